@@ -0,0 +1,1960 @@
+"""Нагрузочные тесты и замеры производительности бота.
+
+Запуск:
+    python benchmark.py async-save --users 500
+    python benchmark.py group-commit --rows 5000
+    python benchmark.py upsert --saves 20000
+    python benchmark.py stats --rows 10000 100000 1000000
+    python benchmark.py memory --respondents 1000000
+    python benchmark.py export --rows 1000000 --max-memory-mb 32
+    python benchmark.py waves --waves 10 --respondents 100000
+    python benchmark.py search --rows 1000000
+    python benchmark.py load --users 600 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Any, Tuple
+
+from database import Database, AsyncDatabase, statistics_from_counters, statistics_keys
+from export import EXPORT_FORMATS, EXPORT_HEADERS, result_to_row, write_csv
+from fake_bot_api import FakeBotAPI
+from persistence import SQLitePersistence
+from ratelimit import OutboundScheduler, PRIORITY_BULK, PRIORITY_SURVEY
+from search import org_index_text, org_match_query, org_tokens
+from sessions import SessionStore
+from subscriptions import SubscriptionCache
+from survey import FIELDS, SURVEY, SurveyAnswers, municipalities, categories
+
+def make_answers(rng: random.Random) -> Dict[str, Any]:
+    """Генерирует случайный набор ответов одного респондента"""
+    category = rng.choice(categories)
+    data = {
+        'municipality': rng.choice(municipalities),
+        'category': category,
+        'education_org': f"Школа №{rng.randint(1, 500)}",
+        'selected_directions': [],
+    }
+    if category == "Студент ВУЗа":
+        data['knows_kosa'] = rng.choice(["Да", "Нет"])
+        data['student_government_rating'] = str(rng.randint(1, 5))
+    else:
+        data['knows_movement'] = rng.choice(["Да", "Нет"])
+        if data['knows_movement'] == "Да":
+            data['is_participant'] = rng.choice(["Да", "Нет"])
+            if data['is_participant'] == "Да":
+                data['knows_curator'] = rng.choice(["Да", "Нет"])
+                data['selected_directions'] = rng.sample(range(12), rng.randint(1, 3))
+                data['region_rating'] = str(rng.randint(1, 5))
+                data['organization_rating'] = str(rng.randint(1, 5))
+    return data
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Возвращает перцентиль pct (0-100) для списка значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(title: str, latencies: List[float]) -> None:
+    """Печатает p50/p99/max для задержек в секундах"""
+    print(
+        f"{title}: n={len(latencies)} "
+        f"p50={percentile(latencies, 50) * 1000:.2f} мс "
+        f"p99={percentile(latencies, 99) * 1000:.2f} мс "
+        f"max={max(latencies) * 1000:.2f} мс"
+    )
+
+
+async def _measure_async_save(db, users: int, blocking: bool) -> None:
+    """Одновременное завершение опроса users пользователями.
+
+    Параллельно работает «лёгкий» обработчик без обращения к БД, который
+    показывает, насколько сохранения задерживают остальных пользователей.
+    """
+    rng = random.Random(42)
+    payloads = [make_answers(rng) for _ in range(users)]
+    save_latencies = []
+    probe_latencies = []
+    done = asyncio.Event()
+
+    async def complete_survey(user_id: int, data: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        if blocking:
+            db.save_survey_result(user_id, data)
+        else:
+            await db.save_survey_result(user_id, data)
+        save_latencies.append(time.perf_counter() - started)
+
+    async def probe() -> None:
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            probe_latencies.append(time.perf_counter() - started - 0.001)
+
+    probe_task = asyncio.create_task(probe())
+    await asyncio.sleep(0)
+    await asyncio.gather(*(complete_survey(user_id, data) for user_id, data in enumerate(payloads, 1)))
+    done.set()
+    await probe_task
+
+    report("  сохранение", save_latencies)
+    report("  другие обработчики", probe_latencies)
+
+
+def bench_async_save(args) -> None:
+    """Сравнение синхронного Database и AsyncDatabase под нагрузкой"""
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Database (синхронно в цикле событий), пользователей: {args.users}")
+        db = Database(os.path.join(tmp, "sync.db"))
+        asyncio.run(_measure_async_save(db, args.users, blocking=True))
+        db.close()
+
+        print(f"AsyncDatabase (отдельный поток), пользователей: {args.users}")
+        adb = AsyncDatabase(os.path.join(tmp, "async.db"))
+        asyncio.run(_measure_async_save(adb, args.users, blocking=False))
+        adb.close()
+
+
+def bench_group_commit(args) -> None:
+    """Сравнение скорости записи (строк/с): по одной транзакции на запись и пакетами"""
+    rng = random.Random(42)
+    payloads = [make_answers(rng) for _ in range(args.rows)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "single.db"))
+        started = time.perf_counter()
+        for user_id, data in enumerate(payloads, 1):
+            db.save_survey_result(user_id, data)
+        elapsed = time.perf_counter() - started
+        db.close()
+        print(f"Транзакция на запись: {args.rows / elapsed:.0f} строк/с")
+
+        async def run_batched() -> float:
+            adb = AsyncDatabase(os.path.join(tmp, "batched.db"), batch_size=args.batch_size)
+            started = time.perf_counter()
+            saved = await asyncio.gather(*(
+                adb.save_survey_result(user_id, data) for user_id, data in enumerate(payloads, 1)
+            ))
+            elapsed = time.perf_counter() - started
+            await adb.aclose()
+            assert all(saved)
+            return elapsed
+
+        elapsed = asyncio.run(run_batched())
+        print(f"Пакетная запись (до {args.batch_size} строк): {args.rows / elapsed:.0f} строк/с")
+
+
+# Прежняя таблица результатов: одна строка на пользователя, ответы текстом
+LEGACY_TABLE_SQL = '''
+CREATE TABLE survey_results (
+    user_id INTEGER PRIMARY KEY,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    municipality TEXT, category TEXT, education_org TEXT, knows_movement TEXT, is_participant TEXT,
+    knows_curator TEXT, selected_directions TEXT, region_rating TEXT, organization_rating TEXT,
+    knows_kosa TEXT, student_government_rating TEXT
+)
+'''
+
+
+def _legacy_params(user_id: int, data: Dict[str, Any]) -> Tuple:
+    """Параметры строки прежней таблицы: направления - массивом JSON"""
+    return (user_id,) + tuple(
+        json.dumps(data.get(field, [])) if field == 'selected_directions' else data.get(field, '')
+        for field in FIELDS
+    )
+
+
+def _legacy_save(conn: sqlite3.Connection, user_id: int, data: Dict[str, Any]) -> None:
+    """Прежний путь сохранения: SELECT, затем UPDATE или INSERT и commit"""
+    params = _legacy_params(user_id, data)
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id FROM survey_results WHERE user_id = ?", (user_id,))
+    if cursor.fetchone():
+        cursor.execute(
+            "UPDATE survey_results SET municipality = ?, category = ?, education_org = ?, "
+            "knows_movement = ?, is_participant = ?, knows_curator = ?, selected_directions = ?, "
+            "region_rating = ?, organization_rating = ?, knows_kosa = ?, "
+            "student_government_rating = ?, timestamp = CURRENT_TIMESTAMP WHERE user_id = ?",
+            params[1:] + params[:1]
+        )
+    else:
+        cursor.execute(
+            "INSERT INTO survey_results (user_id, municipality, category, education_org, "
+            "knows_movement, is_participant, knows_curator, selected_directions, region_rating, "
+            "organization_rating, knows_kosa, student_government_rating) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            params
+        )
+    conn.commit()
+
+
+def bench_upsert(args) -> None:
+    """Стоимость одного сохранения: SELECT + UPDATE/INSERT против UPSERT с WAL"""
+    rng = random.Random(42)
+    # Половина сохранений перезаписывает уже существующих пользователей
+    users = max(1, args.saves // 2)
+    payloads = [(rng.randint(1, users), make_answers(rng)) for _ in range(args.saves)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        conn = sqlite3.connect(legacy_path)
+        conn.execute(LEGACY_TABLE_SQL)
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.execute("PRAGMA synchronous = FULL")
+        started = time.perf_counter()
+        for user_id, data in payloads:
+            _legacy_save(conn, user_id, data)
+        legacy = (time.perf_counter() - started) / args.saves
+        conn.close()
+
+        db = Database(os.path.join(tmp, "upsert.db"))
+        started = time.perf_counter()
+        for user_id, data in payloads:
+            db.save_survey_result(user_id, data)
+        upsert = (time.perf_counter() - started) / args.saves
+        db.close()
+
+    print(f"SELECT + UPDATE/INSERT: {legacy * 1e6:.1f} мкс на сохранение")
+    print(f"UPSERT + WAL:           {upsert * 1e6:.1f} мкс на сохранение ({legacy / upsert:.1f}x)")
+
+
+def fill_database(db: Database, rows: int, seed: int = 42, survey_id: int = None) -> None:
+    """Заполняет базу rows случайными результатами опроса"""
+    rng = random.Random(seed)
+    for start in range(1, rows + 1, 1000):
+        db.save_survey_results([
+            (user_id, make_answers(rng)) for user_id in range(start, min(start + 1000, rows + 1))
+        ], survey_id)
+
+
+def _python_statistics(db: Database) -> Dict[str, Any]:
+    """Прежний способ: все строки в память и подсчёт циклом в Python"""
+    counters = Counter()
+    for result in db.get_all_results():
+        counters.update(statistics_keys(result))
+    return statistics_from_counters(
+        (section, value, count) for (section, value), count in counters.items()
+    )
+
+
+def _measure(func) -> Tuple[float, int]:
+    """Время выполнения и пик памяти Python-объектов"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_stats(args) -> None:
+    """Получение статистики: цикл в Python, агрегация в SQLite и накопленные счётчики"""
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, "stats.db"))
+            fill_database(db, rows)
+
+            print(f"Строк: {rows}")
+            for title, func in (
+                ("цикл в Python", lambda: _python_statistics(db)),
+                ("GROUP BY по ответам", db.get_statistics_sql),
+                ("счётчики survey_stats", db.get_statistics),
+            ):
+                elapsed, peak = _measure(func)
+                print(f"  {title:<22} {elapsed * 1000:10.2f} мс {peak / 1024 / 1024:8.2f} МБ")
+            db.close()
+
+
+def _legacy_users_page(db: Database) -> List[Tuple[int, str, str]]:
+    """Прежний список участников: все анкеты в память, сортировка и первые 10"""
+    users = [(result['user_id'], result['municipality'], result['category']) for result in db.get_all_results()]
+    users.sort(key=lambda user: user[1])
+    return users[:10]
+
+
+def _walk_pages(db: Database, municipality: int = None, category: int = None) -> List[int]:
+    """Все участники по страницам вперёд с проверкой возврата на предыдущие страницы"""
+    pages = [db.get_results_page(municipality=municipality, category=category)]
+    while pages[-1]['has_next']:
+        pages.append(db.get_results_page(municipality=municipality, category=category, after=pages[-1]['last']))
+    page = pages[-1]
+    for expected in reversed(pages[:-1]):
+        page = db.get_results_page(municipality=municipality, category=category, before=page['first'])
+        assert page['items'] == expected['items']
+    assert not page['has_prev']
+    return [user_id for page in pages for user_id, _, _ in page['items']]
+
+
+def bench_users(args) -> None:
+    """Страница списка участников: выборка всех анкет против чтения по курсору"""
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, "users.db"))
+            fill_database(db, rows)
+            municipality, category = db.get_option_codes('municipality')[0][0], db.get_option_codes('category')[0][0]
+
+            # Проверка порядка и фильтров по полному обходу страниц
+            if rows <= args.check_rows:
+                results = db.get_all_results()
+                codes = {
+                    result['user_id']: (db._option_codes['municipality'].get(result['municipality'], 0),
+                                        db._option_codes['category'].get(result['category'], 0))
+                    for result in results
+                }
+                for m, c in ((None, None), (municipality, None), (None, category), (municipality, category)):
+                    expected = sorted(
+                        (codes[user_id][0], user_id) for user_id in codes
+                        if (m is None or codes[user_id][0] == m) and (c is None or codes[user_id][1] == c)
+                    )
+                    assert _walk_pages(db, m, c) == [user_id for _, user_id in expected]
+
+            # Курсор страницы в середине списка
+            middle = db.get_results_page(limit=rows // 2)['last']
+            print(f"Строк: {rows}")
+            for title, func in (
+                ("все анкеты и сортировка", lambda: _legacy_users_page(db)),
+                ("первая страница", lambda: db.get_results_page()),
+                ("страница в середине", lambda: db.get_results_page(after=middle)),
+                ("фильтр муниципалитета", lambda: db.get_results_page(municipality=municipality, after=middle)),
+                ("оба фильтра", lambda: db.get_results_page(municipality=municipality, category=category, after=middle)),
+            ):
+                repeats = 1 if title.startswith("все") else args.repeats
+                started = time.perf_counter()
+                for _ in range(repeats):
+                    func()
+                elapsed = (time.perf_counter() - started) / repeats
+                print(f"  {title:<24} {elapsed * 1000:10.3f} мс")
+            db.close()
+
+
+# Варианты записи названий учебных заведений, как их вводят респонденты
+ORG_TEMPLATES = (
+    "МБОУ СОШ №{n}", "МБОУ «СОШ № {n}»", "Средняя общеобразовательная школа № {n}", "школа {n}", "Школа №{n}",
+    "сош{n}", "МАОУ СОШ №{n} имени А.С. Пушкина", "Гимназия №{n}", "гимназия {n}", "Лицей №{n}", "лицей {n}",
+    "ООШ № {n}", "ГБПОУ «Астраханский колледж № {n}»", "Колледж {n}", "АГТУ", "Астраханский государственный университет",
+    "МБОУ СОШ №{n} г. Астрахани", "МБОУ «СОШ № {n}» г.Астрахани", "школа {n} с. Икряное", "МБОУ «ООШ №{n}» п. Кировский",
+)
+
+# Названия учебных заведений в записи респондентов и ожидаемые результаты поиска,
+# составленные вручную (не той же нормализацией, что и индекс)
+SEARCH_ORGS = (
+    "МБОУ СОШ № 5",
+    "МБОУ СОШ №5 г. Астрахани",
+    "школа 5 с. Икряное",
+    "МБОУ «СОШ № 5» г.Астрахани",
+    "МБОУ СОШ №5г.Астрахани",
+    "Муниципальное бюджетное общеобразовательное учреждение «Средняя общеобразовательная школа № 5»",
+    "МАОУ «СОШ №5 имени А.С. Пушкина» с. Началово",
+    "Школа 15",
+    "МБОУ СОШ № 25 г. Астрахани",
+    "МБОУ СОШ №5а",
+    "МБОУ «СОШ № 5-Б» г. Астрахани",
+    "Гимназия №5",
+    "МБОУ «Гимназия №1» г. Астрахани",
+    "гимназия 11",
+    "МБОУ «Лицей № 2» г. Ахтубинска",
+    "ГБПОУ АО «Астраханский колледж вычислительной техники»",
+)
+SEARCH_CASES = (
+    ("школа 5", {0, 1, 2, 3, 4, 5, 6}),
+    ("СОШ №5", {0, 1, 3, 4, 5, 6}),
+    ("сош 5 астрахань", {1, 3, 4}),
+    ("школа 5 Икряное", {2}),
+    ("школа 5а", {9}),
+    ("СОШ 5-б", {10}),
+    ("имени Пушкина", {6}),
+    ("гимназия 1", {12}),
+    ("гимназии", {11, 12, 13}),
+    ("лицей 2", {14}),
+    ("колледж", {15}),
+)
+
+
+def _org_name(rng: random.Random) -> str:
+    """Случайное название учебного заведения в одном из вариантов записи"""
+    return rng.choice(ORG_TEMPLATES).format(n=rng.randint(1, 200))
+
+
+def _fill_orgs(db: Database, rows: int, seed: int = 42) -> None:
+    """Заполняет базу анкетами с разными вариантами записи названий учебных заведений"""
+    rng = random.Random(seed)
+    for start in range(1, rows + 1, 1000):
+        db.save_survey_results([
+            (user_id, dict(make_answers(rng), education_org=_org_name(rng)))
+            for user_id in range(start, min(start + 1000, rows + 1))
+        ])
+
+
+def _scan_orgs(db: Database, text: str, limit: int = None) -> List[int]:
+    """Поиск без индекса: все названия из базы с той же нормализацией, что и у индекса"""
+    tokens = set(org_tokens(text))
+    found = []
+    for user_id, org in db.conn.execute(
+        "SELECT user_id, text FROM answers WHERE survey_id = ? AND field_id = ? ORDER BY user_id",
+        (db.default_survey_id, db._field_id('education_org'))
+    ):
+        if tokens <= set(org_index_text(org).split()):
+            found.append(user_id)
+            if limit is not None and len(found) > limit:
+                break
+    return found
+
+
+def _like_orgs(db: Database, text: str, limit: int = -1, offset: int = 0) -> List[int]:
+    """Поиск LIKE по словам запроса: просмотр ответов, без учёта вариантов записи"""
+    words = text.split()
+    db.cursor.execute(
+        "SELECT user_id FROM answers WHERE survey_id = ? AND field_id = ? AND "
+        + " AND ".join("text LIKE ?" for _ in words) + " ORDER BY user_id LIMIT ? OFFSET ?",
+        [db.default_survey_id, db._field_id('education_org'), *(f"%{word}%" for word in words), limit, offset]
+    )
+    return [user_id for user_id, in db.cursor.fetchall()]
+
+
+def _check_search_cases(db: Database, first_user_id: int) -> None:
+    """Поиск по названиям SEARCH_ORGS находит ровно ожидаемые анкеты SEARCH_CASES"""
+    db.save_survey_results([
+        (first_user_id + index, dict(make_answers(random.Random(index)), education_org=org))
+        for index, org in enumerate(SEARCH_ORGS)
+    ])
+    for text, expected in SEARCH_CASES:
+        found = {user_id - first_user_id for user_id in _walk_search(db, text)}
+        assert found == expected, (text, sorted(found), sorted(expected))
+
+
+def _walk_search(db: Database, text: str) -> List[int]:
+    """Все найденные участники по страницам вперёд с проверкой возврата на предыдущие страницы"""
+    pages = [db.search_education_org(text)]
+    while pages[-1]['has_next']:
+        pages.append(db.search_education_org(text, after=pages[-1]['last']))
+    page = pages[-1]
+    for expected in reversed(pages[:-1]):
+        page = db.search_education_org(text, before=page['first'])
+        assert page['items'] == expected['items']
+    assert not page['has_prev']
+    return [user_id for page in pages for user_id, _, _ in page['items']]
+
+
+def _measure_saves(db: Database, saves: int, first_user_id: int) -> float:
+    """Среднее время сохранения одной анкеты, секунды"""
+    rng = random.Random(first_user_id)
+    started = time.perf_counter()
+    for user_id in range(first_user_id, first_user_id + saves):
+        db.save_survey_result(user_id, dict(make_answers(rng), education_org=_org_name(rng)))
+    return (time.perf_counter() - started) / saves
+
+
+def bench_search(args) -> None:
+    """Поиск по учебным заведениям: индекс FTS5 против просмотра ответов, стоимость сохранения"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "search.db"))
+        if not db.search_enabled:
+            print("SQLite собран без FTS5: поиск недоступен")
+            return
+
+        cases = Database(os.path.join(tmp, "search-cases.db"))
+        _check_search_cases(cases, 1)
+        cases.close()
+        print(f"Проверка на {len(SEARCH_ORGS)} названиях: найдены ровно ожидаемые анкеты ({len(SEARCH_CASES)} запросов)")
+
+        # Проверка: обход страниц находит тех же участников, что и просмотр всех названий
+        _fill_orgs(db, args.check_rows)
+        for text in args.queries:
+            expected = _scan_orgs(db, text)
+            assert sorted(_walk_search(db, text)) == expected, text
+        print(f"Проверка на {args.check_rows} анкетах: результаты совпадают с просмотром всех названий")
+
+        # Стоимость сохранения анкеты с обновлением индекса и без него
+        with_index = _measure_saves(db, args.saves, args.rows + 1)
+        db.search_enabled = False
+        without_index = _measure_saves(db, args.saves, args.rows + args.saves + 1)
+        db.close()
+        print(f"Сохранение анкеты: {without_index * 1000:.3f} мс без индекса, "
+              f"{with_index * 1000:.3f} мс с индексом (+{(with_index - without_index) * 1e6:.0f} мкс)")
+
+        db = Database(os.path.join(tmp, "search-large.db"))
+        started = time.perf_counter()
+        _fill_orgs(db, args.rows)
+        print(f"Анкет: {args.rows}, заполнение с индексом {time.perf_counter() - started:.1f} с")
+        started = time.perf_counter()
+        db.rebuild_search_index()
+        print(f"Перестроение индекса: {time.perf_counter() - started:.1f} с")
+
+        for text in args.queries:
+            found = db.conn.execute(
+                "SELECT COUNT(*) FROM org_search WHERE org_search MATCH ?", (f"org : ({org_match_query(text)})",)
+            ).fetchone()[0]
+            print(f"Запрос «{text}»: найдено {found}, LIKE находит {len(_like_orgs(db, text))}")
+            # Курсор страницы на глубине deep_offset результатов
+            middle = db.search_education_org(text, limit=min(args.deep_offset, found - 1))
+            for title, func, repeats in (
+                ("первая страница", lambda: db.search_education_org(text), args.repeats),
+                ("глубокая страница", lambda: db.search_education_org(text, after=middle['last']), args.repeats),
+                ("LIKE, первая страница", lambda: _like_orgs(db, text, 11), 1),
+                ("LIKE, глубокая страница", lambda: _like_orgs(db, text, 11, min(args.deep_offset, found - 1)), 1),
+                ("просмотр всех названий", lambda: _scan_orgs(db, text, 10), 1),
+            ):
+                started = time.perf_counter()
+                for _ in range(repeats):
+                    func()
+                elapsed = (time.perf_counter() - started) / repeats
+                print(f"  {title:<24} {elapsed * 1000:10.3f} мс")
+        db.close()
+
+
+def _funnel_events(respondents: int, first_user_id: int, started: float, seed: int = 42):
+    """Переходы респондентов по 12 состояниям опроса: часть бросает опрос, часть начинает заново или отменяет"""
+    rng = random.Random(seed)
+    events = []
+    for user_id in range(first_user_id, first_user_id + respondents):
+        at = started + rng.random() * 86400
+        path = list(range(0, 12))
+        if rng.random() < 0.1:
+            # Начал заново с середины опроса
+            path = path[:rng.randint(1, 11)] + path
+        stop = len(path) if rng.random() < 0.7 else rng.randint(1, len(path))
+        for state in path[:stop]:
+            events.append((1, user_id, state, at))
+            at += rng.lognormvariate(2, 1)
+        if stop == len(path):
+            events.append((1, user_id, -1, at))
+        elif rng.random() < 0.2:
+            events.append((1, user_id, -2, at))
+    events.sort(key=lambda event: event[3])
+    return events
+
+
+def _exact_funnel(db: Database) -> Dict[int, Dict[str, Any]]:
+    """Воронка по полному журналу переходов: точные медианы и число респондентов"""
+    funnel = {}
+    db.cursor.execute("SELECT to_state, COUNT(DISTINCT user_id) FROM funnel_events WHERE survey_id = 1 GROUP BY to_state")
+    for state, reached in db.cursor.fetchall():
+        funnel[state] = {'reached': reached, 'median': None}
+    db.cursor.execute(
+        "SELECT from_state, duration FROM funnel_events WHERE survey_id = 1 AND from_state IS NOT NULL "
+        "ORDER BY from_state, duration"
+    )
+    durations = {}
+    for state, duration in db.cursor.fetchall():
+        durations.setdefault(state, []).append(duration)
+    for state, values in durations.items():
+        funnel[state]['median'] = values[(len(values) - 1) // 2]
+    return funnel
+
+
+def bench_funnel(args) -> None:
+    """Журнал переходов воронки: скорость записи пакетами и время построения воронки"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "funnel.db"))
+
+        # Проверка сводок по точному подсчёту на небольшом журнале
+        events = _funnel_events(args.check_respondents, 1, time.time())
+        for start in range(0, len(events), args.batch_size):
+            assert db.save_funnel_events(events[start:start + args.batch_size])
+        funnel, exact = db.get_funnel(1), _exact_funnel(db)
+        for state, step in exact.items():
+            assert funnel[state]['reached'] == step['reached'], state
+            if step['median'] is not None:
+                assert abs(funnel[state]['median'] / step['median'] - 1) < 0.1, (state, funnel[state]['median'], step['median'])
+        db.cursor.execute("SELECT state, COUNT(*) FROM funnel_positions GROUP BY state")
+        for state, count in db.cursor.fetchall():
+            assert funnel[state]['current'] == count, state
+        print(f"Проверка на {args.check_respondents} респондентах: число дошедших и оставшихся совпадает, "
+              f"медианы в пределах 10%")
+
+        # Рост журнала: запись пакетами и время построения воронки по сводкам и по журналу
+        user_id = args.check_respondents + 1
+        total = db.cursor.execute("SELECT COUNT(*) FROM funnel_events").fetchone()[0]
+        step_events = args.events // args.steps
+        for _ in range(args.steps):
+            written = 0
+            elapsed = 0.0
+            while written < step_events:
+                events = _funnel_events(2000, user_id, time.time(), seed=user_id)
+                user_id += 2000
+                started = time.perf_counter()
+                for start in range(0, len(events), args.batch_size):
+                    db.save_funnel_events(events[start:start + args.batch_size])
+                elapsed += time.perf_counter() - started
+                written += len(events)
+            total += written
+
+            started = time.perf_counter()
+            for _ in range(args.repeats):
+                db.get_funnel(1)
+            summary = (time.perf_counter() - started) / args.repeats
+            line = (f"Переходов {total:>10}: запись {written / elapsed:8.0f} в секунду, "
+                    f"воронка по сводкам {summary * 1000:7.2f} мс")
+            if not args.skip_scan:
+                started = time.perf_counter()
+                _exact_funnel(db)
+                line += f", по журналу {(time.perf_counter() - started) * 1000:9.0f} мс"
+            print(line)
+        db.close()
+
+
+def bench_memory(args) -> None:
+    """Память на одного респондента: словарь строк против SurveyAnswers"""
+    rng = random.Random(42)
+    # Значения берутся из одних и тех же строк, как и ответы с клавиатуры бота
+    samples = [make_answers(rng) for _ in range(1000)]
+
+    for title, build in (
+        ("словарь", lambda data: dict(data, selected_directions=list(data['selected_directions']))),
+        ("SurveyAnswers", SurveyAnswers.from_dict),
+    ):
+        tracemalloc.start()
+        answers = {user_id: build(samples[user_id % len(samples)]) for user_id in range(args.respondents)}
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{title:<14} {size / args.respondents:8.1f} байт на респондента "
+              f"({size / 1024 / 1024:.1f} МБ на {args.respondents})")
+        del answers
+
+
+def _legacy_export(db: Database) -> int:
+    """Прежний экспорт: все строки в память, CSV в StringIO и копия в байтах"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_HEADERS)
+    for result in db.get_all_results():
+        writer.writerow(result_to_row(result))
+    return len(io.BytesIO(output.getvalue().encode('utf-8-sig')).getvalue())
+
+
+def bench_export(args) -> None:
+    """Пиковая память при экспорте CSV: прежний способ против потокового"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.db")
+        db = Database(path)
+        fill_database(db, args.rows)
+        db.close()
+
+        def streaming() -> None:
+            reader = Database(path, read_only=True)
+            count, export_file = write_csv(reader.iter_results())
+            export_file.close()
+            reader.close()
+            assert count == args.rows
+
+        if not args.skip_legacy:
+            legacy_db = Database(path, read_only=True)
+            elapsed, peak = _measure(lambda: _legacy_export(legacy_db))
+            legacy_db.close()
+            print(f"Прежний экспорт:   {elapsed:6.2f} с, пик памяти {peak / 1024 / 1024:8.2f} МБ")
+
+        elapsed, peak = _measure(streaming)
+        print(f"Потоковый экспорт: {elapsed:6.2f} с, пик памяти {peak / 1024 / 1024:8.2f} МБ")
+        if args.max_memory_mb and peak > args.max_memory_mb * 1024 * 1024:
+            raise SystemExit(f"Потоковый экспорт превысил лимит памяти {args.max_memory_mb} МБ")
+
+
+def bench_export_formats(args) -> None:
+    """Размер файла и время формирования для каждого формата экспорта"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.db")
+        db = Database(path)
+        fill_database(db, args.rows)
+        db.close()
+
+        for key, (title, extension, writer) in EXPORT_FORMATS.items():
+            reader = Database(path, read_only=True)
+            started = time.perf_counter()
+            count, export_file = writer(reader.iter_results())
+            elapsed = time.perf_counter() - started
+            export_file.seek(0, io.SEEK_END)
+            size = export_file.tell()
+            export_file.close()
+            reader.close()
+            assert count == args.rows
+            print(f"{title:14} {extension:9} {elapsed:6.2f} с, {size / 1024 / 1024:8.2f} МБ")
+
+
+def _measure_wave(path: str, db: Database, survey_id: int, respondents: int) -> None:
+    """Статистика и потоковый экспорт CSV одной волны"""
+    def export() -> None:
+        reader = Database(path, read_only=True)
+        count, export_file = write_csv(reader.iter_results(survey_id=survey_id))
+        export_file.close()
+        reader.close()
+        assert count == respondents
+
+    # Время - без tracemalloc, который замедляет Python в несколько раз
+    for title, func in (
+        ("статистика: счётчики", lambda: db.get_statistics(survey_id)),
+        ("статистика: GROUP BY", lambda: db.get_statistics_sql(survey_id)),
+        ("экспорт CSV", export),
+    ):
+        started = time.perf_counter()
+        func()
+        print(f"    {title:<22} {(time.perf_counter() - started) * 1000:10.2f} мс")
+    _, peak = _measure(export)
+    print(f"    {'пик памяти экспорта':<22} {peak / 1024 / 1024:10.2f} МБ")
+
+
+def _check_migration(tmp: str, respondents: int) -> None:
+    """Перенос прежней таблицы survey_results в общие таблицы ответов"""
+    path = os.path.join(tmp, "legacy.db")
+    rng = random.Random(7)
+    payloads = [(user_id, make_answers(rng)) for user_id in range(1, respondents + 1)]
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_TABLE_SQL)
+    conn.executemany(
+        "INSERT INTO survey_results (user_id, municipality, category, education_org, knows_movement, "
+        "is_participant, knows_curator, selected_directions, region_rating, organization_rating, knows_kosa, "
+        "student_government_rating) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [_legacy_params(user_id, data) for user_id, data in payloads]
+    )
+    conn.commit()
+    conn.close()
+
+    started = time.perf_counter()
+    db = Database(path)
+    opened = time.perf_counter() - started
+    db.migrate_legacy_results()
+    elapsed = time.perf_counter() - started
+
+    expected = Counter()
+    for _, data in payloads:
+        expected.update(statistics_keys(data))
+    stats = db.get_statistics()
+    matches = stats == statistics_from_counters(
+        (section, value, count) for (section, value), count in expected.items()
+    )
+    mismatches = db.reconcile_statistics()['mismatches']
+    db.close()
+    print(f"Перенос прежней таблицы ({respondents} анкет): открытие базы {opened:.2f} с, всего {elapsed:.2f} с, "
+          f"анкет после переноса {stats['total_users']}, статистика совпадает: {'да' if matches else 'нет'}, "
+          f"расхождений счётчиков {len(mismatches)}")
+
+
+def bench_waves(args) -> None:
+    """Статистика и экспорт одной волны по мере накопления волн, перенос прежней таблицы"""
+    waves = [dict(SURVEY, wave=wave) for wave in range(1, args.waves + 1)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "waves.db")
+        db = Database(path, surveys=waves)
+        survey_ids = [db.survey_ids[(SURVEY['name'], wave)] for wave in range(1, args.waves + 1)]
+
+        fill_time = 0.0
+        for number, survey_id in enumerate(survey_ids, 1):
+            started = time.perf_counter()
+            fill_database(db, args.respondents, seed=number, survey_id=survey_id)
+            fill_time += time.perf_counter() - started
+            if number in (1, args.waves):
+                size = os.path.getsize(path) + os.path.getsize(path + "-wal")
+                print(f"Волн: {number}, анкет: {number * args.respondents}, "
+                      f"база {size / 1024 / 1024:.0f} МБ, запись {number * args.respondents / fill_time:.0f} анкет/с")
+                print("  волна 1:")
+                _measure_wave(path, db, survey_ids[0], args.respondents)
+                if number > 1:
+                    print(f"  волна {number}:")
+                    _measure_wave(path, db, survey_id, args.respondents)
+        db.close()
+
+        if not args.skip_migration:
+            _check_migration(tmp, args.respondents)
+
+
+async def _measure_subscription_cache(args) -> None:
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    async with FakeBotAPI(latency=args.latency, subscribed=set()) as api:
+        request = HTTPXRequest(connection_pool_size=256, pool_timeout=60)
+        async with Bot("1:fake", base_url=api.base_url, request=request) as bot:
+            cache = SubscriptionCache("@channel", positive_ttl=600, negative_ttl=600)
+            rng = random.Random(42)
+
+            # Одновременные проверки одного пользователя выполняются одним запросом
+            results = await asyncio.gather(*(cache.is_subscribed(bot, 1) for _ in range(10)))
+            assert results == [False] * 10 and api.calls['getChatMember'] == 1
+
+            # Пользователь подписался: без сброса кэш отвечает по-старому, после сброса - заново
+            api.subscribed.add(1)
+            assert not await cache.is_subscribed(bot, 1)
+            cache.invalidate(1)
+            assert await cache.is_subscribed(bot, 1) and api.calls['getChatMember'] == 2
+
+            # Всплеск трафика: каждый пользователь проверяется несколько раз
+            api.subscribed.update(range(args.users))
+            api.calls.clear()
+            checks = [rng.randrange(args.users) for _ in range(args.users * args.checks)]
+            for title in ("Холодный кэш", "Тёплый кэш"):
+                calls_before = api.calls['getChatMember']
+                started = time.perf_counter()
+                await asyncio.gather(*(cache.is_subscribed(bot, user_id) for user_id in checks))
+                elapsed = time.perf_counter() - started
+                print(f"{title}: {len(checks)} проверок за {elapsed:.2f} с, "
+                      f"запросов getChatMember: {api.calls['getChatMember'] - calls_before}")
+
+    metrics = cache.metrics()
+    print(f"Из кэша: {metrics['hits']}, совмещено: {metrics['shared']}, промахов: {metrics['misses']}, "
+          f"доля без запроса: {metrics['hit_rate'] * 100:.1f}%")
+
+
+def bench_subscription(args) -> None:
+    """Число запросов к Bot API при проверке подписки через кэш"""
+    asyncio.run(_measure_subscription_cache(args))
+
+
+async def _measure_scheduler(args, use_scheduler: bool) -> None:
+    """Всплеск сообщений пользователям и файлов экспорта на сервер, отвечающий ошибками 429"""
+    from telegram.error import RetryAfter
+    from telegram.ext import ExtBot
+    from telegram.request import HTTPXRequest
+
+    async with FakeBotAPI(global_limit=30, chat_limit=3) as api:
+        request = HTTPXRequest(connection_pool_size=256, pool_timeout=120)
+        rate_limiter = OutboundScheduler() if use_scheduler else None
+        bot = ExtBot("1:fake", base_url=api.base_url, request=request, rate_limiter=rate_limiter)
+        latencies = {PRIORITY_SURVEY: [], PRIORITY_BULK: []}
+        failures = 0
+
+        async def send(chat_id: int, priority: int) -> None:
+            nonlocal failures
+            kwargs = {'rate_limit_args': priority} if use_scheduler else {}
+            started = time.perf_counter()
+            try:
+                if priority == PRIORITY_BULK:
+                    await bot.send_document(chat_id, document=b"export", filename="export.csv", **kwargs)
+                else:
+                    await bot.send_message(chat_id, "Вопрос", **kwargs)
+            except RetryAfter:
+                failures += 1
+                return
+            latencies[priority].append(time.perf_counter() - started)
+
+        async with bot:
+            sends = [send(chat_id, PRIORITY_SURVEY) for chat_id in range(1, args.chats + 1)
+                     for _ in range(args.messages)]
+            sends += [send(0, PRIORITY_BULK) for _ in range(args.exports)]
+            random.Random(42).shuffle(sends)
+            started = time.perf_counter()
+            await asyncio.gather(*sends)
+            elapsed = time.perf_counter() - started
+
+    title = "С планировщиком" if use_scheduler else "Без планировщика"
+    print(f"{title}: {len(sends)} сообщений за {elapsed:.2f} с, не доставлено {failures}, "
+          f"ответов 429 от сервера {api.flood_errors}")
+    for priority, name in ((PRIORITY_SURVEY, "ответы в опросе"), (PRIORITY_BULK, "файлы экспорта")):
+        if latencies[priority]:
+            report(f"  {name}", latencies[priority])
+
+
+def bench_scheduler(args) -> None:
+    """Доставка сообщений при превышении лимитов Telegram с планировщиком и без него"""
+    asyncio.run(_measure_scheduler(args, use_scheduler=False))
+    asyncio.run(_measure_scheduler(args, use_scheduler=True))
+
+
+# Путь респондента по опросу: (вид обновления, текст или callback_data)
+SURVEY_SCRIPT = [
+    ('text', '/start'), ('text', 'Город Астрахань'), ('text', 'Ученик'), ('text', 'Школа № 1'),
+    ('text', 'Да'), ('text', 'Да'), ('text', 'Да'), ('callback', 'direction_0'), ('callback', 'direction_3'),
+    ('callback', 'direction_done'), ('text', '4'), ('text', '5'),
+]
+
+# Пути респондентов по всем ветвям опроса: (ветвь, ожидаемое завершение, шаги)
+LOAD_SCRIPTS = [
+    ('Ученик, участник движения', 'participant', SURVEY_SCRIPT),
+    ('Студент ССУЗа, участник движения', 'participant', [
+        ('text', '/start'), ('text', 'Красноярский округ'), ('text', 'Студент ССУЗа'), ('text', 'Колледж № 2'),
+        ('text', 'Да'), ('text', 'Да'), ('text', 'Нет'), ('callback', 'direction_5'), ('callback', 'direction_done'),
+        ('text', '3'), ('text', '4'),
+    ]),
+    ('Ученик, не знает о движении', 'not_familiar', [
+        ('text', '/start'), ('text', 'Ахтубинский район'), ('text', 'Ученик'), ('text', 'Школа № 7'), ('text', 'Нет'),
+    ]),
+    ('Студент ССУЗа, знает о движении, не участник', 'not_participant', [
+        ('text', '/start'), ('text', 'Лиманский район'), ('text', 'Студент ССУЗа'), ('text', 'Колледж № 1'),
+        ('text', 'Да'), ('text', 'Нет'),
+    ]),
+    ('Студент ВУЗа, знает «Косу»', 'student', [
+        ('text', '/start'), ('text', 'Город Астрахань'), ('text', 'Студент ВУЗа'), ('text', 'Да'), ('text', 'АГУ'),
+        ('text', '5'),
+    ]),
+    ('Студент ВУЗа, не знает «Косу»', 'student', [
+        ('text', '/start'), ('text', 'Камызякский район'), ('text', 'Студент ВУЗа'), ('text', 'Нет'), ('text', 'АГТУ'),
+        ('text', '2'),
+    ]),
+]
+
+
+def make_update(update_id: int, user_id: int, kind: str, value: str) -> Dict[str, Any]:
+    """Обновление Telegram от пользователя: сообщение или нажатие inline-кнопки"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Респондент'}
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+               'from': user, 'text': value}
+    if kind == 'callback':
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': value, 'message': message}}
+    if value.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(value.split(' ', 1)[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+async def _start_application(survey_bot, api: FakeBotAPI, mode: str = 'polling'):
+    """Запуск бота против имитации Bot API; возвращает приложение и функцию доставки обновлений"""
+    import socket
+    import httpx
+
+    # Каждый шаг сценария ждёт ответа бота - правки клавиатуры отправляются без задержки
+    survey_bot.direction_edits.delay = 0
+    application = survey_bot.build_application(base_url=api.base_url)
+    await application.initialize()
+
+    client = None
+    if mode == 'webhook':
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        await application.updater.start_webhook(
+            listen='127.0.0.1', port=port, url_path='telegram', secret_token='secret',
+            webhook_url=f'http://127.0.0.1:{port}/telegram'
+        )
+        client = httpx.AsyncClient(limits=httpx.Limits(max_connections=256))
+        webhook_url = f'http://127.0.0.1:{port}/telegram'
+    else:
+        await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    await application.start()
+
+    async def deliver(user_id: int, kind: str, value: str) -> None:
+        update = make_update(next(_update_ids), user_id, kind, value)
+        if client is None:
+            api.push_update(update)
+        else:
+            response = await client.post(webhook_url, json=update,
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+            response.raise_for_status()
+
+    async def stop() -> None:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        if client is not None:
+            await client.aclose()
+
+    return deliver, stop
+
+
+# Номера обновлений растут на протяжении всего запуска, как у Telegram
+_update_ids = iter(range(1, 10 ** 9))
+
+
+async def _calibrate(api: FakeBotAPI, deliver, user_id: int) -> List[int]:
+    """Сколько сообщений бот отправляет на каждом шаге: проходим опрос одним пользователем"""
+    expected = []
+    for kind, value in SURVEY_SCRIPT:
+        await deliver(user_id, kind, value)
+        count = -1
+        while count != api.chat_messages[user_id]:
+            count = api.chat_messages[user_id]
+            await asyncio.sleep(0.2)
+        expected.append(count)
+    return expected
+
+
+async def _measure_updates_mode(args, survey_bot, mode: str, first_user_id: int) -> None:
+    """Прохождение опроса args.users пользователями одновременно в режиме polling или webhook"""
+    api = FakeBotAPI()
+    await api.start()
+    if not args.telegram_limits:
+        # Лимиты Telegram скрыли бы разницу между режимами - снимаем их
+        survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    deliver, stop = await _start_application(survey_bot, api, mode)
+    expected = await _calibrate(api, deliver, first_user_id)
+
+    latencies = []
+
+    async def respondent(user_id: int) -> None:
+        for (kind, value), count in zip(SURVEY_SCRIPT, expected):
+            if args.think:
+                await asyncio.sleep(args.think)
+            started = time.perf_counter()
+            await deliver(user_id, kind, value)
+            await asyncio.wait_for(api.wait_messages(user_id, count), 60)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(respondent(first_user_id + 1 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await stop()
+    await api.stop()
+
+    print(f"{mode}: {len(latencies)} обновлений за {elapsed:.2f} с ({len(latencies) / elapsed:.0f} в секунду)")
+    report("  ответ бота", latencies)
+
+
+async def _measure_updates(args) -> None:
+    import logging
+    import bot as survey_bot
+
+    # Журнал бота и httpx на каждое обновление исказил бы замеры
+    logging.getLogger().setLevel(logging.WARNING)
+    modes = ['polling', 'webhook'] if args.mode == 'both' else [args.mode]
+    for index, mode in enumerate(modes):
+        await _measure_updates_mode(args, survey_bot, mode, first_user_id=(index + 1) * 1000000)
+    await survey_bot.db.aclose()
+
+
+async def _check_restart(args, survey_bot) -> None:
+    """Перезапуск бота посреди опроса: пользователи должны продолжить с того же вопроса"""
+    api = FakeBotAPI()
+    await api.start()
+    survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    deliver, stop = await _start_application(survey_bot, api)
+    expected = await _calibrate(api, deliver, 1)
+    users = range(2, args.users + 2)
+    half = len(SURVEY_SCRIPT) // 2
+
+    async def answer(user_id: int, steps: range) -> None:
+        for step in steps:
+            kind, value = SURVEY_SCRIPT[step]
+            await deliver(user_id, kind, value)
+            await asyncio.wait_for(api.wait_messages(user_id, expected[step]), 60)
+
+    await asyncio.gather(*(answer(user_id, range(half)) for user_id in users))
+    await stop()
+    # Новый процесс начинает с пустой памятью
+    survey_bot.sessions._sessions.clear()
+
+    deliver, stop = await _start_application(survey_bot, api)
+    await asyncio.gather(*(answer(user_id, range(half, len(SURVEY_SCRIPT))) for user_id in users))
+    await stop()
+    await api.stop()
+
+    completed = 0
+    for user_id in users:
+        result = await survey_bot.db.get_result_by_user_id(user_id)
+        if result and result['municipality'] == 'Город Астрахань' and result['selected_directions'] == [0, 3] \
+                and result['organization_rating'] == '5':
+            completed += 1
+    print(f"Перезапуск посреди опроса: завершили опрос с сохранёнными ответами {completed} из {len(users)}")
+
+
+async def _measure_transitions(args) -> None:
+    """Стоимость сохранения одного перехода: раз в интервал против записи на каждый переход"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = AsyncDatabase(os.path.join(tmp, "persistence.db"))
+        sessions = SessionStore(db)
+        rng = random.Random(42)
+        for user_id in range(args.users):
+            answers = sessions.start(user_id)
+            for field, value in make_answers(rng).items():
+                answers[field] = value
+
+        for title, batch_size in (("Запись на каждый переход", 1), ("Запись раз в интервал", args.users)):
+            persistence = SQLitePersistence(db, sessions)
+            transitions = 0
+            started = time.perf_counter()
+            for state in range(len(SURVEY_SCRIPT)):
+                for first in range(0, args.users, batch_size):
+                    for user_id in range(first, min(first + batch_size, args.users)):
+                        await persistence.update_conversation("survey", (user_id, user_id), state)
+                        transitions += 1
+                    await persistence.flush()
+            elapsed = time.perf_counter() - started
+            print(f"{title}: {elapsed / transitions * 1e6:7.1f} мкс на переход, транзакций {persistence.writes}")
+        await db.aclose()
+
+
+async def _measure_persistence(args) -> None:
+    import logging
+    import bot as survey_bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    await _check_restart(args, survey_bot)
+    await survey_bot.db.aclose()
+    await _measure_transitions(args)
+
+
+def bench_persistence(args) -> None:
+    """Восстановление опроса после перезапуска и накладные расходы на сохранение состояний"""
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            asyncio.run(_measure_persistence(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+def _in_process_request(api: FakeBotAPI, messages: Dict[int, Dict[str, Any]] = None, latency: float = 0.0):
+    """Запросы бота к имитации Bot API в том же процессе, без сети.
+
+    Если передан словарь messages, в нём для каждого чата запоминается
+    последнее сообщение бота с inline-клавиатурой в том виде, в каком его
+    видит пользователь: номер, текст и клавиатура. latency - задержка
+    ответа Bot API в секундах.
+    """
+    from telegram.request import BaseRequest
+
+    class InProcessRequest(BaseRequest):
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            params = request_data.json_parameters if request_data is not None else {}
+            method = url.rsplit('/', 1)[-1]
+            if latency:
+                await asyncio.sleep(latency)
+            status, response = api.respond(method, params)
+            if messages is not None and response['ok'] and method in ('sendMessage', 'editMessageText'):
+                chat_id = int(params['chat_id'])
+                if method == 'sendMessage' and 'inline_keyboard' in params.get('reply_markup', ''):
+                    messages[chat_id] = {'message_id': response['result']['message_id']}
+                if chat_id in messages and (method == 'sendMessage' or
+                                            int(params['message_id']) == messages[chat_id]['message_id']):
+                    messages[chat_id]['text'] = params['text']
+                    messages[chat_id]['reply_markup'] = json.loads(params.get('reply_markup', 'null'))
+            return int(status.split(' ', 1)[0]), json.dumps(response).encode('utf-8')
+
+    return InProcessRequest()
+
+
+def _measure_markups(iterations: int) -> None:
+    """Построение клавиатуры направлений при каждом нажатии против готовой клавиатуры"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from keyboards import ToggleKeyboard
+    from survey import directions
+
+    rng = random.Random(42)
+    masks = [sum(1 << idx for idx in rng.sample(range(len(directions)), rng.randint(0, 3)))
+             for _ in range(iterations)]
+
+    def build(mask: int) -> InlineKeyboardMarkup:
+        # Прежнее построение клавиатуры при каждом нажатии на направление
+        keyboard = []
+        for i, direction in enumerate(directions):
+            text = direction
+            if mask >> i & 1:
+                text = f"✅ {direction}"
+            keyboard.append([InlineKeyboardButton(text, callback_data=f"direction_{i}")])
+        keyboard.append([InlineKeyboardButton("Завершить выбор", callback_data="direction_done")])
+        return InlineKeyboardMarkup(keyboard)
+
+    prebuilt = ToggleKeyboard(directions, "direction", 3).markup
+    for title, make in (("Построение при каждом нажатии", build), ("Готовая клавиатура по маске", prebuilt)):
+        started = time.process_time()
+        for mask in masks:
+            make(mask)
+        elapsed = time.process_time() - started
+        print(f"{title}: {elapsed / iterations * 1e6:7.2f} мкс процессора на клавиатуру направлений")
+
+
+async def _measure_handler_cpu(args, survey_bot) -> None:
+    """Процессорное время обработки одного обновления на каждом шаге опроса"""
+    from telegram import Update
+
+    api = FakeBotAPI()
+    survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    application = survey_bot.build_application(request=_in_process_request(api))
+    await application.initialize()
+    await application.start()
+
+    cpu = [[] for _ in SURVEY_SCRIPT]
+    for user_id in range(1, args.users + 1):
+        for step, (kind, value) in enumerate(SURVEY_SCRIPT):
+            update = Update.de_json(make_update(next(_update_ids), user_id, kind, value), application.bot)
+            started = time.process_time()
+            await application.process_update(update)
+            cpu[step].append(time.process_time() - started)
+
+    await application.stop()
+    await application.shutdown()
+
+    print(f"Процессорное время на обновление ({args.users} пользователей):")
+    for (kind, value), times in zip(SURVEY_SCRIPT, cpu):
+        print(f"  {value:<20} {sum(times) / len(times) * 1e6:8.1f} мкс")
+    total = [elapsed for times in cpu for elapsed in times]
+    print(f"  {'в среднем':<20} {sum(total) / len(total) * 1e6:8.1f} мкс")
+
+
+async def _measure_direction_taps(args, survey_bot, delay: float) -> None:
+    """Быстрые нажатия на кнопки направлений: сколько запросов к Bot API они порождают"""
+    from telegram import Update
+
+    api = FakeBotAPI()
+    messages = {}
+    survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    survey_bot.direction_edits.delay = delay
+    application = survey_bot.build_application(request=_in_process_request(api, messages))
+    await application.initialize()
+    await application.start()
+
+    async def process(user_id: int, kind: str, value: str) -> None:
+        data = make_update(next(_update_ids), user_id, kind, value)
+        if kind == 'callback':
+            # Нажатие приходит вместе с сообщением в том виде, в каком его видит пользователь
+            data['callback_query']['message'].update(messages[user_id])
+        await application.process_update(Update.de_json(data, application.bot))
+
+    rng = random.Random(42)
+    first_tap = SURVEY_SCRIPT.index(('callback', 'direction_0'))
+    users = range(1, args.users + 1)
+    taps = {user_id: [rng.randrange(6) for _ in range(args.taps)] for user_id in users}
+
+    async def respondent(user_id: int) -> None:
+        for kind, value in SURVEY_SCRIPT[:first_tap]:
+            await process(user_id, kind, value)
+
+    await asyncio.gather(*(respondent(user_id) for user_id in users))
+    calls_before = api.calls.copy()
+
+    async def tapper(user_id: int) -> None:
+        for direction in taps[user_id]:
+            await process(user_id, 'callback', f'direction_{direction}')
+            await asyncio.sleep(args.interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(tapper(user_id) for user_id in users))
+    # Ждём отправки последних правок
+    await asyncio.sleep(delay + 0.2)
+    elapsed = time.perf_counter() - started
+    calls = api.calls - calls_before
+
+    # Клавиатура, которую в итоге видит пользователь, должна совпадать с его выбором
+    correct = 0
+    for user_id in users:
+        selected = set()
+        for direction in taps[user_id]:
+            if direction in selected:
+                selected.remove(direction)
+            elif len(selected) < 3:
+                selected.add(direction)
+        markup = messages[user_id]['reply_markup']['inline_keyboard']
+        shown = {int(row[0]['callback_data'].split('_')[1]) for row in markup if row[0]['text'].startswith('✅')}
+        correct += shown == selected
+
+    await application.stop()
+    await survey_bot.direction_edits.flush()
+    await application.shutdown()
+
+    total_taps = args.users * args.taps
+    print(f"Окно объединения {delay:.2f} с: нажатий {total_taps} за {elapsed:.2f} с, "
+          f"ответов на нажатия {calls['answerCallbackQuery']}, правок сообщений {calls['editMessageText']} "
+          f"({calls['editMessageText'] / total_taps:.2f} на нажатие), "
+          f"клавиатура совпадает с выбором у {correct} из {args.users}")
+
+
+async def _measure_taps(args) -> None:
+    import logging
+    import bot as survey_bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for delay in (0.0, args.delay):
+        await _measure_direction_taps(args, survey_bot, delay)
+    await survey_bot.db.aclose()
+
+
+def bench_taps(args) -> None:
+    """Объединение правок клавиатуры направлений при быстрых нажатиях"""
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            asyncio.run(_measure_taps(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+async def _measure_handlers(args) -> None:
+    import logging
+    import bot as survey_bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    await _measure_handler_cpu(args, survey_bot)
+    await survey_bot.db.aclose()
+
+
+def bench_handlers(args) -> None:
+    """Процессорное время обработчиков опроса и построения клавиатур"""
+    _measure_markups(args.iterations)
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            asyncio.run(_measure_handlers(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+async def _measure_instrumentation(args, survey_bot) -> None:
+    """Процессорное время обработки обновления с показателями и без них; проверка страницы /metrics"""
+    import httpx
+    from telegram import Update
+    from metrics import REGISTRY, MetricsServer
+
+    api = FakeBotAPI()
+    survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    application = survey_bot.build_application(request=_in_process_request(api))
+    await application.initialize()
+    await application.start()
+
+    async def run(first_user_id: int) -> float:
+        """Опрос args.users пользователями подряд; процессорное время на обновление"""
+        elapsed = 0.0
+        for user_id in range(first_user_id, first_user_id + args.users):
+            for kind, value in SURVEY_SCRIPT:
+                update = Update.de_json(make_update(next(_update_ids), user_id, kind, value), application.bot)
+                started = time.process_time()
+                await application.process_update(update)
+                elapsed += time.process_time() - started
+        return elapsed / (args.users * len(SURVEY_SCRIPT))
+
+    # Прогрев, затем режимы по очереди, чтобы дрейф частоты процессора не достался одному из них
+    await run(1)
+    times = {False: [], True: []}
+    for round_index in range(args.rounds):
+        for enabled in (False, True):
+            REGISTRY.enabled = enabled
+            times[enabled].append(await run((round_index * 2 + enabled + 1) * 1000000))
+    REGISTRY.enabled = True
+
+    server = MetricsServer(REGISTRY, port=0)
+    await server.start()
+    async with httpx.AsyncClient() as client:
+        started = time.perf_counter()
+        response = await client.get(f"http://127.0.0.1:{server.port}/metrics")
+        scrape = time.perf_counter() - started
+    await server.stop()
+    await application.stop()
+    await application.shutdown()
+
+    page = response.text
+    for name in ('survey_bot_handler_seconds_count', 'survey_bot_db_seconds_count', 'survey_bot_api_seconds_count',
+                 'survey_bot_questions_asked_total', 'survey_bot_surveys_finished_total', 'survey_bot_sessions_size'):
+        assert name in page, name
+    off, on = min(times[False]), min(times[True])
+    print(f"Процессорное время на обновление ({args.users} пользователей, лучший из {args.rounds} проходов):")
+    print(f"  без показателей  {off * 1e6:8.1f} мкс")
+    print(f"  с показателями   {on * 1e6:8.1f} мкс ({(on - off) * 1e6:+.1f} мкс, {(on / off - 1) * 100:+.1f}%)")
+    print(f"Страница /metrics: {len(page.splitlines())} строк, {len(page) / 1024:.1f} КБ за {scrape * 1000:.1f} мс")
+
+    # Стоимость одного измерения без остального бота
+    child = REGISTRY.histogram('benchmark_seconds', 'Замер стоимости наблюдения').labels()
+    iterations = 1000000
+    started = time.perf_counter()
+    for _ in range(iterations):
+        child.observe(time.perf_counter() - started)
+    print(f"Наблюдение в гистограмму с замером времени: {(time.perf_counter() - started) / iterations * 1e9:.0f} нс")
+
+
+async def _measure_metrics(args) -> None:
+    import logging
+    import bot as survey_bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    await _measure_instrumentation(args, survey_bot)
+    await survey_bot.db.aclose()
+
+
+def bench_metrics(args) -> None:
+    """Накладные расходы на показатели работы бота"""
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            asyncio.run(_measure_metrics(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+class _ThrottledFile:
+    """Файл журнала на медленном диске: каждая запись ждёт delay секунд"""
+
+    def __init__(self, path: str, delay: float):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        self.writes += 1
+        return self.file.write(text)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+async def _measure_logging_mode(args, survey_bot, mode: str, first_user_id: int) -> None:
+    """Опрос args.users пользователями при журнале на медленном диске: запись в обработчиках или в потоке журнала"""
+    import logging
+    from logs import TEXT_FORMAT, TextFormatter, start_queue_logging, stop_queue_logging
+
+    stream = _ThrottledFile(f"bot-{mode}.log", args.disk_delay)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(TextFormatter(TEXT_FORMAT))
+    if mode == 'queue':
+        start_queue_logging([handler])
+    else:
+        # Прежняя настройка: обработчик файла вызывается в том потоке, где сделана запись
+        stop_queue_logging()
+        root = logging.getLogger()
+        for existing in root.handlers[:]:
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(logging.WARNING if mode == 'off' else logging.INFO)
+
+    api = FakeBotAPI()
+    await api.start()
+    survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    deliver, stop = await _start_application(survey_bot, api)
+    expected = await _calibrate(api, deliver, first_user_id)
+    writes_before = stream.writes
+
+    latencies = []
+
+    async def respondent(user_id: int) -> None:
+        for (kind, value), count in zip(SURVEY_SCRIPT, expected):
+            started = time.perf_counter()
+            await deliver(user_id, kind, value)
+            await asyncio.wait_for(api.wait_messages(user_id, count), 120)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(respondent(first_user_id + 1 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    records = stream.writes - writes_before
+
+    await stop()
+    await api.stop()
+    # Записи, оставшиеся в очереди, дописываются уже после замера
+    drain_started = time.perf_counter()
+    stop_queue_logging()
+    drain = time.perf_counter() - drain_started
+    stream.close()
+
+    titles = {'off': 'журнал выключен (WARNING)', 'sync': 'запись в обработчиках', 'queue': 'поток журнала'}
+    print(f"{titles[mode]}: {len(latencies)} обновлений за {elapsed:.2f} с, записей журнала за замер {records}"
+          + (f", дозапись очереди после замера {drain:.2f} с" if mode == 'queue' else ""))
+    report("  ответ бота", latencies)
+
+
+async def _measure_logging(args) -> None:
+    import bot as survey_bot
+
+    for index, mode in enumerate(('off', 'sync', 'queue')):
+        await _measure_logging_mode(args, survey_bot, mode, first_user_id=(index + 1) * 1000000)
+    await survey_bot.db.aclose()
+
+
+def bench_logging(args) -> None:
+    """Задержка ответа бота при записи журнала на медленный диск"""
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            print(f"Запись в журнал ждёт диск {args.disk_delay * 1000:.1f} мс, пользователей {args.users}")
+            asyncio.run(_measure_logging(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+def _free_ports(count: int) -> int:
+    """Первый из count подряд идущих свободных портов"""
+    import socket
+
+    rng = random.Random()
+    while True:
+        base = rng.randint(20000, 60000 - count)
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+
+
+async def _run_cluster_check(args, tmp: str) -> None:
+    """Прохождение опроса через приёмник webhook и args.workers процессов-обработчиков"""
+    import re
+    import signal
+    import subprocess
+    import sys
+    import httpx
+
+    api = FakeBotAPI()
+    await api.start()
+    port = _free_ports(args.workers + 1)
+    env = {
+        **os.environ, 'BOT_TOKEN': '1:fake', 'CHANNEL_USERNAME': '@channel', 'BOT_API_URL': api.base_url,
+        'WEBHOOK_URL': f'http://127.0.0.1:{port}', 'WEBHOOK_LISTEN': '127.0.0.1', 'WEBHOOK_PORT': str(port),
+        'WEBHOOK_SECRET': 'secret', 'WORKERS': str(args.workers), 'WORKER_BASE_PORT': str(port + 1),
+        # Лимит на число сообщений в секунду от бота снят, лимит на один чат - как у Telegram
+        'TELEGRAM_GLOBAL_RATE': '100000',
+        'DIRECTION_EDIT_DELAY': '0',
+    }
+    log_path = os.path.join(tmp, 'cluster.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')],
+                                   cwd=tmp, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 60
+        while not api.calls['setWebhook']:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"Бот не запустился, см. {log_path}")
+            await asyncio.sleep(0.1)
+
+        client = httpx.AsyncClient(limits=httpx.Limits(max_connections=256), timeout=60)
+        webhook_url = f'http://127.0.0.1:{port}/telegram'
+
+        async def deliver(user_id: int, kind: str, value: str) -> None:
+            update = make_update(next(_update_ids), user_id, kind, value)
+            response = await client.post(webhook_url, json=update,
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+            response.raise_for_status()
+
+        expected = await _calibrate(api, deliver, 1)
+        users = range(2, args.users + 2)
+        lost = 0
+
+        async def respondent(user_id: int) -> None:
+            nonlocal lost
+            for (kind, value), count in zip(SURVEY_SCRIPT, expected):
+                await deliver(user_id, kind, value)
+                try:
+                    await asyncio.wait_for(api.wait_messages(user_id, count), 60)
+                except asyncio.TimeoutError:
+                    # Ответ не пришёл - обновление потеряно или попало к процессу без состояния диалога
+                    lost += 1
+                    return
+
+        started = time.perf_counter()
+        await asyncio.gather(*(respondent(user_id) for user_id in users))
+        elapsed = time.perf_counter() - started
+        await client.aclose()
+    finally:
+        process.send_signal(signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, process.wait)
+        await api.stop()
+
+    with open(log_path) as log:
+        output = log.read()
+    # Итоги каждого обработчика: сколько разных пользователей он обслужил и сколько получил чужих обновлений
+    summaries = re.findall(r'Обработчик (\d+) из \d+: принято обновлений (\d+), пользователей (\d+), '
+                           r'чужих обновлений (\d+)', output)
+    served = sum(int(summary[2]) for summary in summaries)
+    misrouted = sum(int(summary[3]) for summary in summaries)
+
+    db = Database(os.path.join(tmp, 'survey_bot.db'))
+    completed = 0
+    for user_id in users:
+        result = db.get_result_by_user_id(user_id)
+        if result and result['municipality'] == 'Город Астрахань' and result['selected_directions'] == [0, 3] \
+                and result['organization_rating'] == '5':
+            completed += 1
+    db.close()
+
+    print(f"Обработчиков {args.workers}: {len(users)} пользователей за {elapsed:.2f} с "
+          f"({len(users) * len(SURVEY_SCRIPT) / elapsed:.0f} обновлений в секунду)")
+    print(f"  обработчики остановились штатно: {len(summaries)} из {args.workers}")
+    for index, received, user_count, _ in sorted(summaries):
+        print(f"  обработчик {index}: обновлений {received}, пользователей {user_count}")
+    # Каждого пользователя обслужил ровно один процесс, если сумма по процессам равна числу пользователей
+    # (вместе с пользователем, на котором определялось число сообщений на каждом шаге)
+    print(f"  пользователей, чей диалог обслуживали несколько процессов: {served - len(users) - 1}")
+    print(f"  обновлений, попавших не к своему процессу: {misrouted}")
+    print(f"  пользователей без ответа бота: {lost}")
+    print(f"  анкет сохранено полностью: {completed} из {len(users)}")
+    errors = [line for line in output.splitlines() if ' - ERROR - ' in line or line.startswith('Traceback')]
+    print(f"  ошибок в журнале бота: {len(errors)}")
+    for line in errors[:10]:
+        print(f"    {line}")
+
+
+def bench_cluster(args) -> None:
+    """Несколько процессов-обработчиков за приёмником webhook: диалоги не разделяются, ответы не теряются"""
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(_run_cluster_check(args, tmp))
+
+
+def bench_updates(args) -> None:
+    """Пропускная способность и задержка ответа бота в режимах polling и webhook"""
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # База данных и журнал бота создаются в текущем каталоге
+        os.chdir(tmp)
+        try:
+            asyncio.run(_measure_updates(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+# Результаты нагрузочного теста load по коммитам: одна строка JSON на запуск
+LOAD_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.jsonl')
+
+# Показатели load, сравниваемые с прошлым запуском: (ключ, подпись, больше - лучше)
+LOAD_COMPARED = [
+    ('updates_per_second', 'обновлений в секунду', True),
+    ('p50_ms', 'p50 ответа, мс', False),
+    ('p99_ms', 'p99 ответа, мс', False),
+    ('db_rows_per_second', 'записей в БД в секунду', True),
+    ('rss_growth_mb', 'рост памяти, МБ', False),
+]
+
+
+def _rss_mb() -> float:
+    """Память процесса (RSS), МБ"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    """Наибольшая память процесса (RSS) с его запуска, МБ"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _git_revision() -> Dict[str, Any]:
+    """Коммит, на котором запущен замер, и есть ли в рабочем каталоге незакоммиченные изменения"""
+    import subprocess
+
+    repo = os.path.dirname(LOAD_RESULTS)
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+
+def _total_changes(database: Database) -> int:
+    """Сколько строк изменено в базе с момента подключения"""
+    return database.conn.total_changes
+
+
+async def _measure_load(args, survey_bot) -> Dict[str, float]:
+    """args.users пользователей одновременно проходят опрос по всем ветвям через обработку обновлений бота"""
+    from telegram import Update
+    from metrics import SURVEYS_FINISHED
+
+    api = FakeBotAPI()
+    if not args.telegram_limits:
+        survey_bot.outbound = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    survey_bot.direction_edits.delay = 0
+    application = survey_bot.build_application(request=_in_process_request(api, latency=args.api_latency))
+    await application.initialize()
+    await application.start()
+    survey_name = survey_bot.default_survey.name
+
+    async def process(user_id: int, kind: str, value: str) -> None:
+        update = Update.de_json(make_update(next(_update_ids), user_id, kind, value), application.bot)
+        # Так же, как обновление от Telegram: через обработку параллельных обновлений бота
+        await application.update_processor.process_update(update, application.process_update(update))
+
+    def finished() -> Counter:
+        return Counter({ending: SURVEYS_FINISHED.labels(survey_name, ending, 'yes').value
+                        for _, ending, _ in LOAD_SCRIPTS})
+
+    # Прогрев и проверка путей: каждую ветвь проходит один пользователь
+    before = finished()
+    for user_id, (branch, ending, script) in enumerate(LOAD_SCRIPTS, 1):
+        for kind, value in script:
+            await process(user_id, kind, value)
+    warmup = finished() - before
+    assert warmup == Counter(ending for _, ending, _ in LOAD_SCRIPTS), f"Ветви опроса завершились иначе: {warmup}"
+
+    expected = Counter()
+    for i in range(args.users):
+        expected[LOAD_SCRIPTS[i % len(LOAD_SCRIPTS)][1]] += args.passes
+
+    async def run_round(first_user_id: int) -> Tuple[float, List[List[float]], int, Counter, float]:
+        """Один проход нагрузки новыми пользователями: время, задержки по ветвям, записи в БД, анкеты, рост памяти"""
+        latencies = [[] for _ in LOAD_SCRIPTS]
+
+        async def respondent(user_id: int, branch: int) -> None:
+            for _ in range(args.passes):
+                for kind, value in LOAD_SCRIPTS[branch][2]:
+                    if args.think:
+                        await asyncio.sleep(args.think)
+                    started = time.perf_counter()
+                    await process(user_id, kind, value)
+                    latencies[branch].append(time.perf_counter() - started)
+
+        before = finished()
+        changes = await survey_bot.db._run(_total_changes, survey_bot.db.db)
+        rss = _rss_mb()
+        started = time.perf_counter()
+        await asyncio.gather(*(respondent(first_user_id + i, i % len(LOAD_SCRIPTS)) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        rss_growth = _rss_mb() - rss
+        changes = await survey_bot.db._run(_total_changes, survey_bot.db.db) - changes
+        saved = finished() - before
+        assert saved == expected, f"Сохранено анкет {dict(saved)}, ожидалось {dict(expected)}"
+        return elapsed, latencies, changes, saved, rss_growth
+
+    # Лучший из нескольких проходов: дрейф частоты процессора и фоновые процессы меньше искажают сравнение
+    rounds = [await run_round((index + 1) * 1000000) for index in range(args.rounds)]
+    elapsed, latencies, changes, saved, rss_growth = min(rounds, key=lambda measured: measured[0])
+
+    await application.stop()
+    await application.shutdown()
+
+    total = [latency for branch in latencies for latency in branch]
+    results = {
+        'updates': len(total),
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(total) / elapsed, 1),
+        'surveys_per_second': round(sum(saved.values()) / elapsed, 1),
+        'p50_ms': round(percentile(total, 50) * 1000, 2),
+        'p99_ms': round(percentile(total, 99) * 1000, 2),
+        'max_ms': round(max(total) * 1000, 2),
+        'db_rows_per_second': round(changes / elapsed, 1),
+        'rss_mb': round(_rss_mb(), 1),
+        'rss_growth_mb': round(rss_growth, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+    print(f"{args.users} пользователей по {len(LOAD_SCRIPTS)} ветвям опроса, проходов {args.passes}, "
+          f"задержка Bot API {args.api_latency * 1000:.0f} мс, лучший из {args.rounds} замеров:")
+    print(f"  {results['updates']} обновлений за {elapsed:.2f} с ({results['updates_per_second']:.0f} в секунду), "
+          f"анкет сохранено {sum(saved.values())} ({results['surveys_per_second']:.0f} в секунду)")
+    report("  ответ бота", total)
+    for (branch, _, _), branch_latencies in zip(LOAD_SCRIPTS, latencies):
+        report(f"    {branch}", branch_latencies)
+    print(f"  записей в БД: {changes} ({results['db_rows_per_second']:.0f} в секунду)")
+    print(f"  память: {results['rss_mb']:.1f} МБ (рост за замер {rss_growth:+.1f} МБ, пик {results['peak_rss_mb']:.1f} МБ)")
+    return results
+
+
+def _store_load_result(args, results: Dict[str, float]) -> None:
+    """Сравнение с прошлым запуском с теми же параметрами и запись результата в args.results"""
+    params = {'users': args.users, 'passes': args.passes, 'rounds': args.rounds, 'think': args.think,
+              'api_latency': args.api_latency, 'telegram_limits': args.telegram_limits}
+    entry = {**_git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'params': params, 'results': results}
+
+    previous = None
+    if os.path.exists(args.results):
+        with open(args.results, encoding='utf-8') as results_file:
+            for line in results_file:
+                try:
+                    stored = json.loads(line)
+                except ValueError:
+                    continue
+                if stored.get('params') == params:
+                    previous = stored
+    if previous is not None:
+        dirty = " с изменениями" if previous.get('dirty') else ""
+        print(f"Сравнение с запуском на коммите {previous.get('commit')}{dirty} ({previous.get('time')}):")
+        for key, title, higher_is_better in LOAD_COMPARED:
+            old, new = previous['results'].get(key), results[key]
+            if not old:
+                continue
+            change = (new / old - 1) * 100
+            worse = change < 0 if higher_is_better else change > 0
+            mark = "  <- хуже" if worse and abs(change) >= args.threshold else ""
+            print(f"  {title:<24} {old:>10} -> {new:>10} ({change:+.1f}%){mark}")
+
+    if not args.no_save:
+        with open(args.results, 'a', encoding='utf-8') as results_file:
+            results_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        print(f"Результат записан в {args.results} (коммит {entry['commit']}{' с изменениями' if entry['dirty'] else ''})")
+
+
+async def _run_load(args) -> None:
+    import logging
+    import bot as survey_bot
+
+    # Журнал на каждое обновление исказил бы замеры
+    logging.getLogger().setLevel(logging.WARNING)
+    results = await _measure_load(args, survey_bot)
+    await survey_bot.db.aclose()
+    _store_load_result(args, results)
+
+
+def bench_load(args) -> None:
+    """Пропускная способность бота: одновременные пользователи на всех ветвях опроса"""
+    os.environ.setdefault("BOT_TOKEN", "1:fake")
+    os.environ.setdefault("CHANNEL_USERNAME", "@channel")
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            asyncio.run(_run_load(args))
+        finally:
+            os.chdir(previous_dir)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Замеры производительности бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    async_save = subparsers.add_parser("async-save", help="задержка обработчиков при массовом сохранении")
+    async_save.add_argument("--users", type=int, default=500)
+    async_save.set_defaults(func=bench_async_save)
+
+    group_commit = subparsers.add_parser("group-commit", help="скорость записи пакетами и по одной")
+    group_commit.add_argument("--rows", type=int, default=5000)
+    group_commit.add_argument("--batch-size", type=int, default=100)
+    group_commit.set_defaults(func=bench_group_commit)
+
+    upsert = subparsers.add_parser("upsert", help="стоимость одного сохранения")
+    upsert.add_argument("--saves", type=int, default=20000)
+    upsert.set_defaults(func=bench_upsert)
+
+    stats = subparsers.add_parser("stats", help="время получения статистики")
+    stats.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    stats.set_defaults(func=bench_stats)
+
+    users = subparsers.add_parser("users", help="страница списка участников по курсору")
+    users.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    users.add_argument("--repeats", type=int, default=200, help="повторов чтения страницы")
+    users.add_argument("--check-rows", type=int, default=100000, help="проверять обход страниц до этого числа строк")
+    users.set_defaults(func=bench_users)
+
+    search = subparsers.add_parser("search", help="поиск по учебным заведениям: индекс против просмотра ответов")
+    search.add_argument("--rows", type=int, default=1000000)
+    search.add_argument("--queries", nargs="+", default=["школа 5", "сош 17", "гимназия", "лицей 3", "колледж"])
+    search.add_argument("--deep-offset", type=int, default=20000, help="сколько результатов пропустить до глубокой страницы")
+    search.add_argument("--repeats", type=int, default=200, help="повторов чтения страницы")
+    search.add_argument("--check-rows", type=int, default=20000, help="анкет для проверки результатов")
+    search.add_argument("--saves", type=int, default=5000, help="сохранений для оценки стоимости индекса")
+    search.set_defaults(func=bench_search)
+
+    funnel = subparsers.add_parser("funnel", help="журнал переходов воронки и построение воронки")
+    funnel.add_argument("--events", type=int, default=2000000, help="переходов в журнале к концу замера")
+    funnel.add_argument("--steps", type=int, default=4, help="сколько раз замерить по мере роста журнала")
+    funnel.add_argument("--batch-size", type=int, default=1000, help="переходов в пакете записи")
+    funnel.add_argument("--check-respondents", type=int, default=5000)
+    funnel.add_argument("--repeats", type=int, default=100, help="повторов построения воронки")
+    funnel.add_argument("--skip-scan", action="store_true", help="не считать воронку по всему журналу")
+    funnel.set_defaults(func=bench_funnel)
+
+    waves = subparsers.add_parser("waves", help="статистика и экспорт одной волны при многих волнах, перенос данных")
+    waves.add_argument("--waves", type=int, default=10)
+    waves.add_argument("--respondents", type=int, default=100000, help="анкет в каждой волне")
+    waves.add_argument("--skip-migration", action="store_true", help="не проверять перенос прежней таблицы")
+    waves.set_defaults(func=bench_waves)
+
+    memory = subparsers.add_parser("memory", help="память на одного респондента")
+    memory.add_argument("--respondents", type=int, default=1000000)
+    memory.set_defaults(func=bench_memory)
+
+    export = subparsers.add_parser("export", help="пиковая память при экспорте CSV")
+    export.add_argument("--rows", type=int, default=1000000)
+    export.add_argument("--max-memory-mb", type=float, default=32)
+    export.add_argument("--skip-legacy", action="store_true", help="не запускать прежний экспорт")
+    export.set_defaults(func=bench_export)
+
+    export_formats = subparsers.add_parser("export-formats", help="размер и время экспорта по форматам")
+    export_formats.add_argument("--rows", type=int, default=100000)
+    export_formats.set_defaults(func=bench_export_formats)
+
+    subscription = subparsers.add_parser("subscription", help="кэш проверки подписки на локальном Bot API")
+    subscription.add_argument("--users", type=int, default=500)
+    subscription.add_argument("--checks", type=int, default=5, help="проверок на пользователя")
+    subscription.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    subscription.set_defaults(func=bench_subscription)
+
+    scheduler = subparsers.add_parser("scheduler", help="исходящие сообщения на сервере, отвечающем 429")
+    scheduler.add_argument("--chats", type=int, default=100)
+    scheduler.add_argument("--messages", type=int, default=3, help="сообщений в каждый чат")
+    scheduler.add_argument("--exports", type=int, default=10, help="файлов экспорта администратору")
+    scheduler.set_defaults(func=bench_scheduler)
+
+    load = subparsers.add_parser("load", help="пропускная способность на всех ветвях опроса, результаты по коммитам")
+    load.add_argument("--users", type=int, default=600, help="одновременно проходящих опрос")
+    load.add_argument("--passes", type=int, default=1, help="сколько раз каждый пользователь проходит опрос")
+    load.add_argument("--rounds", type=int, default=3, help="замеров, из которых берётся лучший")
+    load.add_argument("--think", type=float, default=0.0, help="пауза пользователя перед ответом, с")
+    load.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    load.add_argument("--telegram-limits", action="store_true", help="соблюдать лимиты Telegram на отправку")
+    load.add_argument("--results", default=LOAD_RESULTS, help="файл результатов по коммитам")
+    load.add_argument("--threshold", type=float, default=10.0, help="ухудшение, отмечаемое в сравнении, %%")
+    load.add_argument("--no-save", action="store_true", help="не записывать результат")
+    load.set_defaults(func=bench_load)
+
+    updates = subparsers.add_parser("updates", help="нагрузочный тест обработки обновлений: polling и webhook")
+    updates.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    updates.add_argument("--users", type=int, default=200, help="одновременно проходящих опрос")
+    updates.add_argument("--think", type=float, default=0.0, help="пауза пользователя перед ответом, с")
+    updates.add_argument("--telegram-limits", action="store_true", help="соблюдать лимиты Telegram на отправку")
+    updates.set_defaults(func=bench_updates)
+
+    persistence = subparsers.add_parser("persistence", help="перезапуск посреди опроса и стоимость сохранения состояний")
+    persistence.add_argument("--users", type=int, default=200)
+    persistence.set_defaults(func=bench_persistence)
+
+    handlers = subparsers.add_parser("handlers", help="процессорное время обработки обновления по шагам опроса")
+    handlers.add_argument("--users", type=int, default=200)
+    handlers.add_argument("--iterations", type=int, default=100000, help="построений клавиатуры направлений")
+    handlers.set_defaults(func=bench_handlers)
+
+    metrics = subparsers.add_parser("metrics", help="накладные расходы на показатели и страница /metrics")
+    metrics.add_argument("--users", type=int, default=200)
+    metrics.add_argument("--rounds", type=int, default=3, help="проходов в каждом режиме")
+    metrics.set_defaults(func=bench_metrics)
+
+    taps = subparsers.add_parser("taps", help="запросы к Bot API при быстрых нажатиях на кнопки направлений")
+    taps.add_argument("--users", type=int, default=100)
+    taps.add_argument("--taps", type=int, default=8, help="нажатий каждого пользователя")
+    taps.add_argument("--interval", type=float, default=0.05, help="пауза между нажатиями, с")
+    taps.add_argument("--delay", type=float, default=0.3, help="окно объединения правок, с")
+    taps.set_defaults(func=bench_taps)
+
+    logs = subparsers.add_parser("logging", help="задержка ответа при журнале на медленном диске")
+    logs.add_argument("--users", type=int, default=50, help="одновременно проходящих опрос")
+    logs.add_argument("--disk-delay", type=float, default=0.005, help="задержка записи одной строки журнала, с")
+    logs.set_defaults(func=bench_logging)
+
+    cluster = subparsers.add_parser("cluster", help="опрос через приёмник webhook и несколько процессов бота")
+    cluster.add_argument("--workers", type=int, default=4)
+    cluster.add_argument("--users", type=int, default=200, help="одновременно проходящих опрос")
+    cluster.set_defaults(func=bench_cluster)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
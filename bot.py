@@ -1,8 +1,10 @@
 import os
+import asyncio
 import logging
+import secrets
 import signal
 import sys
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Poll
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, Poll
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler, filters, PollHandler
 
 try:
@@ -12,16 +14,38 @@ except ImportError:
     print("python-dotenv не установлен. Переменные окружения должны быть заданы в системе.")
 
 # Импортируем класс базы данных
-from database import Database
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
+from database import AsyncDatabase
+from sessions import SessionStore
+from subscriptions import SubscriptionCache
+from ratelimit import OutboundScheduler, PRIORITY_BULK
+from updates import PerUserUpdateProcessor
+from edits import EditCoalescer
+from funnel import FUNNEL_CANCELLED, FUNNEL_FINISHED, FunnelLog
+from logs import log_state, setup_logging
+from persistence import SQLitePersistence
+from cluster import run_cluster, run_worker, shard_for
+from metrics import QUESTIONS_ASKED, REGISTRY, SURVEYS_FINISHED, MetricsServer, instrument_handler
+from survey import SURVEYS, directions
+from keyboards import REMOVE_KEYBOARD, subscription_keyboard
+from survey_engine import FIRST_STATE, SURVEY_STATES, CompiledSurvey, Ending, Question
+from export import EXPORT_FORMATS, TELEGRAM_UPLOAD_LIMIT, iter_parts
+
+# Настройка логирования: запись в файл и на консоль выполняет отдельный поток.
+# Файл журнала ротируется по размеру LOG_MAX_BYTES или по времени LOG_ROTATE_WHEN
+# (например, midnight); LOG_FORMAT=json - одна запись JSON на строку.
+# Процесс-обработчик номер i пишет в свой файл (bot.worker<i>.log): несколько процессов
+# не могут ротировать один файл.
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+if os.getenv("WORKER_INDEX"):
+    log_name, log_extension = os.path.splitext(LOG_FILE)
+    LOG_FILE = f"{log_name}.worker{os.getenv('WORKER_INDEX')}{log_extension}"
+setup_logging(
+    LOG_FILE,
+    level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
+    json_format=os.getenv("LOG_FORMAT", "text").lower() == "json",
+    max_bytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+    backup_count=int(os.getenv("LOG_BACKUP_COUNT", 5)),
+    rotate_when=os.getenv("LOG_ROTATE_WHEN") or None
 )
 
 logger = logging.getLogger(__name__)
@@ -38,8 +62,11 @@ else:
     CHANNEL_USERNAME = "young_astra"
     CHANNEL_ID = "@" + CHANNEL_USERNAME
 
-# Состояния для ConversationHandler
-CHECKING_SUBSCRIPTION, MUNICIPALITY, CATEGORY, EDUCATION_ORG, KNOWS_MOVEMENT, IS_PARTICIPANT, KNOWS_CURATOR, DIRECTIONS, REGION_RATING, ORGANIZATION_RATING, KNOWS_KOSA, STUDENT_GOVERNMENT_RATING = range(12)
+# Кнопки подписки на канал
+SUBSCRIPTION_KEYBOARD = subscription_keyboard(CHANNEL_USERNAME)
+
+# Состояние ConversationHandler проверки подписки; состояния вопросов задают описания опросов
+CHECKING_SUBSCRIPTION = 0
 
 # Список администраторов (ID пользователей Telegram)
 ADMIN_IDS = os.getenv("ADMIN_IDS", "").split(",")
@@ -51,45 +78,81 @@ except ValueError:
 
 print(f"ID администраторов: {ADMIN_IDS}")
 
-# Данные для опроса
-municipalities = [
-    "Ахтубинский район", "Володарский район", "Город Астрахань", "Енотаевский район",
-    "ЗАТО Знаменск", "Икрянинский район", "Камызякский район", "Красноярский округ",
-    "Лиманский район", "Наримановский район", "Приволжский район", "Харабалинский район",
-    "Черноярский округ"
-]
+# Режим webhook включается, если задан публичный адрес бота WEBHOOK_URL (например, https://example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
-categories = ["Ученик", "Студент ССУЗа", "Студент ВУЗа"]
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя - по очереди)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
 
-directions = [
-    "Волонтерство и добровольчество", "Труд, профессия и свое дело", "Спорт",
-    "Образование и знания", "Культура и искусство", "Наука и технологии",
-    "Патриотизм и историческая память", "Медиа и коммуникации", "Здоровый образ жизни",
-    "Экология и охрана природы", "Дипломатия и международные отношения", "Туризм и путешествия"
-]
+# Сколько процессов обрабатывают обновления; больше одного - только в режиме webhook:
+# главный процесс принимает обновления и распределяет их между процессами по user_id
+WORKERS = int(os.getenv("WORKERS", 1))
+# Номер процесса-обработчика (задаётся главным процессом при запуске обработчиков)
+WORKER_INDEX = int(os.getenv("WORKER_INDEX")) if os.getenv("WORKER_INDEX") else None
+# Обработчик номер i принимает обновления на локальном порту WORKER_BASE_PORT + i
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", WEBHOOK_PORT + 1))
 
-# Инициализация базы данных
-db = Database()
+# Сколько сообщений в секунду бот может отправить (лимит Telegram); делится между процессами
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
 
-# Временное хранение ответов пользователей (будет синхронизироваться с БД)
-user_responses = {}
+# Адрес Bot API, если используется не api.telegram.org (например, локальный сервер Bot API)
+BOT_API_URL = os.getenv("BOT_API_URL")
 
-# Функция для загрузки данных из БД в память
-def load_data_from_db():
-    global user_responses
-    try:
-        results = db.get_all_results()
-        for result in results:
-            user_id = result['user_id']
-            del result['user_id']  # Удаляем, так как это ключ
-            del result['timestamp']  # Удаляем, так как это не нужно в памяти
-            user_responses[user_id] = result
-        logger.info(f"Загружено {len(results)} записей из базы данных")
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке данных из базы данных: {e}")
+# Порт страницы показателей /metrics (не задан - страница не запускается); процесс-обработчик
+# номер i отдаёт свои показатели на порту METRICS_PORT + 1 + i
+METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# Инициализация базы данных (запросы выполняются в отдельном потоке)
+db = AsyncDatabase()
+
+# Опросы, скомпилированные из описаний в таблицы переходов; первый - опрос по умолчанию
+surveys = [CompiledSurvey(definition, FIRST_STATE + index * SURVEY_STATES) for index, definition in enumerate(SURVEYS)]
+for compiled in surveys:
+    compiled.id = db.survey_id(compiled.name, compiled.wave)
+default_survey = surveys[0]
+surveys_by_name = {compiled.name: compiled for compiled in surveys}
+# Префикс callback_data -> (опрос, вопрос с выбором нескольких вариантов)
+selection_callbacks = {
+    prefix: (compiled, question) for compiled in surveys for prefix, question in compiled.callbacks.items()
+}
+# Состояние вопроса -> счётчик того, сколько раз он задан (воронка опроса в показателях)
+asked_counters = {
+    question.state: QUESTIONS_ASKED.labels(compiled.name, question.id)
+    for compiled in surveys for question in compiled.by_id.values()
+}
+# Состояние вопроса -> опрос, к которому он относится
+state_surveys = {state: compiled for compiled in surveys for state in compiled.states}
+
+# Ответы пользователей, проходящих опрос (завершённые анкеты хранятся только в БД)
+sessions = SessionStore(db)
+
+# Состояния диалогов и незавершённые анкеты сохраняются в БД, чтобы пережить перезапуск бота;
+# процесс-обработчик загружает только диалоги своих пользователей
+persistence = SQLitePersistence(
+    db, sessions,
+    owns_user=(lambda user_id: shard_for(user_id, WORKERS) == WORKER_INDEX) if WORKER_INDEX is not None else None
+)
+
+# Кэш статуса подписки на канал (время хранения в секундах)
+subscription_cache = SubscriptionCache(
+    CHANNEL_ID,
+    positive_ttl=float(os.getenv("SUBSCRIPTION_CACHE_TTL", 10 * 60)),
+    negative_ttl=float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", 30))
+)
+
+# Правки клавиатуры направлений при быстрых нажатиях объединяются в одну (задержка в секундах)
+direction_edits = EditCoalescer(delay=float(os.getenv("DIRECTION_EDIT_DELAY", 0.3)))
+
+# Планировщик исходящих сообщений: соблюдает лимиты Telegram и повторяет запросы после ошибки 429
+outbound = OutboundScheduler(global_rate=TELEGRAM_GLOBAL_RATE / WORKERS)
 
-# Загружаем данные при запуске
-load_data_from_db()
+# Журнал переходов между вопросами для воронки опроса (записывается в БД пакетами)
+funnel = FunnelLog(db)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -97,10 +160,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     user_id = user.id
     
-    # Создаем словарь для хранения ответов пользователя если его еще нет
-    user_responses[user_id] = {
-            'selected_directions': []
-        }
+    # Начинаем новую анкету пользователя; опрос, кроме первого, выбирается
+    # параметром ссылки t.me/<бот>?start=<имя опроса>
+    answers = sessions.start(user_id)
+    if context.args and context.args[0] in surveys_by_name:
+        answers.survey = context.args[0]
+    # Начало опроса - проверка подписки
+    funnel.record(user_id, surveys_by_name.get(answers.survey, default_survey).id, CHECKING_SUBSCRIPTION)
     
     await update.message.reply_text(
         f"Привет, {user.first_name}! Мы рады приветствовать тебя в главном молодежном чат-боте региона. "
@@ -117,50 +183,35 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     try:
-        # Проверяем статус пользователя в канале
-        chat_member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        status = chat_member.status
-        
-        # Проверяем, является ли пользователь участником канала
-        if status in ['member', 'administrator', 'creator']:
+        # Проверяем, является ли пользователь участником канала (статус берётся из кэша)
+        if await subscription_cache.is_subscribed(context.bot, user_id):
             await update.message.reply_text(
                 f"Спасибо, что подписаны на наш канал {CHANNEL_ID}!"
             )
             # Пользователь подписан, переходим к опросу
-            return await ask_municipality(update, context)
+            return await ask_question(update, context, (await current_survey(user_id)).first)
         else:
             # Если пользователь не подписан, отправляем сообщение с кнопкой для подписки
-            keyboard = [
-                [InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")],
-                [InlineKeyboardButton("Я подписан", callback_data="check_subscription")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await update.message.reply_text(
                 f"❌ Для участия в опросе необходимо подписаться на канал {CHANNEL_ID}.\n"
                 f"Пожалуйста, подпишитесь и нажмите кнопку 'Я подписан'.",
-                reply_markup=reply_markup
+                reply_markup=SUBSCRIPTION_KEYBOARD
             )
             return CHECKING_SUBSCRIPTION
     except Exception as e:
         logging.error(f"Ошибка при проверке подписки: {e}")
         
         # В случае ошибки тоже требуем подписаться и Я подписан
-        keyboard = [
-            [InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")],
-            [InlineKeyboardButton("Я подписан", callback_data="check_subscription")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             f"❌ Произошла ошибка при проверке подписки на канал {CHANNEL_ID}.\n"
             f"Пожалуйста, подпишитесь на канал и нажмите кнопку 'Я подписан'.",
-            reply_markup=reply_markup
+            reply_markup=SUBSCRIPTION_KEYBOARD
         )
         return CHECKING_SUBSCRIPTION
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик нажатия на кнопки"""
+    log_state.set(CHECKING_SUBSCRIPTION)
     query = update.callback_query
     await query.answer()
     
@@ -168,494 +219,235 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         user_id = update.effective_user.id
         
         try:
-            # Проверяем статус пользователя в канале
-            chat_member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            status = chat_member.status
+            # Пользователь говорит, что подписался - сохранённый статус больше не актуален
+            subscription_cache.invalidate(user_id)
             
-            if status in ['member', 'administrator', 'creator']:
+            if await subscription_cache.is_subscribed(context.bot, user_id):
                 await query.edit_message_text(
                     f"✅ Отлично! Вы подписаны на канал {CHANNEL_ID}. Теперь можно перейти к опросу."
                 )
 
                 # Переходим к первому вопросу опроса
-                return await ask_municipality_after_callback(update, context)
+                return await ask_question(update, context, (await current_survey(user_id)).first)
             else:
                 # Пользователь ещё не подписан
-                keyboard = [
-                    [InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")],
-                    [InlineKeyboardButton("Я подписан", callback_data="check_subscription")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
                 await query.edit_message_text(
                     f"❌ Вы всё ещё не подписаны на канал {CHANNEL_ID}.\n"
                     f"Пожалуйста, подпишитесь на канал и проверьте подписку снова.",
-                    reply_markup=reply_markup
+                    reply_markup=SUBSCRIPTION_KEYBOARD
                 )
                 return CHECKING_SUBSCRIPTION
         except Exception as e:
             logging.error(f"Ошибка при проверке подписки: {e}")
             
             # В случае ошибки тоже требуем подписаться и проверить
-            keyboard = [
-                [InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")],
-                [InlineKeyboardButton("Я подписан", callback_data="check_subscription")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await query.edit_message_text(
                 f"❌ Произошла ошибка при проверке подписки на канал {CHANNEL_ID}.\n"
                 f"Пожалуйста, убедитесь что вы подписаны и нажмите кнопку 'Я подписан' снова.",
-                reply_markup=reply_markup
+                reply_markup=SUBSCRIPTION_KEYBOARD
             )
             return CHECKING_SUBSCRIPTION
             
-    # Обработка выбора направлений
-    elif query.data.startswith("direction_"):
-        return await handle_direction_selection(update, context)
+    # Нажатие на вариант вопроса с выбором нескольких вариантов
+    elif query.data.rpartition("_")[0] in selection_callbacks:
+        return await handle_selection(update, context, *selection_callbacks[query.data.rpartition("_")[0]])
 
-async def ask_municipality_after_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Специальная функция для перехода к вопросу о муниципалитете после callback query"""
-    # Создаем и отправляем новое сообщение с вопросом о муниципалитете
-    user_id = update.effective_user.id
-    await context.bot.send_message(
-        chat_id=user_id,
-        text="Опрос для обучающихся и студентов Астраханской области\n\nУкажите Ваше муниципальное образование:",
-        reply_markup=ReplyKeyboardMarkup(
-            [[municipality] for municipality in municipalities],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
-    )
-    return MUNICIPALITY
+async def current_survey(user_id: int) -> CompiledSurvey:
+    """Опрос, который проходит пользователь"""
+    answers = await sessions.get(user_id)
+    return surveys_by_name.get(answers.survey, default_survey)
 
-async def ask_municipality(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Запрашивает муниципальное образование пользователя"""
-    await update.message.reply_text(
-        "Опрос для обучающихся и студентов Астраханской области\n\nУкажите Ваше муниципальное образование:",
-        reply_markup=ReplyKeyboardMarkup(
-            [[municipality] for municipality in municipalities],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
-    )
-    return MUNICIPALITY
-
-async def handle_municipality(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает выбор муниципального образования"""
-    user_id = update.effective_user.id
-    municipality = update.message.text
-    
-    if municipality in municipalities:
-        user_responses[user_id]['municipality'] = municipality
-        
-        # Задаем следующий вопрос - категория
-        await update.message.reply_text(
-            "Выберите категорию, к которой вы относитесь:",
-            reply_markup=ReplyKeyboardMarkup(
-                [[category] for category in categories],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return CATEGORY
-    else:
-        await update.message.reply_text(
-            "Пожалуйста, выберите один из предложенных вариантов:",
-            reply_markup=ReplyKeyboardMarkup(
-                [[municipality] for municipality in municipalities],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return MUNICIPALITY
-
-async def handle_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает выбор категории"""
-    user_id = update.effective_user.id
-    category = update.message.text
-    
-    if category in categories:
-        user_responses[user_id]['category'] = category
-        
-        # Для студентов ВУЗа задаем вопрос о Молодежном центре "Коса"
-        if category == "Студент ВУЗа":
-            await update.message.reply_text(
-                "Знаете ли вы о работе Молодежного центра \"Коса\"? @dmpp30",
-                reply_markup=ReplyKeyboardMarkup(
-                    [["Да"], ["Нет"]],
-                    one_time_keyboard=True,
-                    resize_keyboard=True
-                )
-            )
-            return KNOWS_KOSA
-        
-        # Для остальных категорий запрашиваем название образовательной организации
-        await update.message.reply_text(
-            "Введите название Вашей образовательной организации:",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        return EDUCATION_ORG
-    else:
-        await update.message.reply_text(
-            "Пожалуйста, выберите один из предложенных вариантов:",
-            reply_markup=ReplyKeyboardMarkup(
-                [[category] for category in categories],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return CATEGORY
+async def ask_question(update: Update, context: ContextTypes.DEFAULT_TYPE, question: Question) -> int:
+    """Задаёт вопрос опроса и возвращает его состояние"""
+    reply_markup = question.keyboard
+    if question.kind == 'multi':
+        # Клавиатура с отметками уже выбранных вариантов
+        answers = await sessions.get(update.effective_user.id)
+        reply_markup = question.keyboard.markup(getattr(answers, question.mask_attribute))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=question.text, reply_markup=reply_markup)
+    asked_counters[question.state].inc()
+    funnel.record(update.effective_user.id, state_surveys[question.state].id, question.state)
+    return question.state
 
-async def handle_education_org(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает ввод названия образовательной организации"""
-    user_id = update.effective_user.id
-    education_org = update.message.text
-    
-    # Сохраняем название образовательной организации
-    user_responses[user_id]['education_org'] = education_org
-    
-    category = user_responses[user_id]['category']
-    
-    # Для студентов ВУЗа задаем дополнительный вопрос об оценке студенческого самоуправления
-    if category == "Студент ВУЗа":
-        await update.message.reply_text(
-            "Оцените деятельность работы студенческого самоуправления Вашего учебного заведения\n"
-            "Оцените по шкале от 1 до 5, где 5 - \"отлично\", а 1 - \"плохо\"",
-            reply_markup=ReplyKeyboardMarkup(
-                [["5", "4", "3", "2", "1"][::-1]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return STUDENT_GOVERNMENT_RATING
-    
-    # Для остальных категорий задаем вопрос о знании Движения Первых
-    await update.message.reply_text(
-        "Знаете ли Вы о проектах Общероссийского общественно-государственного движения детей и молодежи \"Движение первых\"? @mypervie30",
-        reply_markup=ReplyKeyboardMarkup(
-            [["Да"], ["Нет"]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
-    )
-    return KNOWS_MOVEMENT
+async def next_step(update: Update, context: ContextTypes.DEFAULT_TYPE, survey: CompiledSurvey, step, answers) -> int:
+    """Переход к следующему вопросу или завершение опроса"""
+    if isinstance(step, Ending):
+        return await finish_survey(update, context, survey, step, answers)
+    return await ask_question(update, context, step)
 
-async def handle_knows_movement(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает ответ на вопрос о знании Движения Первых"""
+async def finish_survey(update: Update, context: ContextTypes.DEFAULT_TYPE, survey: CompiledSurvey,
+                        ending: Ending, answers) -> int:
+    """Сохраняет анкету и отправляет сообщения завершения опроса"""
     user_id = update.effective_user.id
-    knows_movement = update.message.text
+    chat_id = update.effective_chat.id
     
-    user_responses[user_id]['knows_movement'] = knows_movement
+    # Сохраняем результаты в базу данных
+    save_result = await db.save_survey_result(user_id, answers.to_dict(), survey.id)
+    SURVEYS_FINISHED.labels(survey.name, ending.name, 'yes' if save_result else 'no').inc()
+    funnel.record(user_id, survey.id, FUNNEL_FINISHED)
     
-    if knows_movement == "Да":
-        # Если знает, продолжаем опрос
-        await update.message.reply_text(
-            "Являетесь ли Вы участником Движения Первых?",
-            reply_markup=ReplyKeyboardMarkup(
-                [["Да"], ["Нет"]],
-                one_time_keyboard=True,
-                resize_keyboard=True
+    if save_result:
+        for text, remove_keyboard in survey.render_ending(ending, answers):
+            await context.bot.send_message(
+                chat_id=chat_id, text=text, reply_markup=REMOVE_KEYBOARD if remove_keyboard else None
             )
-        )
-        return IS_PARTICIPANT
     else:
-        # Если не знает, завершаем опрос
-        # Сохраняем результаты в базу данных
-        save_result = db.save_survey_result(user_id, user_responses[user_id])
-        
-        if save_result:
-            # Благодарим за прохождение опроса
-            await update.message.reply_text(
-                "Спасибо за участие в опросе! Ваши ответы записаны.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            
-            # Отправляем напоминание о боте "ТРЕВОГА АСТРАХАНЬ"
-            await update.message.reply_text(
-                "Также напоминаем о боте \"ТРЕВОГА АСТРАХАНЬ\" @trevoga30_bot в который приходит вся проверенная информация о БПЛА и других ЧП региона. "
-                "Думайте. Подпишись, чтобы быть в курсе."
-            )
-        else:
-            # Сообщаем о проблеме с сохранением данных
-            await update.message.reply_text(
-                "К сожалению, произошла ошибка при сохранении ваших ответов. Пожалуйста, попробуйте пройти опрос позже.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            # Логируем ошибку
-            logger.error(f"Не удалось сохранить результаты опроса для пользователя {user_id}")
-        
-        return ConversationHandler.END
-
-async def handle_is_participant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает ответ на вопрос об участии в Движении Первых"""
-    user_id = update.effective_user.id
-    is_participant = update.message.text
+        # Сообщаем о проблеме с сохранением данных
+        await context.bot.send_message(chat_id=chat_id, text=survey.save_error, reply_markup=REMOVE_KEYBOARD)
+        # Логируем ошибку
+        logger.error(f"Не удалось сохранить результаты опроса для пользователя {user_id}")
     
-    user_responses[user_id]['is_participant'] = is_participant
+    # Анкета завершена, освобождаем память
+    sessions.finish(user_id)
     
-    # Если не является участником, завершаем опрос
-    if is_participant == "Нет":
-        # Сохраняем результаты в базу данных
-        save_result = db.save_survey_result(user_id, user_responses[user_id])
-        
-        if save_result:
-            # Благодарим за прохождение опроса
-            await update.message.reply_text(
-                "Спасибо за участие в опросе! Ваши ответы успешно записаны.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            
-            # Отправляем напоминание о боте "ТРЕВОГА АСТРАХАНЬ"
-            await update.message.reply_text(
-                "Будь с нами!\n\n"
-                "Также напоминаем о боте \"ТРЕВОГА АСТРАХАНЬ\" @trevoga30_bot в который приходит вся проверенная информация о БПЛА и других ЧП региона. "
-                "Думайте. Подпишись, чтобы быть в курсе."
-            )
-        else:
-            # Сообщаем о проблеме с сохранением данных
-            await update.message.reply_text(
-                "К сожалению, произошла ошибка при сохранении ваших ответов. Пожалуйста, попробуйте пройти опрос позже.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            # Логируем ошибку
-            logger.error(f"Не удалось сохранить результаты опроса для пользователя {user_id}")
-        
-        return ConversationHandler.END
-    
-    # Если является участником, задаем вопрос о знании куратора
-    await update.message.reply_text(
-        "Знаете ли Вы куратора первичного отделения Движения Первых в Вашей образовательной организации?",
-        reply_markup=ReplyKeyboardMarkup(
-            [["Да"], ["Нет"]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
-    )
-    return KNOWS_CURATOR
+    return ConversationHandler.END
 
-async def handle_knows_curator(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает ответ на вопрос о знании куратора"""
-    user_id = update.effective_user.id
-    knows_curator = update.message.text
+async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, survey: CompiledSurvey,
+                        question: Question) -> int:
+    """Обрабатывает текстовый ответ на вопрос: проверка, сохранение и переход к следующему шагу"""
+    answer = update.message.text
     
-    user_responses[user_id]['knows_curator'] = knows_curator
+    if not question.is_valid(answer):
+        await update.message.reply_text(question.invalid, reply_markup=question.keyboard)
+        return question.state
     
-    # Получаем список направлений и создаем клавиатуру
-    keyboard = []
-    for i, direction in enumerate(directions):
-        keyboard.append([InlineKeyboardButton(
-            f"{direction}", callback_data=f"direction_{i}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton("Завершить выбор", callback_data="direction_done")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "Укажите 3 направления Движения Первых, в проектах которых Вы принимаете активное участие:\n"
-        "(Выберите до 3 направлений, затем нажмите 'Завершить выбор')",
-        reply_markup=reply_markup
-    )
-    return DIRECTIONS
+    answers = await sessions.get(update.effective_user.id)
+    answers[question.id] = answer
+    return await next_step(update, context, survey, question.next_step(answers), answers)
 
-async def handle_direction_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает выбор направлений"""
+async def handle_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, survey: CompiledSurvey,
+                           question: Question) -> int:
+    """Обрабатывает нажатие на вариант вопроса с выбором нескольких вариантов"""
     query = update.callback_query
-    user_id = query.from_user.id
+    texts = question.texts
+    answers = await sessions.get(query.from_user.id)
+    mask = getattr(answers, question.mask_attribute)
+    choice = query.data[len(question.callback_prefix) + 1:]
     
-    if query.data == "direction_done":
+    if choice == "done":
         # Пользователь завершил выбор, переходим к следующему вопросу
-        selected = user_responses[user_id]['selected_directions']
+        if not mask:
+            await query.answer(texts['empty'])
+            return question.state
         
-        if len(selected) > 0:
-            selected_texts = [directions[idx] for idx in selected]
-            selected_text = "\n• ".join(selected_texts)
-            
-            await query.edit_message_text(
-                f"Вы выбрали следующие направления:\n• {selected_text}"
-            )
-            
-            # Задаем вопрос об оценке уровня развития
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="Оцените уровень развития Движения Первых на территории Вашего муниципального образования\n"
-                     "Оцените по шкале от 1 до 5, где 5 - \"отлично\", а 1 - \"плохо\"",
-                reply_markup=ReplyKeyboardMarkup(
-                    [["5", "4", "3", "2", "1"][::-1]],
-                    one_time_keyboard=True,
-                    resize_keyboard=True
-                )
-            )
-            return REGION_RATING
-        else:
-            await query.answer("Пожалуйста, выберите хотя бы одно направление")
-            return DIRECTIONS
-            
-    else:
-        # Пользователь выбирает направление
-        direction_idx = int(query.data.split("_")[1])
-        
-        if 'selected_directions' not in user_responses[user_id]:
-            user_responses[user_id]['selected_directions'] = []
-            
-        selected = user_responses[user_id]['selected_directions']
-        
-        if direction_idx in selected:
-            # Если направление уже выбрано, удаляем его
-            selected.remove(direction_idx)
-            await query.answer(f"Вы отменили выбор: {directions[direction_idx]}")
-        else:
-            # Если направление не выбрано и выбрано меньше 3, добавляем
-            if len(selected) < 3:
-                selected.append(direction_idx)
-                await query.answer(f"Вы выбрали: {directions[direction_idx]}")
-            else:
-                await query.answer("Вы уже выбрали 3 направления. Отмените одно из них или завершите выбор.")
-        
-        # Обновляем клавиатуру
-        keyboard = []
-        for i, direction in enumerate(directions):
-            text = direction
-            if i in selected:
-                text = f"✅ {direction}"
-            keyboard.append([InlineKeyboardButton(text, callback_data=f"direction_{i}")])
-        
-        keyboard.append([InlineKeyboardButton("Завершить выбор", callback_data="direction_done")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"Укажите 3 направления Движения Первых, в проектах которых Вы принимаете активное участие:\n"
-            f"(Выбрано: {len(selected)}/3)",
-            reply_markup=reply_markup
-        )
-        return DIRECTIONS
-
-async def handle_region_rating(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает оценку уровня развития в регионе"""
-    user_id = update.effective_user.id
-    rating = update.message.text
+        selected = "\n• ".join(option for idx, option in enumerate(question.options) if mask >> idx & 1)
+        # Запоздавшая правка клавиатуры не должна вернуть её после завершения выбора
+        await direction_edits.discard(query.message)
+        await query.edit_message_text(texts['done'].format(selected=selected))
+        return await next_step(update, context, survey, question.next_step(answers), answers)
     
-    if rating in ["1", "2", "3", "4", "5"]:
-        user_responses[user_id]['region_rating'] = rating
-        
-        # Задаем последний вопрос об оценке уровня организации
-        await update.message.reply_text(
-            "Оцените уровень организации и проведения мероприятий Движения Первых в Вашей образовательной организации\n"
-            "Оцените по шкале от 1 до 5, где 5 - \"отлично\", а 1 - \"плохо\"",
-            reply_markup=ReplyKeyboardMarkup(
-                [["5", "4", "3", "2", "1"][::-1]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return ORGANIZATION_RATING
+    try:
+        idx = int(choice)
+        option = question.options[idx]
+    except (ValueError, IndexError):
+        await query.answer()
+        return question.state
+    
+    bit = 1 << idx
+    if mask & bit:
+        # Если вариант уже выбран, отменяем выбор
+        mask &= ~bit
+        await query.answer(texts['removed'].format(option=option))
+    elif mask.bit_count() < question.max_selected:
+        mask |= bit
+        await query.answer(texts['added'].format(option=option))
     else:
-        await update.message.reply_text(
-            "Пожалуйста, выберите оценку от 1 до 5:",
-            reply_markup=ReplyKeyboardMarkup(
-                [["5", "4", "3", "2", "1"][::-1]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return REGION_RATING
+        await query.answer(texts['limit'])
+    setattr(answers, question.mask_attribute, mask)
+    
+    # Обновляем клавиатуру: на нажатие уже ответили, правка сообщения отправится
+    # одна на серию быстрых нажатий и только если клавиатура изменилась
+    direction_edits.edit(
+        query.message,
+        texts['progress'].format(count=mask.bit_count(), max=question.max_selected),
+        reply_markup=question.keyboard.markup(mask)
+    )
+    return question.state
 
-async def handle_organization_rating(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает оценку уровня организации мероприятий"""
-    user_id = update.effective_user.id
-    rating = update.message.text
+def answer_handler(survey: CompiledSurvey, question: Question):
+    """Обработчик ответов на вопрос question опроса survey для ConversationHandler"""
+    if question.kind == 'multi':
+        async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+            log_state.set(question.state)
+            return await handle_selection(update, context, survey, question)
+        return CallbackQueryHandler(handle, pattern=f"^{question.callback_prefix}_")
     
-    if rating in ["1", "2", "3", "4", "5"]:
-        user_responses[user_id]['organization_rating'] = rating
-        
-        # Сохраняем результаты в базу данных
-        save_result = db.save_survey_result(user_id, user_responses[user_id])
-        
-        if save_result:
-            # Выводим результаты опроса
-            response = user_responses[user_id]
-            selected_directions = [directions[idx] for idx in response.get('selected_directions', [])]
-            
-            summary = (
-                f"📋 Ваши ответы:\n\n"
-                f"🏙️ Муниципальное образование: {response.get('municipality', 'Не указано')}\n"
-                f"👤 Категория: {response.get('category', 'Не указано')}\n"
-                f"🏫 Образовательная организация: {response.get('education_org', 'Не указано')}\n"
-            )
-            
-            if response.get('category') == "Студент ВУЗа":
-                summary += (
-                    f"📊 Оценка студенческого самоуправления: {response.get('student_government_rating', 'Не указано')}/5\n"
-                    f"🚩 Знание о Молодежном центре \"Коса\": {response.get('knows_kosa', 'Не указано')}\n\n\n"
-                )
-            else:
-                summary += f"🚩 Знание о Движении Первых: {response.get('knows_movement', 'Не указано')}\n"
-                
-                if response.get('knows_movement') == "Да":
-                    summary += (
-                        f"🧑‍🤝‍🧑 Участие в Движении: {response.get('is_participant', 'Не указано')}\n"
-                        f"👨‍🏫 Знание куратора: {response.get('knows_curator', 'Не указано')}\n"
-                        f"🧭 Выбранные направления: {', '.join(selected_directions)}\n"
-                        f"⭐ Оценка в муниципалитете: {response.get('region_rating', 'Не указано')}/5\n"
-                        f"🏫 Оценка в организации: {response.get('organization_rating', 'Не указано')}/5\n\n\n"
-                    )
-            
-            await update.message.reply_text(summary + 
-                f"Будь с нами!\n\n" 
-                f"Также напоминаем о боте \"ТРЕВОГА АСТРАХАНЬ\" @trevoga30_bot в который приходит вся проверенная информация о БПЛА и других ЧП региона. "
-                f"Думайте. Подпишись, чтобы быть в курсе."
-            )
-        else:
-            # Сообщаем о проблеме с сохранением данных
-            await update.message.reply_text(
-                "К сожалению, произошла ошибка при сохранении ваших ответов. Пожалуйста, попробуйте пройти опрос позже.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            # Логируем ошибку
-            logger.error(f"Не удалось сохранить результаты опроса для пользователя {user_id}")
-        
-        return ConversationHandler.END
-    else:
-        await update.message.reply_text(
-            "Пожалуйста, выберите оценку от 1 до 5:",
-            reply_markup=ReplyKeyboardMarkup(
-                [["5", "4", "3", "2", "1"][::-1]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return ORGANIZATION_RATING
+    async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        log_state.set(question.state)
+        return await handle_answer(update, context, survey, question)
+    return MessageHandler(filters.TEXT & ~filters.COMMAND, handle)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет опрос по команде /cancel"""
     user = update.effective_user
+    sessions.finish(user.id)
+    funnel.record(user.id, None, FUNNEL_CANCELLED)
     await update.message.reply_text(
         f"Опрос отменен. Вы можете начать заново, отправив команду /start.",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KEYBOARD
     )
     return ConversationHandler.END
 
+def admin_survey(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """Опрос, с которым работает администратор (по умолчанию - первый из SURVEYS)"""
+    return context.user_data.get('survey') or {
+        'id': default_survey.id, 'name': default_survey.name, 'wave': default_survey.wave
+    }
+
+def admin_keyboard(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+    """Клавиатура панели администратора"""
+    selected = admin_survey(context)
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"📋 Опрос: {selected['name']}, волна {selected['wave']}", callback_data="admin_surveys")],
+        [InlineKeyboardButton("Общая статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton("Список всех участников", callback_data="admin_users")],
+        [InlineKeyboardButton("🔍 Поиск по образовательной организации", callback_data="admin_search")],
+        [InlineKeyboardButton("📉 Воронка", callback_data="admin_funnel")],
+        [InlineKeyboardButton("Экспорт результатов", callback_data="admin_export")]
+    ])
+
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /admin - проверяет права администратора"""
     user_id = update.effective_user.id
     
     if str(user_id) in ADMIN_IDS or user_id in ADMIN_IDS:
-        keyboard = [
-            [InlineKeyboardButton("Общая статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("Список всех участников", callback_data="admin_users")],
-            [InlineKeyboardButton("Экспорт результатов (CSV)", callback_data="admin_export")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             "👑 Панель администратора\nВыберите действие:",
-            reply_markup=reply_markup
+            reply_markup=admin_keyboard(context)
         )
     else:
         await update.message.reply_text(
             "⛔ У вас нет прав администратора для доступа к этой команде."
         )
 
+async def cmd_reconcile_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /reconcile_stats - сверяет счётчики статистики с результатами опроса"""
+    user_id = update.effective_user.id
+    
+    if str(user_id) not in ADMIN_IDS and user_id not in ADMIN_IDS:
+        await update.message.reply_text(
+            "⛔ У вас нет прав администратора для доступа к этой команде."
+        )
+        return
+    
+    report = await db.reconcile_statistics(admin_survey(context)['id'])
+    
+    if 'error' in report:
+        await update.message.reply_text(f"❌ Ошибка при сверке статистики: {report['error']}")
+    elif report['mismatches']:
+        details = "\n".join(
+            f"• {section} / {value}: было {actual}, по данным {expected}"
+            for (section, value), (actual, expected) in sorted(report['mismatches'].items())
+        )
+        await update.message.reply_text(
+            f"⚠️ Найдены расхождения в статистике ({len(report['mismatches'])}), счётчики пересчитаны:\n"
+            f"{details}"[:4096]
+        )
+    else:
+        await update.message.reply_text(
+            f"✅ Статистика сходится. Проверено участников: {report['total_users']}"
+        )
+
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик кнопок админской панели"""
     query = update.callback_query
@@ -672,33 +464,77 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await show_stats(query, context)
     elif query.data == "admin_users":
         await show_users(query, context)
+    elif query.data.startswith("admin_users_"):
+        await show_users(query, context, *parse_users_callback(query.data))
+    elif query.data.startswith("admin_ufm_"):
+        await show_users_filter(query, context, 'municipality', query.data[len("admin_ufm_"):])
+    elif query.data.startswith("admin_ufc_"):
+        await show_users_filter(query, context, 'category', query.data[len("admin_ufc_"):])
+    elif query.data == "admin_search":
+        await query.edit_message_text(
+            SEARCH_HELP, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]])
+        )
+    elif query.data.startswith("admin_search_"):
+        direction, cursor = query.data[len("admin_search_"):].split("_")
+        message, reply_markup = await search_page(context, direction, int(cursor))
+        await query.edit_message_text(message, reply_markup=reply_markup)
     elif query.data == "admin_export":
-        await export_results(query, context)
+        await show_export_formats(query, context)
+    elif query.data.startswith("admin_export_"):
+        await export_results(query, context, query.data[len("admin_export_"):])
     elif query.data.startswith("user_details_"):
         user_id_to_show = query.data.split("_")[2]
         await show_user_details(query, context, user_id_to_show)
+    elif query.data == "admin_funnel":
+        await show_funnel(query, context)
+    elif query.data == "admin_surveys":
+        await show_surveys(query, context)
+    elif query.data.startswith("admin_survey_"):
+        await select_survey(query, context, int(query.data[len("admin_survey_"):]))
     elif query.data == "admin_back":
         # Возврат к основной панели администратора
-        keyboard = [
-            [InlineKeyboardButton("Общая статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("Список всех участников", callback_data="admin_users")],
-            [InlineKeyboardButton("Экспорт результатов (CSV)", callback_data="admin_export")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             "👑 Панель администратора\nВыберите действие:",
-            reply_markup=reply_markup
+            reply_markup=admin_keyboard(context)
         )
 
+async def show_surveys(query, context):
+    """Показывает опросы и волны для выбора"""
+    selected = admin_survey(context)
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{'✅ ' if item['id'] == selected['id'] else ''}{item['name']}, волна {item['wave']}"
+            f" (версия {item['version']}): {item['respondents']}",
+            callback_data=f"admin_survey_{item['id']}"
+        )]
+        for item in await db.get_surveys()
+    ]
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
+    
+    await query.edit_message_text(
+        "📋 Выберите опрос: статистика, список участников и экспорт относятся к выбранной волне",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def select_survey(query, context, survey_id: int):
+    """Выбор опроса, с которым работает администратор"""
+    for item in await db.get_surveys():
+        if item['id'] == survey_id:
+            context.user_data['survey'] = {'id': item['id'], 'name': item['name'], 'wave': item['wave']}
+    await query.edit_message_text(
+        "👑 Панель администратора\nВыберите действие:",
+        reply_markup=admin_keyboard(context)
+    )
+
 async def show_stats(query, context):
     """Показывает общую статистику по опросу"""
+    selected = admin_survey(context)
     # Получаем статистику из базы данных
-    stats = db.get_statistics()
+    stats = await db.get_statistics(selected['id'])
     total_users = stats['total_users']
     
     # Формируем сообщение со статистикой
-    stats_message = f"📊 Общая статистика опроса\n\n"
+    stats_message = f"📊 Общая статистика опроса {selected['name']}, волна {selected['wave']}\n\n"
     stats_message += f"Всего участников: {total_users}\n\n"
     
     stats_message += "По муниципалитетам:\n"
@@ -728,6 +564,36 @@ async def show_stats(query, context):
         percentage = (count / total_users) * 100 if total_users else 0
         stats_message += f"• {knows}: {count} ({percentage:.1f}%)\n"
     
+    session_metrics = sessions.metrics()
+    stats_message += (
+        f"\nАнкет в процессе заполнения: {session_metrics['size']}\n"
+        f"Попаданий в кэш анкет: {session_metrics['hit_rate'] * 100:.1f}%"
+        f" (вытеснено: {session_metrics['evictions']})\n"
+    )
+    
+    subscription_metrics = subscription_cache.metrics()
+    stats_message += (
+        f"Проверки подписки: из кэша {subscription_metrics['hits']}, "
+        f"запросов к Telegram {subscription_metrics['misses']}, "
+        f"совмещено {subscription_metrics['shared']}\n"
+    )
+    
+    outbound_metrics = outbound.metrics()
+    stats_message += "Очереди исходящих сообщений:"
+    for lane, lane_metrics in outbound_metrics['lanes'].items():
+        stats_message += (
+            f" {lane} - {lane_metrics['depth']} (макс. {lane_metrics['max_depth']},"
+            f" ожидание до {lane_metrics['max_wait']:.1f} с);"
+        )
+    stats_message += f" ошибок 429: {outbound_metrics['flood_errors']}\n"
+    
+    edit_metrics = direction_edits.metrics()
+    stats_message += (
+        f"Правки клавиатуры направлений: запрошено {edit_metrics['requested']}, "
+        f"отправлено {edit_metrics['sent']}, объединено {edit_metrics['coalesced']}, "
+        f"без изменений {edit_metrics['skipped']}\n"
+    )
+    
     # Кнопка возврата к панели администратора
     keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -743,12 +609,99 @@ async def show_stats(query, context):
     else:
         await query.edit_message_text(stats_message, reply_markup=reply_markup)
 
-async def show_users(query, context):
-    """Показывает список пользователей, прошедших опрос"""
-    # Получаем всех пользователей из базы данных
-    results = db.get_all_results()
+# Участников на странице списка
+USERS_PAGE_SIZE = 10
+
+def users_callback(municipality, category, direction: str = '', cursor=None) -> str:
+    """callback_data страницы списка участников: фильтры и курсор соседней страницы.
+
+    Формат admin_users_<муниципалитет>_<категория>[_<n|p>_<код муниципалитета>_<user_id>],
+    где вместо кода фильтра "a" - без фильтра; длина не превышает лимит Telegram в 64 байта.
+    """
+    data = f"admin_users_{'a' if municipality is None else municipality}_{'a' if category is None else category}"
+    if cursor is not None:
+        data += f"_{direction}_{cursor[0]}_{cursor[1]}"
+    return data
+
+def parse_users_callback(data: str):
+    """Фильтры, направление и курсор из callback_data страницы списка участников"""
+    parts = data[len("admin_users_"):].split("_")
+    municipality = None if parts[0] == 'a' else int(parts[0])
+    category = None if parts[1] == 'a' else int(parts[1])
+    if len(parts) == 5:
+        return municipality, category, parts[2], (int(parts[3]), int(parts[4]))
+    return municipality, category, '', None
+
+def format_duration(seconds: float) -> str:
+    """Продолжительность для панели администратора"""
+    if seconds < 60:
+        return f"{seconds:.0f} с" if seconds >= 10 else f"{seconds:.1f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+async def show_funnel(query, context):
+    """Показывает воронку опроса: сколько респондентов дошло до каждого вопроса и сколько на нём задержалось"""
+    selected = admin_survey(context)
+    funnel_steps = await db.get_funnel(selected['id'])
+    compiled = surveys_by_name.get(selected['name'], default_survey)
+    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    started = funnel_steps.get(CHECKING_SUBSCRIPTION, {}).get('reached', 0)
+    if not funnel_steps:
+        await query.edit_message_text("📉 Переходов по опросу пока нет.", reply_markup=reply_markup)
+        return
+    
+    def share(count: int) -> str:
+        return f"{count / started * 100:.1f}%" if started else "-"
+    
+    message = (
+        f"📉 Воронка опроса {selected['name']}, волна {selected['wave']}\n"
+        f"(дошли до вопроса, доля от начавших; сейчас на вопросе; медиана времени ответа)\n\n"
+        f"Начали опрос: {started}\n"
+    )
+    subscription = funnel_steps.get(CHECKING_SUBSCRIPTION)
+    if subscription and subscription['current']:
+        message += f"Не прошли проверку подписки: {subscription['current']}\n"
+    previous = started
+    for number, (state, question) in enumerate(sorted(compiled.states.items()), 1):
+        step = funnel_steps.get(state)
+        if step is None:
+            continue
+        message += f"\n{number}. {question.id}: {step['reached']} ({share(step['reached'])}"
+        if previous:
+            message += f", от предыдущего {step['reached'] / previous * 100:.0f}%"
+        message += ")"
+        if step['current']:
+            message += f", сейчас на вопросе {step['current']}"
+        if step['median'] is not None:
+            message += f", медиана {format_duration(step['median'])}"
+        previous = step['reached']
+    finished = funnel_steps.get(FUNNEL_FINISHED, {}).get('reached', 0)
+    cancelled = funnel_steps.get(FUNNEL_CANCELLED, {}).get('reached', 0)
+    message += f"\n\n✅ Завершили: {finished} ({share(finished)})\n"
+    if cancelled:
+        message += f"❌ Отменили командой /cancel: {cancelled}\n"
+    
+    await query.edit_message_text(message[:4096], reply_markup=reply_markup)
+
+async def show_users(query, context, municipality=None, category=None, direction='', cursor=None):
+    """Показывает страницу списка пользователей, прошедших опрос.
+
+    Список упорядочен по муниципалитету и ID пользователя; кнопки перехода
+    передают в callback_data курсор соседней страницы, поэтому каждая страница
+    читается из базы по индексу, а не выборкой всех анкет.
+    """
+    selected = admin_survey(context)
+    page = await db.get_results_page(
+        selected['id'], municipality, category,
+        after=cursor if direction == 'n' else None,
+        before=cursor if direction == 'p' else None,
+        limit=USERS_PAGE_SIZE
+    )
     
-    if not results:
+    if not page['items'] and municipality is None and category is None:
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -758,39 +711,148 @@ async def show_users(query, context):
         )
         return
     
-    # Создаем список пользователей для пагинации
-    users_list = []
-    for result in results:
-        user_id = result['user_id']
-        municipality = result.get('municipality', 'Не указано')
-        category = result.get('category', 'Не указано')
-        users_list.append((user_id, municipality, category))
-    
-    # Сортируем по муниципалитету
-    users_list.sort(key=lambda x: x[1])
+    # Названия выбранных фильтров и число участников по счётчикам статистики
+    municipality_label = dict(await db.get_option_codes('municipality')).get(municipality) if municipality else None
+    category_label = dict(await db.get_option_codes('category')).get(category) if category else None
+    stats = await db.get_statistics(selected['id'])
+    if municipality is None and category is None:
+        total = stats['total_users']
+    elif category is None:
+        total = stats['municipalities'].get(municipality_label, 0)
+    elif municipality is None:
+        total = stats['categories'].get(category_label, 0)
+    else:
+        total = None
     
     # Создаем клавиатуру для просмотра деталей каждого пользователя
     keyboard = []
-    for user_id, municipality, category in users_list[:10]:  # Показываем первые 10
+    for user_id, user_municipality, user_category in page['items']:
         keyboard.append([InlineKeyboardButton(
-            f"{municipality} - {category} (ID: {user_id})",
+            f"{user_municipality} - {user_category} (ID: {user_id})",
             callback_data=f"user_details_{user_id}"
         )])
     
+    navigation = []
+    if page['has_prev']:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=users_callback(municipality, category, 'p', page['first'])
+        ))
+    if page['has_next']:
+        navigation.append(InlineKeyboardButton(
+            "Далее ➡️", callback_data=users_callback(municipality, category, 'n', page['last'])
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton(
+        f"🏙️ Муниципалитет: {municipality_label or 'все'}", callback_data=f"admin_ufm_{'a' if category is None else category}"
+    )])
+    keyboard.append([InlineKeyboardButton(
+        f"👤 Категория: {category_label or 'все'}", callback_data=f"admin_ufc_{'a' if municipality is None else municipality}"
+    )])
     keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    title = "👥 Список участников опроса" + (f" ({total})" if total is not None else "")
+    if not page['items']:
+        title += ":\nНет участников, подходящих под выбранные фильтры"
+    else:
+        title += ":\nВыберите участника для просмотра подробной информации"
+    await query.edit_message_text(title, reply_markup=reply_markup)
+
+async def show_users_filter(query, context, field: str, other: str):
+    """Показывает варианты фильтра списка участников по муниципалитету или категории.
+
+    other - код фильтра по другому полю из callback_data ("a" - без фильтра), он сохраняется.
+    """
+    keyboard = []
+    for code, label in await db.get_option_codes(field):
+        data = f"admin_users_{code}_{other}" if field == 'municipality' else f"admin_users_{other}_{code}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=data)])
+    keyboard.append([InlineKeyboardButton(
+        "Все", callback_data=f"admin_users_a_{other}" if field == 'municipality' else f"admin_users_{other}_a"
+    )])
+    
     await query.edit_message_text(
-        f"👥 Список участников опроса ({len(users_list)}):\nВыберите участника для просмотра подробной информации",
-        reply_markup=reply_markup
+        "🏙️ Выберите муниципалитет:" if field == 'municipality' else "👤 Выберите категорию:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+# Найденных участников на странице поиска
+SEARCH_PAGE_SIZE = 10
+
+SEARCH_HELP = (
+    "🔍 Поиск участников по образовательной организации:\n"
+    "отправьте команду /search и название, например /search школа 5\n"
+    "Регистр, кавычки, знак № и сокращения (МБОУ, СОШ) не важны; найдутся ответы, содержащие все слова запроса."
+)
+
+async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /search <название> - поиск участников по образовательной организации"""
+    user_id = update.effective_user.id
+    
+    if str(user_id) not in ADMIN_IDS and user_id not in ADMIN_IDS:
+        await update.message.reply_text(
+            "⛔ У вас нет прав администратора для доступа к этой команде."
+        )
+        return
+    
+    text = " ".join(context.args or []).strip()
+    if not text:
+        await update.message.reply_text(SEARCH_HELP)
+        return
+    
+    # Запрос хранится у администратора: в callback_data кнопок страниц - только курсор
+    context.user_data['search'] = text
+    message, reply_markup = await search_page(context)
+    await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def search_page(context, direction: str = '', cursor=None):
+    """Текст и клавиатура страницы результатов поиска по образовательной организации.
+    
+    Как и в списке участников, кнопки перехода передают в callback_data курсор
+    соседней страницы (admin_search_<n|p>_<номер строки индекса>).
+    """
+    back = [InlineKeyboardButton("◀️ К панели администратора", callback_data="admin_back")]
+    text = context.user_data.get('search')
+    if not text:
+        return "🔍 Запрос не найден, повторите поиск командой /search", InlineKeyboardMarkup([back])
+    
+    selected = admin_survey(context)
+    page = await db.search_education_org(
+        text, selected['id'],
+        after=cursor if direction == 'n' else None,
+        before=cursor if direction == 'p' else None,
+        limit=SEARCH_PAGE_SIZE
+    )
+    if page is None:
+        return "⚠️ Поиск недоступен: SQLite бота собран без FTS5", InlineKeyboardMarkup([back])
+    
+    keyboard = [
+        [InlineKeyboardButton(f"{org[:40]} - {municipality} (ID: {user_id})", callback_data=f"user_details_{user_id}")]
+        for user_id, org, municipality in page['items']
+    ]
+    navigation = []
+    if page['has_prev']:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_search_p_{page['first']}"))
+    if page['has_next']:
+        navigation.append(InlineKeyboardButton("Далее ➡️", callback_data=f"admin_search_n_{page['last']}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append(back)
+    
+    title = f"🔍 Поиск «{text}»"
+    if page['items']:
+        title += ":\nВыберите участника для просмотра подробной информации"
+    else:
+        title += ":\nНичего не найдено"
+    return title, InlineKeyboardMarkup(keyboard)
+
 async def show_user_details(query, context, user_id_to_show):
     """Показывает подробную информацию о конкретном пользователе"""
     user_id_to_show = int(user_id_to_show)
     
     # Получаем данные пользователя из базы данных
-    result = db.get_result_by_user_id(user_id_to_show)
+    result = await db.get_result_by_user_id(user_id_to_show, admin_survey(context)['id'])
     
     if not result:
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_users")]]
@@ -835,75 +897,67 @@ async def show_user_details(query, context, user_id_to_show):
     
     await query.edit_message_text(details, reply_markup=reply_markup)
 
-async def export_results(query, context):
-    """Экспортирует результаты опроса в CSV файл"""
-    # Получаем всех пользователей из базы данных
-    results = db.get_all_results()
-    
-    if not results:
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "📝 Пока никто не прошел опрос. Нет данных для экспорта.",
-            reply_markup=reply_markup
-        )
-        return
+async def show_export_formats(query, context):
+    """Показывает выбор формата экспорта"""
+    keyboard = [
+        [InlineKeyboardButton(title, callback_data=f"admin_export_{key}")]
+        for key, (title, _, _) in EXPORT_FORMATS.items()
+    ]
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
     
+    await query.edit_message_text(
+        "📤 Выберите формат экспорта:\n"
+        "CSV открывается в Excel, сжатые CSV, Arrow и Parquet - для больших выгрузок и анализа данных",
+        reply_markup=reply_markup
+    )
+
+async def export_results(query, context, export_format="csv"):
+    """Экспортирует результаты опроса в файл выбранного формата"""
     try:
-        import csv
-        import io
         from datetime import datetime
         
-        # Создаем файл CSV в памяти
-        output = io.StringIO()
-        writer = csv.writer(output)
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"неизвестный формат экспорта {export_format}")
+        title, extension, writer = EXPORT_FORMATS[export_format]
         
-        # Заголовки CSV
-        headers = [
-            "ID пользователя", "Муниципалитет", "Категория", "Образовательная организация", "Знает о Движении", 
-            "Участник Движения", "Знает куратора", "Направления", 
-            "Оценка региона", "Оценка организации", "Оценка студенческого самоуправления", 
-            "Знает о Молодежном центре \"Коса\"", "Дата и время"
-        ]
-        writer.writerow(headers)
+        # Результаты читаются из БД порциями и пишутся во временный файл в отдельном потоке
+        selected = admin_survey(context)
+        count, export_file = await db.stream_results(writer, survey_id=selected['id'])
         
-        # Данные пользователей
-        for result in results:
-            selected_directions = [directions[idx] for idx in result.get('selected_directions', [])]
-            directions_str = "; ".join(selected_directions)
+        if count == 0:
+            export_file.close()
+            keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
             
-            row = [
-                result['user_id'],
-                result.get('municipality', ''),
-                result.get('category', ''),
-                result.get('education_org', ''),
-                result.get('knows_movement', ''),
-                result.get('is_participant', ''),
-                result.get('knows_curator', ''),
-                directions_str,
-                result.get('region_rating', ''),
-                result.get('organization_rating', ''),
-                result.get('student_government_rating', ''),
-                result.get('knows_kosa', ''),
-                result.get('timestamp', '')
-            ]
-            writer.writerow(row)
-        
-        # Возвращаем указатель в начало файла
-        output.seek(0)
+            await query.edit_message_text(
+                "📝 Пока никто не прошел опрос. Нет данных для экспорта.",
+                reply_markup=reply_markup
+            )
+            return
         
         # Имя файла с датой и временем
-        filename = f"opros_results_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
-        
-        # Отправляем файл пользователю
-        await context.bot.send_document(
-            chat_id=query.from_user.id,
-            document=io.BytesIO(output.getvalue().encode('utf-8-sig')),  # Используем UTF-8 с BOM для корректного отображения в Excel
-            filename=filename,
-            caption="📊 Результаты опроса в формате CSV"
+        filename = (
+            f"opros_{selected['name']}_{selected['wave']}_results_"
+            f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}{extension}"
         )
         
+        # Отправляем файл пользователю; слишком большой файл отправляется частями
+        with export_file:
+            export_file.seek(0, 2)
+            size = export_file.tell()
+            parts_total = -(-size // TELEGRAM_UPLOAD_LIMIT)
+            for part_number, part in enumerate(iter_parts(export_file), 1):
+                part_filename = filename if parts_total <= 1 else f"{filename}.part{part_number}of{parts_total}"
+                await context.bot.send_document(
+                    chat_id=query.from_user.id,
+                    document=part,
+                    filename=part_filename,
+                    caption=f"📊 Результаты опроса в формате {title}"
+                    + (f" (часть {part_number} из {parts_total})" if parts_total > 1 else ""),
+                    rate_limit_args=PRIORITY_BULK
+                )
+        
         # Информируем пользователя
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -911,7 +965,8 @@ async def export_results(query, context):
         await query.edit_message_text(
             f"✅ Файл с результатами опроса успешно сформирован и отправлен!\n"
             f"Имя файла: {filename}\n"
-            f"Количество записей: {len(results)}",
+            f"Размер: {size / 1024 / 1024:.1f} МБ\n"
+            f"Количество записей: {count}",
             reply_markup=reply_markup
         )
         
@@ -927,151 +982,192 @@ async def export_results(query, context):
         )
 
 # Добавляем новый обработчик для ответа о Молодежном центре "Коса"
-async def handle_knows_kosa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает ответ на вопрос о знании Молодежного центра "Коса" и запрашивает название образовательной организации"""
-    user_id = update.effective_user.id
-    knows_kosa = update.message.text
-    
-    # Сохраняем ответ пользователя
-    user_responses[user_id]['knows_kosa'] = knows_kosa
-    
-    # Запрашиваем название образовательной организации
-    await update.message.reply_text(
-        "Введите название Вашей образовательной организации:",
-        reply_markup=ReplyKeyboardRemove()
-    )
-    return EDUCATION_ORG
-
-async def handle_student_government_rating(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обрабатывает оценку студенческого самоуправления"""
-    user_id = update.effective_user.id
-    rating = update.message.text
-    
-    if rating in ["1", "2", "3", "4", "5"]:
-        user_responses[user_id]['student_government_rating'] = rating
-        
-        # Сохраняем результаты в базу данных
-        save_result = db.save_survey_result(user_id, user_responses[user_id])
-        
-        if save_result:
-            # Благодарим за прохождение опроса
-            await update.message.reply_text(
-                "Спасибо за участие в опросе! Ваши ответы успешно записаны.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            
-            # Выводим результаты опроса
-            response = user_responses[user_id]
-            
-            summary = (
-                f"📋 Ваши ответы:\n\n"
-                f"🏙️ Муниципальное образование: {response.get('municipality', 'Не указано')}\n"
-                f"👤 Категория: {response.get('category', 'Не указано')}\n"
-                f"🏫 Образовательная организация: {response.get('education_org', 'Не указано')}\n"
-                f"📊 Оценка студенческого самоуправления: {response.get('student_government_rating', 'Не указано')}/5\n"
-                f"🚩 Знание о Молодежном центре \"Коса\": {response.get('knows_kosa', 'Не указано')}\n"
-            )
-            
-            await update.message.reply_text(summary)
-            
-            # Отправляем напоминание о боте "ТРЕВОГА АСТРАХАНЬ"
-            await update.message.reply_text(
-                "Также напоминаем о боте \"ТРЕВОГА АСТРАХАНЬ\" @trevoga30_bot в который приходит вся проверенная информация о БПЛА и других ЧП региона. "
-                "Думайте. Подпишись, чтобы быть в курсе."
-            )
-        else:
-            # Сообщаем о проблеме с сохранением данных
-            await update.message.reply_text(
-                "К сожалению, произошла ошибка при сохранении ваших ответов. Пожалуйста, попробуйте пройти опрос позже.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            # Логируем ошибку
-            logger.error(f"Не удалось сохранить результаты опроса для пользователя {user_id}")
-        
-        return ConversationHandler.END
-    else:
-        await update.message.reply_text(
-            "Пожалуйста, выберите оценку от 1 до 5:",
-            reply_markup=ReplyKeyboardMarkup(
-                [["5", "4", "3", "2", "1"][::-1]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        return STUDENT_GOVERNMENT_RATING
-
 # Функция для корректного завершения работы бота
 def shutdown_handler(signal_number, frame):
     """Обработчик сигналов завершения для корректного закрытия соединения с БД"""
-    print("Получен сигнал завершения, закрываем соединение с базой данных...")
+    print("Получен сигнал завершения, записываем ожидающие ответы и закрываем соединение с базой данных...")
     db.close()
     print("Соединение с базой данных закрыто. Завершение работы.")
     sys.exit(0)
 
+def component_metrics():
+    """Показатели компонентов бота для страницы /metrics: (имя, метки, значение)"""
+    for name, component in (('sessions', sessions), ('subscriptions', subscription_cache), ('edits', direction_edits)):
+        for key, value in component.metrics().items():
+            yield f"survey_bot_{name}_{key}", {}, value
+    outbound_metrics = outbound.metrics()
+    for lane, lane_metrics in outbound_metrics['lanes'].items():
+        for key, value in lane_metrics.items():
+            yield f"survey_bot_outbound_{key}", {'lane': lane}, value
+    yield "survey_bot_outbound_flood_errors", {}, outbound_metrics['flood_errors']
+    yield "survey_bot_outbound_paused_seconds", {}, outbound_metrics['paused_for']
+    for key, value in db.metrics().items():
+        yield f"survey_bot_db_{key}", {}, value
+    for key, value in funnel.metrics().items():
+        yield f"survey_bot_funnel_{key}", {}, value
+
+REGISTRY.add_collector(component_metrics)
+
+# Сервер страницы показателей (запускается при старте приложения, если задан METRICS_PORT)
+metrics_server = None
+
+async def start_metrics(application: Application) -> None:
+    """Запуск страницы показателей /metrics"""
+    global metrics_server
+    if METRICS_PORT is None or metrics_server is not None:
+        return
+    port = METRICS_PORT + 1 + WORKER_INDEX if WORKER_INDEX is not None else METRICS_PORT
+    metrics_server = MetricsServer(REGISTRY, METRICS_LISTEN, port)
+    await metrics_server.start()
+
+# Фоновый перенос прежней таблицы результатов (запускается после старта приложения)
+legacy_migration = None
+
+async def start_legacy_migration(application: Application) -> None:
+    """Запуск переноса прежней таблицы survey_results в фоне, если он не завершён"""
+    global legacy_migration
+    # В режиме нескольких процессов таблицу переносит только первый обработчик
+    if not db.legacy_pending or WORKER_INDEX not in (None, 0) or legacy_migration is not None:
+        return
+    legacy_migration = asyncio.create_task(db.migrate_legacy_results())
+
+async def start_background(application: Application) -> None:
+    """Запуск страницы показателей и переноса прежних результатов после старта приложения"""
+    await start_metrics(application)
+    await start_legacy_migration(application)
+
+async def flush_edits(application: Application) -> None:
+    """Отправка собранных правок сообщений перед остановкой бота"""
+    await direction_edits.flush()
+
+async def close_database(application: Application) -> None:
+    """Запись ожидающих ответов и переходов воронки, закрытие БД и страницы показателей при остановке приложения"""
+    global metrics_server, legacy_migration
+    if legacy_migration is not None:
+        # Перенос продолжится с места остановки при следующем запуске
+        legacy_migration.cancel()
+        await asyncio.gather(legacy_migration, return_exceptions=True)
+        legacy_migration = None
+    await funnel.flush()
+    await db.aclose()
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+
 # Регистрируем обработчики сигналов
 signal.signal(signal.SIGINT, shutdown_handler)  # Ctrl+C
 signal.signal(signal.SIGTERM, shutdown_handler)  # kill
 
-def main() -> None:
-    """Запуск бота"""
-    # Создаем приложение
-    application = Application.builder().token(TOKEN).build()
+def build_application(base_url=None, request=None) -> Application:
+    """Создание приложения со всеми обработчиками; request - своя реализация запросов к Bot API"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .rate_limiter(outbound)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(persistence)
+        .post_init(start_background)
+        .post_stop(flush_edits)
+        .post_shutdown(close_database)
+    )
+    if base_url or BOT_API_URL:
+        builder = builder.base_url(base_url or BOT_API_URL)
+    if request is not None:
+        builder = builder.request(request)
+    if WORKER_INDEX is not None:
+        # Обновления процессу-обработчику пересылает главный процесс
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Настраиваем обработчик разговоров
+    # Время обработки каждого обработчика попадает в показатель survey_bot_handler_seconds
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[instrument_handler(CommandHandler("start", start), "start")],
         states={
             CHECKING_SUBSCRIPTION: [
-                CallbackQueryHandler(button_callback),
-            ],
-            MUNICIPALITY: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_municipality)
-            ],
-            CATEGORY: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_category)
-            ],
-            EDUCATION_ORG: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_education_org)
-            ],
-            KNOWS_MOVEMENT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_knows_movement)
-            ],
-            IS_PARTICIPANT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_is_participant)
-            ],
-            KNOWS_CURATOR: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_knows_curator)
-            ],
-            DIRECTIONS: [
-                CallbackQueryHandler(handle_direction_selection)
-            ],
-            REGION_RATING: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_region_rating)
-            ],
-            ORGANIZATION_RATING: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_organization_rating)
-            ],
-            KNOWS_KOSA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_knows_kosa)
-            ],
-            STUDENT_GOVERNMENT_RATING: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_student_government_rating)
+                instrument_handler(CallbackQueryHandler(button_callback), "check_subscription"),
             ],
+            # Вопросы опросов - по их таблицам переходов
+            **{
+                state: [instrument_handler(answer_handler(compiled, question), f"{compiled.name}:{question.id}")]
+                for compiled in surveys for state, question in compiled.states.items()
+            }
         },
-        fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        fallbacks=[instrument_handler(CommandHandler("cancel", cancel), "cancel")],
+        allow_reentry=True,
+        name="survey",
+        persistent=True
     )
     
     # Добавляем обработчики
     application.add_handler(conv_handler)
-    application.add_handler(CommandHandler("admin", cmd_admin))
-    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
-    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^user_details_"))
+    application.add_handler(instrument_handler(CommandHandler("admin", cmd_admin), "admin"))
+    application.add_handler(instrument_handler(CommandHandler("reconcile_stats", cmd_reconcile_stats), "reconcile_stats"))
+    application.add_handler(instrument_handler(CommandHandler("search", cmd_search), "search"))
+    application.add_handler(instrument_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"), "admin_callback"))
+    application.add_handler(instrument_handler(
+        CallbackQueryHandler(admin_callback, pattern="^user_details_"), "admin_callback"
+    ))
     
-    # Запускаем бота
+    return application
+
+def run_workers() -> None:
+    """Запуск приёмника webhook и WORKERS процессов-обработчиков"""
+    if not WEBHOOK_URL:
+        print("ОШИБКА: несколько процессов-обработчиков (WORKERS) работают только в режиме webhook, задайте WEBHOOK_URL.")
+        sys.exit(1)
+    print(f"Режим webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}, "
+          f"обработчиков {WORKERS} на портах {WORKER_BASE_PORT}-{WORKER_BASE_PORT + WORKERS - 1}")
+    # Секрет, с которым приёмник пересылает обновления обработчикам
+    worker_secret = secrets.token_urlsafe(32)
+    bot = Bot(TOKEN, base_url=BOT_API_URL) if BOT_API_URL else Bot(TOKEN)
+    try:
+        asyncio.run(run_cluster(
+            bot,
+            worker_command=[sys.executable, os.path.abspath(__file__)],
+            worker_env={**os.environ, "WORKER_SECRET": worker_secret},
+            workers=WORKERS,
+            base_port=WORKER_BASE_PORT,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            worker_secret=worker_secret,
+            metrics=(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT is not None else None
+        ))
+    finally:
+        db.close()
+
+def main() -> None:
+    """Запуск бота"""
     print(f"Бот запущен. Канал: {CHANNEL_ID}, Админы: {ADMIN_IDS}")
+    if WORKER_INDEX is None and WORKERS > 1:
+        print("Для остановки нажмите Ctrl+C.")
+        run_workers()
+        return
+    
+    application = build_application()
+    
+    if WORKER_INDEX is not None:
+        # Процесс-обработчик, запущенный главным процессом
+        asyncio.run(run_worker(application, WORKER_BASE_PORT + WORKER_INDEX, WORKER_INDEX, WORKERS,
+                               os.getenv("WORKER_SECRET")))
+        return
+    
+    # Запускаем бота
     print("Для остановки нажмите Ctrl+C.")
-    application.run_polling()
+    if WEBHOOK_URL:
+        print(f"Режим webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,418 @@
+"""Запуск бота несколькими процессами за общим приёмником webhook.
+
+Главный процесс принимает обновления от Telegram (Ingress) и пересылает
+каждое процессу-обработчику с номером user_id % workers, поэтому все
+обновления одного пользователя, а значит и весь его диалог, обрабатывает
+один и тот же процесс. Обработчик - обычное приложение бота без Updater:
+пересланные обновления кладутся в application.update_queue (WorkerServer).
+
+Общее состояние - результаты, статистика, состояния диалогов и
+незавершённые анкеты - хранится в общей базе SQLite: в режиме WAL с ней
+одновременно работают несколько процессов. В памяти процесса остаются
+только кэши данных его собственных пользователей: анкеты SessionStore,
+статусы подписки и очереди исходящих сообщений.
+"""
+
+import asyncio
+import json
+import logging
+import signal
+import subprocess
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from metrics import REGISTRY, MetricsServer
+from updates import KeyedLocks
+
+# Виды обновлений и поле, в котором указан пользователь
+USER_FIELDS = (
+    ('message', 'from'), ('edited_message', 'from'), ('callback_query', 'from'),
+    ('inline_query', 'from'), ('chosen_inline_result', 'from'), ('shipping_query', 'from'),
+    ('pre_checkout_query', 'from'), ('poll_answer', 'user'), ('my_chat_member', 'from'),
+    ('chat_member', 'from'), ('chat_join_request', 'from'),
+)
+
+# Заголовок с секретом, который Telegram передаёт вместе с обновлением
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+# Наибольший размер тела запроса с обновлением, байт: обновления Telegram
+# намного меньше, а приёмник принимает соединения с любого адреса
+MAX_UPDATE_SIZE = 1024 * 1024
+# Наибольшее число заголовков запроса
+MAX_HEADERS = 100
+# Сколько секунд ждать очередного запроса по соединению и чтения его заголовков или тела
+REQUEST_TIMEOUT = 60
+# Наибольшее число одновременных соединений с сервером обновлений
+MAX_CONNECTIONS = 512
+
+# Сколько секунд ждать запуска процесса-обработчика и его остановки
+WORKER_START_TIMEOUT = 60
+WORKER_STOP_TIMEOUT = 30
+
+
+class BadUpdate(ValueError):
+    """Тело запроса - JSON, но не обновление Telegram (ответ 400)"""
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """Пользователь, от которого пришло обновление (None - обновление без пользователя)"""
+    for kind, field in USER_FIELDS:
+        payload = update.get(kind)
+        if payload is not None:
+            if not isinstance(payload, dict):
+                raise BadUpdate(f"Поле {kind} обновления - не объект")
+            user = payload.get(field)
+            if not user:
+                return None
+            if not isinstance(user, dict) or not isinstance(user.get('id'), int):
+                raise BadUpdate(f"Некорректный пользователь в поле {kind} обновления")
+            return user['id']
+    return None
+
+
+def shard_for(user_id: Optional[int], workers: int) -> int:
+    """Номер процесса-обработчика пользователя; обновления без пользователя получает процесс 0"""
+    return user_id % workers if user_id is not None else 0
+
+
+async def read_request_head(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str]]]:
+    """Чтение строки запроса и заголовков HTTP: метод, путь и заголовки (None - соединение закрыто).
+
+    Тело запроса не читается: его читает вызывающий после проверки заголовков.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise ValueError("Слишком много заголовков запроса")
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, path, headers
+
+
+def content_length(headers: Dict[str, str]) -> Optional[int]:
+    """Длина тела запроса из заголовка Content-Length (None - заголовок некорректен)"""
+    value = headers.get('content-length', '0')
+    return int(value) if value.isdigit() else None
+
+
+class UpdateServer(ABC):
+    """HTTP-сервер, принимающий обновления Telegram запросами POST на url_path.
+
+    Соединения keep-alive: Telegram и приёмник отправляют обновления подряд
+    по одному соединению. Обработка обновления - в handle_update, который
+    возвращает HTTP-статус ответа. Путь, секрет и размер тела проверяются до
+    чтения тела; после отказа соединение закрывается, не дочитывая тело.
+    Соединение, по которому запрос или его часть не приходят дольше
+    request_timeout секунд, закрывается; соединения сверх max_connections
+    получают ответ 503 и сразу закрываются.
+    """
+
+    def __init__(self, listen: str, port: int, url_path: str = '', secret_token: Optional[str] = None,
+                 request_timeout: float = REQUEST_TIMEOUT, max_connections: int = MAX_CONNECTIONS):
+        """Инициализация сервера"""
+        self.listen = listen
+        self.port = port
+        self.url_path = url_path.strip('/')
+        self.secret_token = secret_token
+        self.request_timeout = request_timeout
+        self.max_connections = max_connections
+        self.rejected_connections = 0
+        self.server = None
+        # Задача соединения -> обрабатывается ли сейчас запрос
+        self._connections = {}
+
+    async def start(self):
+        """Запуск сервера"""
+        self.server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+
+    async def stop(self):
+        """Остановка сервера; обрабатываемые обновления дообрабатываются"""
+        if self.server is not None:
+            server, self.server = self.server, None
+            server.close()
+            # Простаивающие соединения закрываем, остальные закроются после ответа
+            for task, busy in list(self._connections.items()):
+                if not busy:
+                    task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await server.wait_closed()
+
+    @abstractmethod
+    async def handle_update(self, data: Dict[str, Any]) -> str:
+        """Обработка обновления; возвращает HTTP-статус ответа, при неверном обновлении - BadUpdate"""
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обработка соединения"""
+        if len(self._connections) >= self.max_connections:
+            self.rejected_connections += 1
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self._connections[task] = False
+        try:
+            while self.server is not None:
+                request = await asyncio.wait_for(read_request_head(reader), self.request_timeout)
+                if request is None:
+                    break
+                self._connections[task] = True
+                method, path, headers = request
+                length = content_length(headers)
+                if method != 'POST' or path.strip('/') != self.url_path:
+                    status = '404 Not Found'
+                elif self.secret_token and headers.get(SECRET_HEADER) != self.secret_token:
+                    status = '403 Forbidden'
+                elif length is None:
+                    status = '400 Bad Request'
+                elif length > MAX_UPDATE_SIZE:
+                    status = '413 Payload Too Large'
+                else:
+                    status = None
+                if status is not None:
+                    # Тело не прочитано - продолжать соединение нельзя
+                    writer.write(
+                        f'HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode('latin-1')
+                    )
+                    await writer.drain()
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), self.request_timeout)
+                try:
+                    data = json.loads(body)
+                    if not isinstance(data, dict):
+                        raise BadUpdate("Обновление - не объект JSON")
+                    status = await self.handle_update(data)
+                except ValueError as e:
+                    # И некорректный JSON, и BadUpdate: повторять такой запрос бесполезно
+                    logging.warning("Отклонено некорректное обновление: %s", e)
+                    status = '400 Bad Request'
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n'.encode('latin-1'))
+                await writer.drain()
+                self._connections[task] = False
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+
+class Ingress(UpdateServer):
+    """Приёмник webhook: пересылает обновление процессу-обработчику его пользователя.
+
+    Обновления одного пользователя пересылаются по очереди, чтобы обработчик
+    получил их в том же порядке. Telegram получает ответ 200 только после
+    того, как обработчик принял обновление; если обработчик недоступен,
+    ответ 503 - и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, listen: str, port: int, url_path: str, secret_token: Optional[str],
+                 worker_urls: List[str], worker_secret: Optional[str] = None):
+        """Инициализация приёмника"""
+        super().__init__(listen, port, url_path, secret_token)
+        self.worker_urls = worker_urls
+        self.worker_secret = worker_secret
+        self._user_locks = KeyedLocks()
+        self._client = None
+        self.forwarded = Counter()
+        self.failures = 0
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=256))
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        logging.info("Переслано обновлений по обработчикам: %s, ошибок пересылки: %s",
+                     dict(sorted(self.forwarded.items())), self.failures)
+
+    async def handle_update(self, data: Dict[str, Any]) -> str:
+        user_id = update_user_id(data)
+        worker = shard_for(user_id, len(self.worker_urls))
+        headers = {SECRET_HEADER: self.worker_secret} if self.worker_secret else {}
+        async with self._user_locks.hold(user_id):
+            try:
+                response = await self._client.post(self.worker_urls[worker], json=data, headers=headers)
+            except httpx.HTTPError as e:
+                self.failures += 1
+                logging.error(f"Обработчик {worker} недоступен: {e}")
+                return '503 Service Unavailable'
+        if response.status_code == 400:
+            # Обработчик не разобрал обновление - повтор доставки не поможет
+            raise BadUpdate(f"Обработчик {worker} отклонил обновление")
+        if response.status_code != 200:
+            self.failures += 1
+            logging.error(f"Обработчик {worker} не принял обновление: {response.status_code}")
+            return '503 Service Unavailable'
+        self.forwarded[worker] += 1
+        return '200 OK'
+
+    def metrics(self):
+        """Показатели приёмника для страницы /metrics: (имя, метки, значение)"""
+        for worker, count in self.forwarded.items():
+            yield "survey_bot_ingress_forwarded", {'worker': worker}, count
+        yield "survey_bot_ingress_failures", {}, self.failures
+        yield "survey_bot_ingress_rejected_connections", {}, self.rejected_connections
+
+
+class WorkerServer(UpdateServer):
+    """Приём обновлений процессом-обработчиком: обновление передаётся приложению бота"""
+
+    def __init__(self, application: Application, port: int, worker_index: int, workers: int,
+                 secret_token: Optional[str] = None):
+        """Инициализация; обработчик слушает только локальный адрес"""
+        super().__init__('127.0.0.1', port, secret_token=secret_token)
+        self.application = application
+        self.worker_index = worker_index
+        self.workers = workers
+        self.received = 0
+        self.users = set()
+        self.misrouted = 0
+
+    async def handle_update(self, data: Dict[str, Any]) -> str:
+        user_id = update_user_id(data)
+        if shard_for(user_id, self.workers) != self.worker_index:
+            # Диалог пользователя ведёт другой процесс - здесь его состояния нет
+            self.misrouted += 1
+            logging.error(f"Обработчик {self.worker_index} получил обновление чужого пользователя {user_id}")
+            return '421 Misdirected Request'
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise BadUpdate(f"Обновление не разобрано: {e!r}") from e
+        self.received += 1
+        if user_id is not None:
+            self.users.add(user_id)
+        await self.application.update_queue.put(update)
+        return '200 OK'
+
+
+async def run_worker(application: Application, port: int, worker_index: int, workers: int,
+                     secret_token: Optional[str] = None):
+    """Работа процесса-обработчика до сигнала SIGINT или SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    server = WorkerServer(application, port, worker_index, workers, secret_token)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        logging.info("Обработчик %s из %s принимает обновления на порту %s", worker_index, workers, port)
+        await stop_event.wait()
+        # Сначала перестаём принимать обновления, затем дообрабатываем принятые
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    logging.info("Обработчик %s из %s: принято обновлений %s, пользователей %s, чужих обновлений %s",
+                 worker_index, workers, server.received, len(server.users), server.misrouted)
+
+
+async def _wait_worker(process: subprocess.Popen, port: int):
+    """Ожидание, пока процесс-обработчик начнёт принимать соединения"""
+    deadline = time.monotonic() + WORKER_START_TIMEOUT
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"Обработчик на порту {port} завершился с кодом {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Обработчик на порту {port} не запустился за {WORKER_START_TIMEOUT} с")
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+
+
+async def _stop_worker(process: subprocess.Popen):
+    """Штатная остановка процесса-обработчика, при зависании - принудительная"""
+    if process.poll() is None:
+        process.terminate()
+    deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+    while process.poll() is None:
+        if time.monotonic() > deadline:
+            logging.error(f"Обработчик {process.pid} не остановился за {WORKER_STOP_TIMEOUT} с")
+            process.kill()
+            await asyncio.get_running_loop().run_in_executor(None, process.wait)
+            break
+        await asyncio.sleep(0.1)
+
+
+async def run_cluster(bot: Bot, worker_command: List[str], worker_env: Dict[str, str], workers: int,
+                      base_port: int, listen: str, port: int, url_path: str, webhook_url: str,
+                      secret_token: Optional[str] = None, worker_secret: Optional[str] = None,
+                      metrics: Optional[Tuple[str, int]] = None):
+    """Запуск процессов-обработчиков и приёмника webhook до сигнала SIGINT или SIGTERM.
+
+    Обработчик номер i запускается командой worker_command с переменной
+    окружения WORKER_INDEX=i и слушает порт base_port + i. Завершившийся
+    процесс-обработчик перезапускается; пока он недоступен, Telegram получает
+    ответ 503 и повторяет доставку. metrics - (адрес, порт) страницы
+    показателей приёмника /metrics; обработчики отдают свои показатели сами.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    def spawn(index: int) -> subprocess.Popen:
+        return subprocess.Popen(worker_command, env={**worker_env, 'WORKER_INDEX': str(index)})
+
+    processes = [spawn(index) for index in range(workers)]
+    ingress = None
+    metrics_server = None
+    try:
+        await asyncio.gather(*(_wait_worker(process, base_port + index) for index, process in enumerate(processes)))
+
+        ingress = Ingress(listen, port, url_path, secret_token,
+                          [f'http://127.0.0.1:{base_port + index}/' for index in range(workers)], worker_secret)
+        await ingress.start()
+        if metrics is not None:
+            REGISTRY.add_collector(ingress.metrics)
+            metrics_server = MetricsServer(REGISTRY, *metrics)
+            await metrics_server.start()
+        async with bot:
+            await bot.set_webhook(url=webhook_url, secret_token=secret_token,
+                                  allowed_updates=Update.ALL_TYPES)
+        logging.info("Приёмник webhook запущен: %s:%s/%s, обработчиков %s", listen, port, url_path, workers)
+
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            for index, process in enumerate(processes):
+                if process.poll() is not None and not stop_event.is_set():
+                    logging.error(f"Обработчик {index} завершился с кодом {process.returncode}, перезапуск")
+                    processes[index] = spawn(index)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.stop()
+        if ingress is not None:
+            await ingress.stop()
+        await asyncio.gather(*(_stop_worker(process) for process in processes))
@@ -1,271 +1,1153 @@
 import sqlite3
 import json
 import logging
-from typing import Dict, List, Any, Optional, Union
+import os
+import urllib.parse
+import asyncio
+import copy
+import functools
+import math
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
+
+from metrics import DB_SECONDS, REGISTRY
+from search import ORG_INDEX_VERSION, org_index_text, org_match_query
+from survey import CODED_FIELDS, FIELDS, RESULT_META, SURVEYS, directions
+
+# Настройки соединения: WAL не блокирует чтение во время записи, а synchronous=NORMAL
+# в режиме WAL делает fsync только при контрольной точке, а не при каждом commit
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # 16 МБ кэша страниц
+    "PRAGMA temp_store = MEMORY",
+]
+
+# Сколько секунд ждать, пока другой процесс бота закончит запись в базу
+BUSY_TIMEOUT = 30
+
+# Размер кэша подготовленных выражений соединения
+CACHED_STATEMENTS = 64
+
+# Версия схемы: 2 - ответы хранятся кодами вариантов, направления - битовой маской;
+# 3 - ответы всех опросов и волн в общих таблицах responses и answers;
+# 4 - коды муниципалитета и категории в responses для постраничного списка участников
+SCHEMA_VERSION = 4
+
+# Анкета респондента: одна строка на (опрос, пользователь). Текст запроса постоянный,
+# поэтому sqlite3 компилирует его один раз и дальше берёт из кэша выражений.
+# Время ответа передаётся только при переносе результатов из прежней таблицы
+UPSERT_RESPONSE_SQL = '''
+INSERT INTO responses (survey_id, user_id, version, timestamp, municipality_code, category_code)
+VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?)
+ON CONFLICT(survey_id, user_id) DO UPDATE SET
+    version = excluded.version, timestamp = excluded.timestamp,
+    municipality_code = excluded.municipality_code, category_code = excluded.category_code
+'''
+
+# Заполнение кодов муниципалитета и категории анкет, сохранённых в схеме 3
+BACKFILL_BROWSE_CODES_SQL = '''
+UPDATE responses SET
+    municipality_code = COALESCE((
+        SELECT a.code FROM answers AS a JOIN answer_fields AS f ON f.id = a.field_id AND f.name = 'municipality'
+        WHERE a.survey_id = responses.survey_id AND a.user_id = responses.user_id
+    ), 0),
+    category_code = COALESCE((
+        SELECT a.code FROM answers AS a JOIN answer_fields AS f ON f.id = a.field_id AND f.name = 'category'
+        WHERE a.survey_id = responses.survey_id AND a.user_id = responses.user_id
+    ), 0)
+'''
+
+DELETE_ANSWERS_SQL = "DELETE FROM answers WHERE survey_id = ? AND user_id = ?"
+
+INSERT_ANSWER_SQL = "INSERT INTO answers (survey_id, user_id, field_id, code, text) VALUES (?, ?, ?, ?, ?)"
+
+# Индекс поиска по названию учебного заведения: строка org_search - анкета, её номер
+# (rowid) задаёт org_search_rows. Опрос записан в индекс словом s<номер опроса>
+CREATE_SEARCH_SQL = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS org_search USING fts5(survey, org, tokenize = 'unicode61 remove_diacritics 2')
+'''
+INSERT_SEARCH_ROW_SQL = "INSERT OR IGNORE INTO org_search_rows (survey_id, user_id) VALUES (?, ?)"
+DELETE_SEARCH_SQL = '''
+DELETE FROM org_search WHERE rowid = (SELECT id FROM org_search_rows WHERE survey_id = ? AND user_id = ?)
+'''
+INSERT_SEARCH_SQL = '''
+INSERT INTO org_search (rowid, survey, org)
+SELECT id, ?, ? FROM org_search_rows WHERE survey_id = ? AND user_id = ?
+'''
+
+# Анкеты опроса с ответами, от новых к старым. Ответы одного респондента идут
+# подряд, поэтому анкеты собираются по одной, без загрузки всего опроса в память
+RESULTS_SQL = '''
+SELECT r.user_id, r.timestamp, a.field_id, a.code, a.text
+FROM responses AS r
+LEFT JOIN answers AS a ON a.survey_id = r.survey_id AND a.user_id = r.user_id
+WHERE r.survey_id = ?
+ORDER BY r.timestamp DESC, r.user_id DESC
+'''
+
+# Столбцы прежней таблицы survey_results (схемы 1 и 2), нужные для переноса её данных
+LEGACY_COLUMNS = [
+    ('municipality', 'TEXT'),
+    ('category', 'TEXT'),
+    ('education_org', 'TEXT'),
+    ('knows_movement', 'TEXT'),
+    ('is_participant', 'TEXT'),
+    ('knows_curator', 'TEXT'),
+    ('selected_directions', 'TEXT'),
+    ('region_rating', 'TEXT'),
+    ('organization_rating', 'TEXT'),
+    ('knows_kosa', 'TEXT'),
+    ('student_government_rating', 'TEXT'),
+    # Схема 2: коды вариантов ответа и битовая маска направлений
+    ('municipality_code', 'INTEGER'),
+    ('category_code', 'INTEGER'),
+    ('knows_movement_code', 'INTEGER'),
+    ('is_participant_code', 'INTEGER'),
+    ('knows_curator_code', 'INTEGER'),
+    ('directions_mask', 'INTEGER'),
+    ('region_rating_code', 'INTEGER'),
+    ('organization_rating_code', 'INTEGER'),
+    ('knows_kosa_code', 'INTEGER'),
+    ('student_government_rating_code', 'INTEGER')
+]
+
+# Вопросы с ответом да/нет и оценки от 1 до 5, по которым ведётся статистика
+YES_NO_FIELDS = ('knows_movement', 'is_participant', 'knows_curator', 'knows_kosa')
+RATING_FIELDS = ('region_rating', 'organization_rating', 'student_government_rating')
+YES_NO_VALUES = ('Да', 'Нет')
+RATING_VALUES = ('1', '2', '3', '4', '5')
+NOT_SPECIFIED = 'Не указано'
+
+# Поле с выбранными направлениями хранится битовой маской
+MASK_FIELD = 'selected_directions'
+
+# Разделы статистики для вопросов с произвольным списком вариантов
+OPTION_SECTIONS = {'municipality': 'municipalities', 'category': 'categories'}
+
+# Код муниципалитета или категории в responses для анкеты без ответа на этот вопрос
+NO_CODE = 0
+
+# Поле анкеты, по которому ведётся полнотекстовый поиск
+SEARCH_FIELD = 'education_org'
+
+# Время на вопросе хранится гистограммой: корзина - четверть удвоения (шаг около 19%),
+# поэтому медиана по гистограмме отличается от точной не больше чем на 10%
+FUNNEL_BUCKETS_PER_DOUBLING = 4
+FUNNEL_MIN_DURATION = 0.01
+
+
+def rating_code(value: Optional[str]) -> Optional[int]:
+    """Оценка от 1 до 5 в виде числа (None, если оценки нет)"""
+    return int(value) if value in RATING_VALUES else None
+
+
+def empty_statistics() -> Dict[str, Any]:
+    """Пустая статистика в формате, который ожидает панель администратора"""
+    stats = {
+        'total_users': 0,
+        'municipalities': {},
+        'categories': {},
+        'selected_directions': {}
+    }
+    for field in YES_NO_FIELDS:
+        stats[field] = {value: 0 for value in YES_NO_VALUES + (NOT_SPECIFIED,)}
+    for field in RATING_FIELDS:
+        stats[field] = {value: 0 for value in RATING_VALUES + (NOT_SPECIFIED,)}
+    return stats
+
+
+def statistics_keys(result: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """Счётчики статистики (раздел, значение), в которые входит один результат"""
+    keys = [
+        ('total_users', ''),
+        ('municipalities', result.get('municipality') or NOT_SPECIFIED),
+        ('categories', result.get('category') or NOT_SPECIFIED)
+    ]
+    for field in YES_NO_FIELDS:
+        value = result.get(field)
+        keys.append((field, value if value in YES_NO_VALUES else NOT_SPECIFIED))
+    for field in RATING_FIELDS:
+        value = result.get(field)
+        keys.append((field, value if value in RATING_VALUES else NOT_SPECIFIED))
+    
+    directions = result.get('selected_directions', [])
+    if isinstance(directions, list):
+        keys.extend(('selected_directions', str(direction)) for direction in directions)
+    return keys
+
+
+def statistics_from_counters(counters) -> Dict[str, Any]:
+    """Сборка статистики из троек (раздел, значение, количество)"""
+    stats = empty_statistics()
+    for section, value, count in counters:
+        if section == 'total_users':
+            stats['total_users'] = count
+        elif section == 'selected_directions':
+            stats[section][int(value)] = count
+        else:
+            stats[section][value] = count
+    return stats
+
+
+def funnel_bucket(duration: float) -> int:
+    """Корзина гистограммы времени на вопросе"""
+    return math.floor(math.log2(max(duration, FUNNEL_MIN_DURATION)) * FUNNEL_BUCKETS_PER_DOUBLING)
+
+
+def funnel_bucket_value(bucket: int) -> float:
+    """Середина корзины гистограммы времени (среднее геометрическое её границ), секунды"""
+    return 2 ** ((bucket + 0.5) / FUNNEL_BUCKETS_PER_DOUBLING)
+
+
+def _build_legacy_view_sql() -> str:
+    """Временное представление прежней таблицы survey_results с ответами в текстовом виде.
+
+    Коды вариантов расшифровываются по таблице answer_options. Для строк, ещё
+    не переведённых в коды (схема 1), берётся значение из текстовой колонки.
+    """
+    columns = ["r.user_id", "r.timestamp"]
+    joins = []
+    for field in FIELDS:
+        if field in CODED_FIELDS:
+            columns.append(f"COALESCE({field}_option.label, r.{field}, '') AS {field}")
+            joins.append(
+                f"LEFT JOIN answer_options AS {field}_option "
+                f"ON {field}_option.field = '{field}' AND {field}_option.code = r.{field}_code"
+            )
+        elif field in RATING_FIELDS:
+            columns.append(f"COALESCE(CAST(r.{field}_code AS TEXT), r.{field}, '') AS {field}")
+        else:
+            columns.append(f"r.{field}")
+    columns.append("r.directions_mask")
+    return (
+        "CREATE TEMP VIEW legacy_results AS SELECT " + ", ".join(columns) +
+        " FROM main.survey_results AS r " + " ".join(joins)
+    )
+
+
+LEGACY_VIEW_SQL = _build_legacy_view_sql()
+
 
 class Database:
-    """Класс для работы с базой данных SQLite"""
+    """Класс для работы с базой данных SQLite.
+
+    Бот может проводить несколько опросов и несколько волн одного опроса:
+    опрос (имя, волна) регистрируется в таблице surveys, каждая изменённая
+    версия его описания - в survey_versions. Анкета хранится строкой responses
+    с ключом (опрос, пользователь) и ответами в answers - по строке на вопрос:
+    вариант ответа кодом, оценка числом, направления битовой маской, свободный
+    ответ текстом. Индексы начинаются с номера опроса, поэтому статистика и
+    экспорт одной волны читают только её строки, сколько бы волн ни накопилось.
+    Методы принимают survey_id; без него используется первый опрос из SURVEYS.
+    """
     
-    def __init__(self, db_name="survey_bot.db"):
-        """Инициализация базы данных"""
+    def __init__(self, db_name="survey_bot.db", read_only: bool = False,
+                 surveys: Optional[List[Dict[str, Any]]] = None):
+        """Инициализация базы данных.
+
+        Соединение только для чтения не создаёт таблиц и используется для долгих
+        выборок (например, экспорта), чтобы не задерживать запись результатов.
+        surveys - описания проводимых опросов (по умолчанию SURVEYS).
+        """
         self.db_name = db_name
+        self.read_only = read_only
         self.conn = None
         self.cursor = None
+        # Коды вариантов ответа: {вопрос: {текст ответа: код}} и обратный справочник
+        self._option_codes = {field: {} for field in CODED_FIELDS}
+        self._option_labels = {field: {} for field in CODED_FIELDS}
+        # Номера полей анкеты в таблице answers
+        self._field_ids = {}
+        self._field_names = {}
+        # (имя, волна) -> номер опроса; номер опроса -> текущая версия описания
+        self.survey_ids = {}
+        self._survey_versions = {}
+        self.default_survey_id = None
+        # Есть ли индекс поиска по учебным заведениям (нужен SQLite с FTS5)
+        self.search_enabled = False
+        # Не завершён перенос прежней таблицы survey_results: последний перенесённый user_id и число анкет
+        self.legacy_pending = False
+        self._legacy_position = None
+        self._legacy_migrated = 0
         self.connect()
-        self.create_tables()
+        if not read_only:
+            self.create_tables(SURVEYS if surveys is None else surveys)
+        else:
+            self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'org_search'")
+            self.search_enabled = self.cursor.fetchone() is not None
+            self._load_dictionaries()
+            self._load_surveys()
+            first = (SURVEYS if surveys is None else surveys)[0]
+            self.default_survey_id = self.survey_ids.get((first['name'], first.get('wave', 1)))
     
     def connect(self):
         """Подключение к базе данных"""
         try:
-            self.conn = sqlite3.connect(self.db_name)
+            if self.read_only:
+                uri = f"file:{urllib.parse.quote(os.path.abspath(self.db_name))}?mode=ro"
+                self.conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+            else:
+                self.conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS)
             self.conn.row_factory = sqlite3.Row  # Для доступа к данным по названиям столбцов
             self.cursor = self.conn.cursor()
-            logging.info(f"Успешное подключение к базе данных {self.db_name}")
+            if not self.read_only:
+                for pragma in CONNECTION_PRAGMAS:
+                    self.cursor.execute(pragma)
+            logging.info("Успешное подключение к базе данных %s", self.db_name)
         except sqlite3.Error as e:
             logging.error(f"Ошибка подключения к базе данных: {e}")
     
-    def create_tables(self):
-        """Создание необходимых таблиц и добавление недостающих колонок"""
+    def create_tables(self, surveys: List[Dict[str, Any]]):
+        """Создание необходимых таблиц, регистрация опросов и перенос данных прежней схемы"""
         try:
-            # Таблица для хранения результатов опроса
+            # Справочник вариантов ответа; коды совпадают с порядком вариантов в опросе
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS answer_options (
+                field TEXT NOT NULL,
+                code INTEGER NOT NULL,
+                label TEXT NOT NULL,
+                PRIMARY KEY (field, code),
+                UNIQUE (field, label)
+            ) WITHOUT ROWID
+            ''')
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO answer_options (field, code, label) VALUES (?, ?, ?)",
+                [(field, code, label) for field, options in CODED_FIELDS.items() for code, label in enumerate(options, 1)]
+            )
+            
+            # Справочник полей анкеты: в answers хранится номер поля, а не его имя
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS answer_fields (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+            ''')
+            self.cursor.executemany("INSERT OR IGNORE INTO answer_fields (name) VALUES (?)", [(field,) for field in FIELDS])
+            
+            # Опросы и волны; версия описания меняется при каждом изменении вопросов
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS surveys (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                wave INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (name, wave)
+            )
+            ''')
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS survey_versions (
+                survey_id INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                definition TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (survey_id, version)
+            ) WITHOUT ROWID
+            ''')
+            
+            # Анкеты и ответы всех опросов
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                survey_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                municipality_code INTEGER NOT NULL DEFAULT 0,
+                category_code INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (survey_id, user_id)
+            ) WITHOUT ROWID
+            ''')
+            # В таблице схемы 3 нет кодов для списка участников: добавляем и заполняем по ответам
+            self.cursor.execute("PRAGMA table_info(responses)")
+            if 'municipality_code' not in {column[1] for column in self.cursor.fetchall()}:
+                self.cursor.execute("ALTER TABLE responses ADD COLUMN municipality_code INTEGER NOT NULL DEFAULT 0")
+                self.cursor.execute("ALTER TABLE responses ADD COLUMN category_code INTEGER NOT NULL DEFAULT 0")
+                self.cursor.execute(BACKFILL_BROWSE_CODES_SQL)
             self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS survey_results (
+            CREATE TABLE IF NOT EXISTS answers (
+                survey_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                field_id INTEGER NOT NULL,
+                code INTEGER,
+                text TEXT,
+                PRIMARY KEY (survey_id, user_id, field_id)
+            ) WITHOUT ROWID
+            ''')
+            
+            # Индексы по опросу: выгрузка по времени ответа и покрывающий индекс для
+            # подсчёта ответов по вариантам без чтения самой таблицы
+            self.cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_responses_timestamp ON responses (survey_id, timestamp)"
+            )
+            # Список участников в порядке (муниципалитет, user_id): страница - чтение
+            # диапазона одного из индексов, в том числе с фильтром по категории
+            self.cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_responses_municipality "
+                "ON responses (survey_id, municipality_code, user_id, category_code)"
+            )
+            self.cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_responses_category "
+                "ON responses (survey_id, category_code, municipality_code, user_id)"
+            )
+            self.cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_answers_field ON answers (survey_id, field_id, code)"
+            )
+            
+            # Счётчики статистики каждого опроса, обновляемые при каждом сохранении и удалении;
+            # таблица прежней схемы (без номера опроса) пересоздаётся
+            self.cursor.execute("PRAGMA table_info(survey_stats)")
+            stats_columns = {column[1] for column in self.cursor.fetchall()}
+            if stats_columns and 'survey_id' not in stats_columns:
+                self.cursor.execute("DROP TABLE survey_stats")
+            stats_table_exists = 'survey_id' in stats_columns
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS survey_stats (
+                survey_id INTEGER NOT NULL,
+                section TEXT NOT NULL,
+                value TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (survey_id, section, value)
+            ) WITHOUT ROWID
+            ''')
+            
+            # Состояния диалогов и незавершённые анкеты, чтобы перезапуск бота не прерывал опрос
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state INTEGER NOT NULL,
+                PRIMARY KEY (name, key)
+            ) WITHOUT ROWID
+            ''')
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS survey_drafts (
                 user_id INTEGER PRIMARY KEY,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                data TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
             ''')
             
-            # Список всех ожидаемых колонок
-            expected_columns = [
-                ('municipality', 'TEXT'),
-                ('category', 'TEXT'),
-                ('education_org', 'TEXT'),
-                ('knows_movement', 'TEXT'),
-                ('is_participant', 'TEXT'),
-                ('knows_curator', 'TEXT'),
-                ('selected_directions', 'TEXT'),
-                ('region_rating', 'TEXT'),
-                ('organization_rating', 'TEXT'),
-                ('knows_kosa', 'TEXT'),
-                ('student_government_rating', 'TEXT')
-            ]
+            # Воронка: журнал переходов только дописывается и не индексируется; панель
+            # администратора читает сводки, обновляемые при записи каждого пакета переходов
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_events (
+                id INTEGER PRIMARY KEY,
+                survey_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                from_state INTEGER,
+                to_state INTEGER NOT NULL,
+                at REAL NOT NULL,
+                duration REAL
+            )
+            ''')
+            # Последнее состояние респондента: откуда он перейдёт и с какого времени он на вопросе
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_positions (
+                user_id INTEGER PRIMARY KEY,
+                survey_id INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                at REAL NOT NULL
+            )
+            ''')
+            # Респонденты, дошедшие до состояния: для подсчёта каждого респондента один раз
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_reached (
+                survey_id INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (survey_id, state, user_id)
+            ) WITHOUT ROWID
+            ''')
+            # Сводка по состояниям: сколько респондентов дошло и сколько сейчас на нём остаётся
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_steps (
+                survey_id INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                reached INTEGER NOT NULL,
+                current INTEGER NOT NULL,
+                PRIMARY KEY (survey_id, state)
+            ) WITHOUT ROWID
+            ''')
+            # Гистограмма времени, проведённого на состоянии до перехода
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_durations (
+                survey_id INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (survey_id, state, bucket)
+            ) WITHOUT ROWID
+            ''')
+            
+            self.conn.commit()
+            self._load_dictionaries()
+            self.search_enabled = self._create_search_index()
             
-            # Получаем информацию о существующих колонках
+            for definition in surveys:
+                self.register_survey(definition)
+            first = surveys[0]
+            self.default_survey_id = self.survey_ids[(first['name'], first.get('wave', 1))]
+            
+            # Прежнюю таблицу только готовим: её переносят порциями после запуска бота (migrate_legacy_chunk)
+            self.cursor.execute("PRAGMA user_version")
+            if self.cursor.fetchone()[0] < SCHEMA_VERSION:
+                self.legacy_pending = self._prepare_legacy_results()
+            
+            # Для существующей базы без счётчиков заполняем их по имеющимся результатам
+            if not stats_table_exists:
+                self.rebuild_statistics()
+            
+            logging.info("Таблицы успешно созданы или обновлены")
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка создания/обновления таблиц: {e}")
+    
+    def _create_search_index(self) -> bool:
+        """Создание индекса поиска по учебным заведениям.
+        
+        В новый индекс заносятся имеющиеся анкеты; индекс, заполненный прежней
+        нормализацией названий (ORG_INDEX_VERSION), заполняется заново.
+        """
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS org_search_rows (
+            id INTEGER PRIMARY KEY,
+            survey_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            UNIQUE (survey_id, user_id)
+        )
+        ''')
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS org_search_version (version INTEGER NOT NULL)")
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'org_search'")
+        exists = self.cursor.fetchone() is not None
+        self.cursor.execute("SELECT MAX(version) FROM org_search_version")
+        current = exists and self.cursor.fetchone()[0] == ORG_INDEX_VERSION
+        try:
+            self.cursor.execute(CREATE_SEARCH_SQL)
+        except sqlite3.OperationalError as e:
+            self.conn.rollback()
+            logging.warning(f"Поиск по учебным заведениям недоступен (SQLite без FTS5): {e}")
+            return False
+        self.conn.commit()
+        if not current:
+            self.rebuild_search_index()
+        return True
+    
+    def rebuild_search_index(self, chunk_size: int = 10000) -> int:
+        """Заполнение индекса поиска по сохранённым анкетам; возвращает число проиндексированных анкет.
+        
+        Индекс создаётся заново, а не очищается DELETE: удалённые строки FTS5
+        остаются в сегментах индекса до их слияния и замедляют чтение страниц
+        в глубине результатов. После заполнения сегменты сливаются в один (optimize).
+        """
+        field_id = self._field_id(SEARCH_FIELD)
+        indexed = 0
+        try:
+            # INSERT открывает транзакцию: при ошибке откатывается и пересоздание индекса
+            self.cursor.execute(
+                "INSERT OR IGNORE INTO org_search_rows (survey_id, user_id) "
+                "SELECT survey_id, user_id FROM answers WHERE field_id = ?", (field_id,)
+            )
+            self.cursor.execute("DROP TABLE IF EXISTS org_search")
+            self.cursor.execute(CREATE_SEARCH_SQL)
+            rows = self.conn.execute(
+                "SELECT m.id, m.survey_id, a.text FROM org_search_rows AS m "
+                "JOIN answers AS a ON a.survey_id = m.survey_id AND a.user_id = m.user_id AND a.field_id = ?",
+                (field_id,)
+            )
+            while True:
+                chunk = rows.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                self.cursor.executemany(
+                    "INSERT INTO org_search (rowid, survey, org) VALUES (?, ?, ?)",
+                    [(row_id, f"s{survey_id}", org_index_text(text)) for row_id, survey_id, text in chunk]
+                )
+                indexed += len(chunk)
+            self.cursor.execute("INSERT INTO org_search (org_search) VALUES ('optimize')")
+            self.cursor.execute("DELETE FROM org_search_version")
+            self.cursor.execute("INSERT INTO org_search_version (version) VALUES (?)", (ORG_INDEX_VERSION,))
+            self.conn.commit()
+            if indexed:
+                logging.info("Индекс поиска по учебным заведениям заполнен: анкет %s", indexed)
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.error(f"Ошибка при заполнении индекса поиска: {e}")
+        return indexed
+    
+    def _load_dictionaries(self):
+        """Загрузка справочников вариантов ответа и полей анкеты в память"""
+        self._option_codes = {field: {} for field in CODED_FIELDS}
+        self._option_labels = {field: {} for field in CODED_FIELDS}
+        self.cursor.execute("SELECT field, code, label FROM answer_options")
+        for row in self.cursor.fetchall():
+            self._option_codes.setdefault(row['field'], {})[row['label']] = row['code']
+            self._option_labels.setdefault(row['field'], {})[row['code']] = row['label']
+        self.cursor.execute("SELECT id, name FROM answer_fields")
+        self._field_ids = {row['name']: row['id'] for row in self.cursor.fetchall()}
+        self._field_names = {field_id: name for name, field_id in self._field_ids.items()}
+    
+    def _load_surveys(self):
+        """Загрузка зарегистрированных опросов и текущих версий их описаний"""
+        self.cursor.execute(
+            "SELECT s.id, s.name, s.wave, MAX(v.version) AS version FROM surveys AS s "
+            "JOIN survey_versions AS v ON v.survey_id = s.id GROUP BY s.id"
+        )
+        for row in self.cursor.fetchall():
+            self.survey_ids[(row['name'], row['wave'])] = row['id']
+            self._survey_versions[row['id']] = row['version']
+    
+    def register_survey(self, definition: Dict[str, Any]) -> int:
+        """Регистрация опроса (волны) и новой версии его описания, если оно изменилось.
+
+        Возвращает номер опроса, с которым сохраняются его анкеты.
+        """
+        name, wave = definition['name'], definition.get('wave', 1)
+        body = json.dumps(definition, ensure_ascii=False, sort_keys=True)
+        self.cursor.execute("INSERT OR IGNORE INTO surveys (name, wave) VALUES (?, ?)", (name, wave))
+        self.cursor.execute("SELECT id FROM surveys WHERE name = ? AND wave = ?", (name, wave))
+        survey_id = self.cursor.fetchone()['id']
+        self.cursor.execute(
+            "SELECT version, definition FROM survey_versions WHERE survey_id = ? ORDER BY version DESC LIMIT 1",
+            (survey_id,)
+        )
+        row = self.cursor.fetchone()
+        version = row['version'] if row is not None else 0
+        if row is None or row['definition'] != body:
+            version += 1
+            self.cursor.execute(
+                "INSERT INTO survey_versions (survey_id, version, definition) VALUES (?, ?, ?)",
+                (survey_id, version, body)
+            )
+            logging.info("Опрос %s (волна %s): зарегистрирована версия описания %s", name, wave, version)
+        self.conn.commit()
+        self.survey_ids[(name, wave)] = survey_id
+        self._survey_versions[survey_id] = version
+        return survey_id
+    
+    def get_surveys(self) -> List[Dict[str, Any]]:
+        """Зарегистрированные опросы с текущей версией и числом анкет"""
+        try:
+            self.cursor.execute('''
+            SELECT s.id, s.name, s.wave, MAX(v.version) AS version, COALESCE(st.count, 0) AS respondents
+            FROM surveys AS s
+            JOIN survey_versions AS v ON v.survey_id = s.id
+            LEFT JOIN survey_stats AS st ON st.survey_id = s.id AND st.section = 'total_users' AND st.value = ''
+            GROUP BY s.id
+            ORDER BY s.name, s.wave
+            ''')
+            return [dict(row) for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при получении списка опросов: {e}")
+            return []
+    
+    def _survey(self, survey_id: Optional[int]) -> int:
+        """Номер опроса; None - опрос по умолчанию"""
+        return self.default_survey_id if survey_id is None else survey_id
+    
+    def _option_code(self, field: str, label: Optional[str]) -> Optional[int]:
+        """Код варианта ответа; новый вариант добавляется в справочник (внутри текущей транзакции)"""
+        if not label:
+            return None
+        codes = self._option_codes[field]
+        code = codes.get(label)
+        if code is None:
+            # Вариант мог уже добавить другой процесс бота, работающий с той же базой
+            self.cursor.execute("SELECT code FROM answer_options WHERE field = ? AND label = ?", (field, label))
+            row = self.cursor.fetchone()
+            if row is not None:
+                code = row['code']
+            else:
+                self.cursor.execute("SELECT COALESCE(MAX(code), 0) + 1 FROM answer_options WHERE field = ?", (field,))
+                code = self.cursor.fetchone()[0]
+                self.cursor.execute(
+                    "INSERT INTO answer_options (field, code, label) VALUES (?, ?, ?)", (field, code, label)
+                )
+            codes[label] = code
+            self._option_labels[field][code] = label
+        return code
+    
+    def _option_label(self, field: str, code: int) -> str:
+        """Текст варианта ответа по коду"""
+        label = self._option_labels[field].get(code)
+        if label is None:
+            # Вариант добавлен другим процессом бота
+            self._load_dictionaries()
+            label = self._option_labels[field].get(code, '')
+        return label
+    
+    def _field_id(self, field: str) -> int:
+        """Номер поля анкеты; новое поле добавляется в справочник (внутри текущей транзакции)"""
+        field_id = self._field_ids.get(field)
+        if field_id is None:
+            self.cursor.execute("INSERT OR IGNORE INTO answer_fields (name) VALUES (?)", (field,))
+            self.cursor.execute("SELECT id FROM answer_fields WHERE name = ?", (field,))
+            field_id = self.cursor.fetchone()['id']
+            self._field_ids[field] = field_id
+            self._field_names[field_id] = field
+        return field_id
+    
+    def _field_name(self, field_id: int) -> str:
+        """Имя поля анкеты по номеру"""
+        name = self._field_names.get(field_id)
+        if name is None:
+            # Поле добавлено другим процессом бота
+            self._load_dictionaries()
+            name = self._field_names[field_id]
+        return name
+    
+    def _answer_rows(self, survey_id: int, user_id: int, data: Dict[str, Any]) -> List[Tuple]:
+        """Строки таблицы answers для ответов одного респондента"""
+        rows = []
+        for field, value in data.items():
+            if field in RESULT_META:
+                continue
+            code = text = None
+            if field in CODED_FIELDS:
+                code = self._option_code(field, value)
+            elif field in RATING_FIELDS:
+                code = rating_code(value)
+            elif field == MASK_FIELD:
+                # Выбранные направления хранятся битовой маской
+                code = sum(1 << idx for idx in set(value or [])) or None
+            elif value:
+                text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            if code is not None or text is not None:
+                rows.append((survey_id, user_id, self._field_id(field), code, text))
+        return rows
+    
+    def _decode(self, field: str, code: Optional[int], text: Optional[str]) -> Any:
+        """Ответ из строки таблицы answers"""
+        if field == MASK_FIELD:
+            return [idx for idx in range(len(directions)) if code >> idx & 1]
+        if field in RATING_FIELDS:
+            return str(code)
+        if field in CODED_FIELDS:
+            return self._option_label(field, code)
+        return text
+    
+    def _build_result(self, user_id: int, timestamp: str, answers: Iterable) -> Dict[str, Any]:
+        """Словарь результатов анкеты из строк (user_id, timestamp, field_id, code, text)"""
+        result = {'user_id': user_id, 'timestamp': timestamp}
+        for field in FIELDS:
+            result[field] = ''
+        result[MASK_FIELD] = []
+        for row in answers:
+            field_id = row[2]
+            if field_id is not None:
+                field = self._field_name(field_id)
+                result[field] = self._decode(field, row[3], row[4])
+        return result
+    
+    def _iter_grouped(self, rows: Iterable) -> Iterator[Dict[str, Any]]:
+        """Анкеты из строк (user_id, timestamp, field_id, code, text), где ответы анкеты идут подряд"""
+        for user_id, user_rows in groupby(rows, key=lambda row: row[0]):
+            first = next(user_rows)
+            yield self._build_result(user_id, first[1], [first, *user_rows])
+    
+    def _prepare_legacy_results(self) -> bool:
+        """Подготовка прежней таблицы survey_results к переносу в первый опрос.
+
+        Возвращает True, если таблица есть и её нужно перенести; без неё база
+        сразу отмечается как перенесённая.
+        """
+        try:
+            self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'survey_results'")
+            if self.cursor.fetchone() is None:
+                self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self.conn.commit()
+                return False
+            # В базе схемы 1 может не быть колонок с кодами
             self.cursor.execute("PRAGMA table_info(survey_results)")
             existing_columns = {column[1] for column in self.cursor.fetchall()}
-            
-            # Проверяем и добавляем отсутствующие колонки
-            for column_name, column_type in expected_columns:
+            for column_name, column_type in LEGACY_COLUMNS:
                 if column_name not in existing_columns:
-                    try:
-                        self.cursor.execute(f"ALTER TABLE survey_results ADD COLUMN {column_name} {column_type}")
-                        logging.info(f"Добавлена колонка {column_name} в таблицу survey_results")
-                    except sqlite3.Error as e:
-                        logging.error(f"Ошибка при добавлении колонки {column_name}: {e}")
+                    self.cursor.execute(f"ALTER TABLE survey_results ADD COLUMN {column_name} {column_type}")
+            self.cursor.execute("DROP VIEW IF EXISTS survey_results_decoded")
+            self.cursor.execute("DROP VIEW IF EXISTS temp.legacy_results")
+            self.cursor.execute(LEGACY_VIEW_SQL)
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.error(f"Ошибка при подготовке переноса результатов в схему версии {SCHEMA_VERSION}: {e}")
+            return False
+    
+    def _legacy_active(self) -> bool:
+        """Не завершён ли перенос прежней таблицы (его мог завершить другой процесс бота)"""
+        if self.legacy_pending:
+            self.cursor.execute("PRAGMA user_version")
+            if self.cursor.fetchone()[0] >= SCHEMA_VERSION:
+                self.legacy_pending = False
+        return self.legacy_pending
+    
+    def migrate_legacy_chunk(self, chunk_size: int = 1000) -> int:
+        """Перенос очередной порции прежней таблицы survey_results в первый опрос.
+
+        Порция переносится одной короткой транзакцией вместе с изменением
+        счётчиков статистики, с сохранением времени ответа. Анкеты, уже
+        сохранённые в первый опрос (в том числе во время переноса), не
+        перезаписываются. Возвращает число перенесённых анкет; 0 - перенос
+        завершён: таблица переименована в survey_results_v2 (её можно удалить,
+        убедившись, что данные перенесены).
+        """
+        try:
+            # Проверка и запись - под одной блокировкой записи с другими процессами бота
+            self.cursor.execute("BEGIN IMMEDIATE")
+            if not self._legacy_active():
+                self.conn.rollback()
+                return 0
+            self.cursor.execute(
+                "SELECT l.* FROM temp.legacy_results AS l WHERE (? IS NULL OR l.user_id > ?) "
+                "AND NOT EXISTS (SELECT 1 FROM responses AS r WHERE r.survey_id = ? AND r.user_id = l.user_id) "
+                "ORDER BY l.user_id LIMIT ?",
+                (self._legacy_position, self._legacy_position, self.default_survey_id, chunk_size)
+            )
+            rows = self.cursor.fetchall()
+            if not rows:
+                self.cursor.execute("DROP VIEW temp.legacy_results")
+                self.cursor.execute("ALTER TABLE survey_results RENAME TO survey_results_v2")
+                self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self.conn.commit()
+                self.legacy_pending = False
+                logging.info(
+                    "Перенесено в схему версии %s анкет: %s; прежняя таблица переименована в survey_results_v2",
+                    SCHEMA_VERSION, self._legacy_migrated
+                )
+                return 0
             
+            items = [
+                (self.default_survey_id, row['user_id'], self._legacy_row_to_result(row), row['timestamp'])
+                for row in rows
+            ]
+            self._write_responses(items)
+            self._apply_statistics_delta(Counter(
+                (survey_id,) + key for survey_id, _, data, _ in items for key in statistics_keys(data)
+            ))
             self.conn.commit()
-            logging.info("Таблицы успешно созданы или обновлены")
+            self._legacy_position = rows[-1]['user_id']
+            self._legacy_migrated += len(rows)
+            return len(rows)
         except sqlite3.Error as e:
-            logging.error(f"Ошибка создания/обновления таблиц: {e}")
+            self.conn.rollback()
+            self._load_dictionaries()
+            logging.error(f"Ошибка при переносе результатов в схему версии {SCHEMA_VERSION}: {e}")
+            return 0
     
-    def save_survey_result(self, user_id: int, data: Dict[str, Any]) -> bool:
+    def migrate_legacy_results(self, chunk_size: int = 1000) -> int:
+        """Перенос всей прежней таблицы порциями (без запущенного бота); число перенесённых анкет"""
+        migrated = 0
+        while True:
+            count = self.migrate_legacy_chunk(chunk_size)
+            if not count:
+                return migrated
+            migrated += count
+    
+    def _legacy_result(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Результаты пользователя в прежней таблице, ещё не перенесённые в первый опрос"""
+        self.cursor.execute("SELECT * FROM temp.legacy_results WHERE user_id = ?", (user_id,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        result = {'user_id': row['user_id'], 'timestamp': row['timestamp']}
+        for field, value in self._legacy_row_to_result(row).items():
+            result[field] = value if value is not None else ''
+        return result
+    
+    @staticmethod
+    def _legacy_row_to_result(row: sqlite3.Row) -> Dict[str, Any]:
+        """Словарь ответов из строки прежней таблицы"""
+        result = {field: row[field] for field in FIELDS}
+        mask = row['directions_mask']
+        if mask is not None:
+            # Направления из битовой маски (схема 2)
+            result[MASK_FIELD] = [idx for idx in range(len(directions)) if mask >> idx & 1]
+        else:
+            # Направления в виде JSON (схема 1)
+            try:
+                result[MASK_FIELD] = json.loads(row[MASK_FIELD]) if row[MASK_FIELD] else []
+            except (TypeError, ValueError):
+                result[MASK_FIELD] = []
+        return result
+    
+    def _write_responses(self, items: List[Tuple[int, int, Dict[str, Any], Optional[str]]]):
+        """Запись анкет (опрос, пользователь, ответы, время ответа) внутри текущей транзакции"""
+        self.cursor.executemany(UPSERT_RESPONSE_SQL, [
+            (
+                survey_id, user_id, self._survey_versions.get(survey_id, 1), timestamp,
+                self._option_code('municipality', data.get('municipality')) or NO_CODE,
+                self._option_code('category', data.get('category')) or NO_CODE
+            )
+            for survey_id, user_id, data, timestamp in items
+        ])
+        self.cursor.executemany(DELETE_ANSWERS_SQL, [(survey_id, user_id) for survey_id, user_id, _, _ in items])
+        self.cursor.executemany(INSERT_ANSWER_SQL, [
+            row for survey_id, user_id, data, _ in items for row in self._answer_rows(survey_id, user_id, data)
+        ])
+        if self.search_enabled:
+            keys = [(survey_id, user_id) for survey_id, user_id, _, _ in items]
+            self.cursor.executemany(INSERT_SEARCH_ROW_SQL, keys)
+            self.cursor.executemany(DELETE_SEARCH_SQL, keys)
+            self.cursor.executemany(INSERT_SEARCH_SQL, [
+                (f"s{survey_id}", org_index_text(data.get(SEARCH_FIELD)), survey_id, user_id)
+                for survey_id, user_id, data, _ in items if data.get(SEARCH_FIELD)
+            ])
+    
+    def save_survey_result(self, user_id: int, data: Dict[str, Any], survey_id: Optional[int] = None) -> bool:
         """Сохранение результатов опроса в базу данных"""
+        return self.save_responses([(self._survey(survey_id), user_id, data)])
+    
+    def save_survey_results(self, items: List[Tuple[int, Dict[str, Any]]], survey_id: Optional[int] = None) -> bool:
+        """Сохранение результатов нескольких пользователей одного опроса одной транзакцией"""
+        survey_id = self._survey(survey_id)
+        return self.save_responses([(survey_id, user_id, data) for user_id, data in items])
+    
+    def save_responses(self, items: List[Tuple[int, int, Dict[str, Any]]]) -> bool:
+        """Сохранение анкет (опрос, пользователь, ответы), возможно разных опросов, одной транзакцией.
+        
+        Анкета одного пользователя в одном опросе, переданная несколько раз,
+        сохраняется один раз - последняя.
+        """
+        items = list({(survey_id, user_id): (survey_id, user_id, data) for survey_id, user_id, data in items}.values())
         try:
-            # Подготавливаем данные для сохранения
-            municipality = data.get('municipality', '')
-            category = data.get('category', '')
-            education_org = data.get('education_org', '')
-            knows_movement = data.get('knows_movement', '')
-            is_participant = data.get('is_participant', '')
-            knows_curator = data.get('knows_curator', '')
-            knows_kosa = data.get('knows_kosa', '')
-            
-            # Преобразуем список направлений в строку JSON
-            selected_directions = json.dumps(data.get('selected_directions', []))
-            
-            region_rating = data.get('region_rating', '')
-            organization_rating = data.get('organization_rating', '')
-            
-            # Получаем оценку студенческого самоуправления, если есть
-            student_government_rating = data.get('student_government_rating', '')
+            # Изменения счётчиков статистики: старые ответы вычитаем, новые добавляем
+            current = self._current_results([(survey_id, user_id) for survey_id, user_id, _ in items])
+            delta = Counter()
+            for survey_id, user_id, data in items:
+                result = {field: data.get(field, '') for field in FIELDS}
+                result[MASK_FIELD] = sorted(data.get(MASK_FIELD, []))
+                key = (survey_id, user_id)
+                if key in current:
+                    delta.subtract((survey_id,) + stats_key for stats_key in statistics_keys(current[key]))
+                delta.update((survey_id,) + stats_key for stats_key in statistics_keys(result))
+                current[key] = result
             
-            # Проверяем, существует ли уже запись для этого пользователя
-            self.cursor.execute("SELECT user_id FROM survey_results WHERE user_id = ?", (user_id,))
-            existing_user = self.cursor.fetchone()
-            
-            if existing_user:
-                # Обновляем существующую запись
-                self.cursor.execute('''
-                UPDATE survey_results SET 
-                    municipality = ?, 
-                    category = ?,
-                    education_org = ?,
-                    knows_movement = ?, 
-                    is_participant = ?, 
-                    knows_curator = ?, 
-                    selected_directions = ?, 
-                    region_rating = ?, 
-                    organization_rating = ?,
-                    knows_kosa = ?,
-                    student_government_rating = ?,
-                    timestamp = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-                ''', (municipality, category, education_org, knows_movement, is_participant, knows_curator, 
-                      selected_directions, region_rating, organization_rating, knows_kosa, 
-                      student_government_rating, user_id))
-            else:
-                # Вставляем новую запись
-                self.cursor.execute('''
-                INSERT INTO survey_results (
-                    user_id, municipality, category, education_org, knows_movement, is_participant, 
-                    knows_curator, selected_directions, region_rating, organization_rating, knows_kosa,
-                    student_government_rating
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (user_id, municipality, category, education_org, knows_movement, is_participant, 
-                      knows_curator, selected_directions, region_rating, organization_rating, knows_kosa,
-                      student_government_rating))
+            self._write_responses([(survey_id, user_id, data, None) for survey_id, user_id, data in items])
+            self._apply_statistics_delta(delta)
             
             self.conn.commit()
-            logging.info(f"Результаты опроса для пользователя {user_id} успешно сохранены")
+            logging.info("Результаты опроса успешно сохранены (записей: %s)", len(items))
             return True
         except Exception as e:
+            self.conn.rollback()
+            # Новые варианты ответа и поля, добавленные в откаченной транзакции, не сохранились
+            self._load_dictionaries()
             logging.error(f"Ошибка при сохранении результатов опроса: {e}")
             return False
     
-    def get_all_results(self) -> List[Dict[str, Any]]:
+    def _current_results(self, keys: List[Tuple[int, int]]) -> Dict[Tuple[int, int], Dict[str, Any]]:
+        """Текущие сохранённые результаты по ключам (опрос, пользователь)"""
+        by_survey = {}
+        for survey_id, user_id in set(keys):
+            by_survey.setdefault(survey_id, []).append(user_id)
+        
+        results = {}
+        for survey_id, user_ids in by_survey.items():
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                self.cursor.execute(
+                    "SELECT r.user_id, r.timestamp, a.field_id, a.code, a.text FROM responses AS r "
+                    "LEFT JOIN answers AS a ON a.survey_id = r.survey_id AND a.user_id = r.user_id "
+                    f"WHERE r.survey_id = ? AND r.user_id IN ({placeholders}) ORDER BY r.user_id",
+                    [survey_id, *chunk]
+                )
+                for result in self._iter_grouped(self.cursor.fetchall()):
+                    results[(survey_id, result['user_id'])] = result
+        return results
+    
+    def get_all_results(self, survey_id: Optional[int] = None) -> List[Dict[str, Any]]:
         """Получение всех результатов опроса"""
         try:
-            self.cursor.execute("SELECT * FROM survey_results ORDER BY timestamp DESC")
-            rows = self.cursor.fetchall()
-            
-            results = []
-            for row in rows:
-                result = dict(row)
-                
-                # Преобразуем JSON строки обратно в объекты Python
-                for key, value in result.items():
-                    if key == 'selected_directions' and value:
-                        try:
-                            result[key] = json.loads(value)
-                        except:
-                            result[key] = []
-                
-                results.append(result)
-            
-            return results
+            return list(self.iter_results(survey_id=survey_id))
         except sqlite3.Error as e:
             logging.error(f"Ошибка при получении результатов опроса: {e}")
             return []
     
-    def get_result_by_user_id(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получение результатов опроса конкретного пользователя"""
+    def iter_results(self, chunk_size: int = 1000, survey_id: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Последовательное чтение всех результатов опроса порциями по chunk_size строк"""
+        cursor = self.conn.cursor()
+        # Строки читаются по номерам столбцов: кортежи дешевле sqlite3.Row
+        cursor.row_factory = None
+        cursor.execute(RESULTS_SQL, (self._survey(survey_id),))
+        
+        def rows():
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                yield from chunk
+        
         try:
-            self.cursor.execute("SELECT * FROM survey_results WHERE user_id = ?", (user_id,))
-            row = self.cursor.fetchone()
-            
-            if row:
-                result = dict(row)
-                
-                # Преобразуем JSON строки обратно в объекты Python
-                for key, value in result.items():
-                    if key == 'selected_directions' and value:
-                        try:
-                            result[key] = json.loads(value)
-                        except:
-                            result[key] = []
-                
-                return result
+            yield from self._iter_grouped(rows())
+        finally:
+            cursor.close()
+    
+    def get_results_page(self, survey_id: Optional[int] = None, municipality: Optional[int] = None,
+                         category: Optional[int] = None, after: Optional[Tuple[int, int]] = None,
+                         before: Optional[Tuple[int, int]] = None, limit: int = 10) -> Dict[str, Any]:
+        """Страница списка участников опроса в порядке (муниципалитет, user_id).
+
+        Вместо смещения страница задаётся курсором: after - (код муниципалитета,
+        user_id) последнего участника предыдущей страницы, before - первого
+        участника следующей. municipality и category - коды вариантов для
+        фильтра. Страница читается из диапазона индекса idx_responses_municipality
+        или idx_responses_category не дальше limit + 1 строк, поэтому время не
+        зависит от числа анкет. Возвращает участников (user_id, муниципалитет,
+        категория), курсоры первой и последней строки и признаки соседних страниц.
+        """
+        conditions = ["survey_id = ?"]
+        params = [self._survey(survey_id)]
+        if municipality is not None:
+            conditions.append("municipality_code = ?")
+            params.append(municipality)
+        if category is not None:
+            conditions.append("category_code = ?")
+            params.append(category)
+        backward = before is not None
+        cursor = before if backward else after
+        if cursor is not None:
+            if municipality is not None:
+                # Муниципалитет задан фильтром: курсор - только user_id, иначе SQLite
+                # ищет по диапазону пары и сортирует найденное заново
+                conditions.append(f"user_id {'<' if backward else '>'} ?")
+                params.append(cursor[1])
+            else:
+                conditions.append(f"(municipality_code, user_id) {'<' if backward else '>'} (?, ?)")
+                params.extend(cursor)
+        order = "DESC" if backward else "ASC"
+        try:
+            self.cursor.execute(
+                "SELECT user_id, municipality_code, category_code FROM responses "
+                f"WHERE {' AND '.join(conditions)} "
+                f"ORDER BY municipality_code {order}, user_id {order} LIMIT ?",
+                [*params, limit + 1]
+            )
+            rows = [tuple(row) for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при получении списка участников: {e}")
+            return {'items': [], 'first': None, 'last': None, 'has_prev': False, 'has_next': False}
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return {
+            'items': [
+                (
+                    user_id,
+                    self._option_label('municipality', municipality_code) if municipality_code else NOT_SPECIFIED,
+                    self._option_label('category', category_code) if category_code else NOT_SPECIFIED
+                )
+                for user_id, municipality_code, category_code in rows
+            ],
+            'first': (rows[0][1], rows[0][0]) if rows else None,
+            'last': (rows[-1][1], rows[-1][0]) if rows else None,
+            # Курсор сам указывает на строку соседней страницы
+            'has_prev': more if backward else after is not None,
+            'has_next': before is not None if backward else more
+        }
+    
+    def get_option_codes(self, field: str) -> List[Tuple[int, str]]:
+        """Варианты ответа на вопрос (код, текст) в порядке кодов"""
+        return sorted(self._option_labels.get(field, {}).items())
+    
+    def search_education_org(self, text: str, survey_id: Optional[int] = None, after: Optional[int] = None,
+                             before: Optional[int] = None, limit: int = 10) -> Optional[Dict[str, Any]]:
+        """Страница анкет, в названии учебного заведения которых есть все слова text.
+        
+        Запрос и названия нормализуются одинаково (см. search.py), поиск идёт по
+        индексу FTS5 в порядке номеров его строк; after и before - номер строки
+        последнего участника предыдущей страницы и первого участника следующей,
+        как в get_results_page. Возвращает участников (user_id, учебное
+        заведение, муниципалитет), курсоры и признаки соседних страниц; None -
+        если поиск недоступен.
+        """
+        empty = {'items': [], 'first': None, 'last': None, 'has_prev': False, 'has_next': False}
+        if not self.search_enabled:
             return None
+        expression = org_match_query(text)
+        if expression is None:
+            return empty
+        conditions = ["org_search MATCH ?"]
+        params = [self._field_id(SEARCH_FIELD), f"survey : s{self._survey(survey_id)} AND org : ({expression})"]
+        backward = before is not None
+        cursor = before if backward else after
+        if cursor is not None:
+            conditions.append(f"s.rowid {'<' if backward else '>'} ?")
+            params.append(cursor)
+        try:
+            self.cursor.execute(
+                "SELECT s.rowid, m.user_id, a.text, r.municipality_code FROM org_search AS s "
+                "JOIN org_search_rows AS m ON m.id = s.rowid "
+                "LEFT JOIN answers AS a ON a.survey_id = m.survey_id AND a.user_id = m.user_id AND a.field_id = ? "
+                "LEFT JOIN responses AS r ON r.survey_id = m.survey_id AND r.user_id = m.user_id "
+                f"WHERE {' AND '.join(conditions)} ORDER BY s.rowid {'DESC' if backward else 'ASC'} LIMIT ?",
+                [*params, limit + 1]
+            )
+            rows = [tuple(row) for row in self.cursor.fetchall()]
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при поиске по учебным заведениям: {e}")
+            return empty
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return {
+            'items': [
+                (
+                    user_id,
+                    org or '',
+                    self._option_label('municipality', municipality_code) if municipality_code else NOT_SPECIFIED
+                )
+                for _, user_id, org, municipality_code in rows
+            ],
+            'first': rows[0][0] if rows else None,
+            'last': rows[-1][0] if rows else None,
+            'has_prev': more if backward else after is not None,
+            'has_next': before is not None if backward else more
+        }
+    
+    def get_result_by_user_id(self, user_id: int, survey_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Получение результатов опроса конкретного пользователя.
+        
+        Пока прежняя таблица переносится, не перенесённые ещё результаты первого
+        опроса читаются из неё.
+        """
+        survey_id = self._survey(survey_id)
+        try:
+            result = self._current_results([(survey_id, user_id)]).get((survey_id, user_id))
+            if result is None and survey_id == self.default_survey_id and self._legacy_active():
+                result = self._legacy_result(user_id)
+            return result
         except sqlite3.Error as e:
             logging.error(f"Ошибка при получении результатов пользователя {user_id}: {e}")
             return None
     
-    def get_statistics(self) -> Dict[str, Any]:
-        """Получение статистики по опросу"""
+    def get_statistics(self, survey_id: Optional[int] = None) -> Dict[str, Any]:
+        """Получение статистики по опросу из накопленных счётчиков"""
         try:
-            stats = {
+            self.cursor.execute(
+                "SELECT section, value, count FROM survey_stats WHERE survey_id = ?", (self._survey(survey_id),)
+            )
+            return statistics_from_counters(
+                (row['section'], row['value'], row['count']) for row in self.cursor.fetchall()
+            )
+        except Exception as e:
+            logging.error(f"Ошибка при получении статистики: {e}")
+            return {
                 'total_users': 0,
-                'municipalities': {},
-                'categories': {},
-                'knows_movement': {'Да': 0, 'Нет': 0, 'Не указано': 0},
-                'is_participant': {'Да': 0, 'Нет': 0, 'Не указано': 0},
-                'knows_curator': {'Да': 0, 'Нет': 0, 'Не указано': 0},
-                'knows_kosa': {'Да': 0, 'Нет': 0, 'Не указано': 0},
-                'selected_directions': {},
-                'region_rating': {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0, 'Не указано': 0},
-                'organization_rating': {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0, 'Не указано': 0},
-                'student_government_rating': {'1': 0, '2': 0, '3': 0, '4': 0, '5': 0, 'Не указано': 0}
+                'error': str(e)
             }
-            
-            # Получаем все результаты
-            results = self.get_all_results()
-            stats['total_users'] = len(results)
-            
-            # Анализируем каждый результат
-            for result in results:
-                # Муниципалитеты
-                municipality = result.get('municipality', 'Не указано')
-                stats['municipalities'][municipality] = stats['municipalities'].get(municipality, 0) + 1
-                
-                # Категории
-                category = result.get('category', 'Не указано')
-                stats['categories'][category] = stats['categories'].get(category, 0) + 1
-                
-                # Знание о движении
-                knows = result.get('knows_movement', 'Не указано')
-                if knows and knows in stats['knows_movement']:
-                    stats['knows_movement'][knows] += 1
-                else:
-                    stats['knows_movement']['Не указано'] += 1
-                
-                # Участие в движении
-                participant = result.get('is_participant', 'Не указано')
-                if participant and participant in stats['is_participant']:
-                    stats['is_participant'][participant] += 1
-                else:
-                    stats['is_participant']['Не указано'] += 1
-                
-                # Знание куратора
-                curator = result.get('knows_curator', 'Не указано')
-                if curator and curator in stats['knows_curator']:
-                    stats['knows_curator'][curator] += 1
-                else:
-                    stats['knows_curator']['Не указано'] += 1
-                
-                # Направления
-                directions = result.get('selected_directions', [])
-                if isinstance(directions, list):
-                    for direction in directions:
-                        stats['selected_directions'][direction] = stats['selected_directions'].get(direction, 0) + 1
-                
-                # Рейтинги
-                region = result.get('region_rating', 'Не указано')
-                if region and region in stats['region_rating']:
-                    stats['region_rating'][region] += 1
-                else:
-                    stats['region_rating']['Не указано'] += 1
-                
-                org = result.get('organization_rating', 'Не указано')
-                if org and org in stats['organization_rating']:
-                    stats['organization_rating'][org] += 1
-                else:
-                    stats['organization_rating']['Не указано'] += 1
-                
-                # Рейтинг студенческого самоуправления
-                student_gov = result.get('student_government_rating', 'Не указано')
-                if student_gov and student_gov in stats['student_government_rating']:
-                    stats['student_government_rating'][student_gov] += 1
-                else:
-                    stats['student_government_rating']['Не указано'] += 1
-                
-                # Знание о молодежном центре "Коса"
-                kosa = result.get('knows_kosa', 'Не указано')
-                if kosa and kosa in stats['knows_kosa']:
-                    stats['knows_kosa'][kosa] += 1
-                else:
-                    stats['knows_kosa']['Не указано'] += 1
-            
-            return stats
+    
+    def get_statistics_sql(self, survey_id: Optional[int] = None) -> Dict[str, Any]:
+        """Получение статистики агрегирующим запросом по ответам опроса"""
+        try:
+            return statistics_from_counters(
+                (section, value, count) for (section, value), count in self._count_statistics(survey_id).items()
+            )
         except Exception as e:
             logging.error(f"Ошибка при получении статистики: {e}")
             return {
@@ -273,19 +1155,550 @@ class Database:
                 'error': str(e)
             }
     
-    def delete_result(self, user_id: int) -> bool:
+    def _count_statistics(self, survey_id: Optional[int] = None) -> Counter:
+        """Подсчёт счётчиков статистики опроса по его ответам.
+
+        Ответы группируются по (поле, код) средствами SQLite по покрывающему
+        индексу idx_answers_field; в Python разбирается только несколько сотен
+        групп. Результат совпадает с суммой statistics_keys по всем анкетам.
+        """
+        survey_id = self._survey(survey_id)
+        self.cursor.execute("SELECT COUNT(*) FROM responses WHERE survey_id = ?", (survey_id,))
+        total = self.cursor.fetchone()[0]
+        
+        stats_fields = [*OPTION_SECTIONS, *YES_NO_FIELDS, *RATING_FIELDS, MASK_FIELD]
+        field_ids = [self._field_id(field) for field in stats_fields]
+        placeholders = ", ".join("?" * len(field_ids))
+        groups = {field: [] for field in stats_fields}
+        for field_id, code, count in self.conn.execute(
+            f"SELECT field_id, code, COUNT(*) FROM answers WHERE survey_id = ? AND field_id IN ({placeholders}) "
+            f"GROUP BY field_id, code",
+            [survey_id, *field_ids]
+        ):
+            groups[self._field_name(field_id)].append((code, count))
+        
+        counters = Counter()
+        counters[('total_users', '')] = total
+        for field, section in OPTION_SECTIONS.items():
+            for code, count in groups[field]:
+                counters[(section, self._option_label(field, code) or NOT_SPECIFIED)] += count
+            counters[(section, NOT_SPECIFIED)] += total - sum(count for _, count in groups[field])
+        for field in YES_NO_FIELDS:
+            for code, count in groups[field]:
+                label = self._option_label(field, code)
+                counters[(field, label if label in YES_NO_VALUES else NOT_SPECIFIED)] += count
+            counters[(field, NOT_SPECIFIED)] += total - sum(count for _, count in groups[field])
+        for field in RATING_FIELDS:
+            for code, count in groups[field]:
+                counters[(field, str(code) if str(code) in RATING_VALUES else NOT_SPECIFIED)] += count
+            counters[(field, NOT_SPECIFIED)] += total - sum(count for _, count in groups[field])
+        for mask, count in groups[MASK_FIELD]:
+            for idx in range(len(directions)):
+                if mask >> idx & 1:
+                    counters[(MASK_FIELD, str(idx))] += count
+        # Нулевые счётчики не хранятся
+        return +counters
+    
+    def _apply_statistics_delta(self, delta: Counter):
+        """Применение изменений счётчиков (опрос, раздел, значение) внутри текущей транзакции"""
+        changes = [(survey_id, section, value, count) for (survey_id, section, value), count in delta.items() if count]
+        if not changes:
+            return
+        self.cursor.executemany('''
+        INSERT INTO survey_stats (survey_id, section, value, count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(survey_id, section, value) DO UPDATE SET count = count + excluded.count
+        ''', changes)
+        # Обнулившиеся счётчики ищем только среди изменённых, без просмотра всей таблицы
+        self.cursor.executemany(
+            "DELETE FROM survey_stats WHERE survey_id = ? AND section = ? AND value = ? AND count = 0",
+            [change[:3] for change in changes]
+        )
+    
+    def rebuild_statistics(self, survey_id: Optional[int] = None) -> bool:
+        """Пересчёт счётчиков статистики опроса (без survey_id - всех опросов)"""
+        try:
+            if survey_id is None:
+                self.cursor.execute("SELECT id FROM surveys")
+                survey_ids = [row['id'] for row in self.cursor.fetchall()]
+            else:
+                survey_ids = [survey_id]
+            for current_id in survey_ids:
+                counters = self._count_statistics(current_id)
+                self.cursor.execute("DELETE FROM survey_stats WHERE survey_id = ?", (current_id,))
+                self._apply_statistics_delta(Counter({
+                    (current_id, section, value): count for (section, value), count in counters.items()
+                }))
+            self.conn.commit()
+            logging.info("Счётчики статистики пересчитаны")
+            return True
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.error(f"Ошибка при пересчёте статистики: {e}")
+            return False
+    
+    def reconcile_statistics(self, survey_id: Optional[int] = None) -> Dict[str, Any]:
+        """Сверка счётчиков статистики с результатами опроса.
+
+        Возвращает расхождения в виде {(раздел, значение): (в счётчиках, по данным)}.
+        Если расхождения найдены, счётчики пересчитываются.
+        """
+        survey_id = self._survey(survey_id)
+        try:
+            expected = self._count_statistics(survey_id)
+            self.cursor.execute("SELECT section, value, count FROM survey_stats WHERE survey_id = ?", (survey_id,))
+            actual = Counter({(row['section'], row['value']): row['count'] for row in self.cursor.fetchall()})
+            
+            mismatches = {
+                key: (actual.get(key, 0), expected.get(key, 0))
+                for key in set(actual) | set(expected)
+                if actual.get(key, 0) != expected.get(key, 0)
+            }
+            if mismatches:
+                logging.warning("Найдены расхождения в счётчиках статистики: %s", len(mismatches))
+                self.rebuild_statistics(survey_id)
+            
+            return {
+                'total_users': expected.get(('total_users', ''), 0),
+                'mismatches': mismatches
+            }
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при сверке статистики: {e}")
+            return {
+                'total_users': 0,
+                'error': str(e)
+            }
+    
+    def delete_result(self, user_id: int, survey_id: Optional[int] = None) -> bool:
         """Удаление результатов опроса пользователя"""
+        survey_id = self._survey(survey_id)
         try:
-            self.cursor.execute("DELETE FROM survey_results WHERE user_id = ?", (user_id,))
+            existing = self._current_results([(survey_id, user_id)])
+            if (survey_id, user_id) in existing:
+                self.cursor.execute(DELETE_ANSWERS_SQL, (survey_id, user_id))
+                self.cursor.execute("DELETE FROM responses WHERE survey_id = ? AND user_id = ?", (survey_id, user_id))
+                if self.search_enabled:
+                    self.cursor.execute(DELETE_SEARCH_SQL, (survey_id, user_id))
+                self._apply_statistics_delta(Counter({
+                    (survey_id,) + key: -1 for key in statistics_keys(existing[(survey_id, user_id)])
+                }))
+            if survey_id == self.default_survey_id and self._legacy_active():
+                # Иначе перенос вернёт удалённые результаты из прежней таблицы
+                self.cursor.execute("DELETE FROM main.survey_results WHERE user_id = ?", (user_id,))
             self.conn.commit()
-            logging.info(f"Результаты пользователя {user_id} успешно удалены")
+            logging.info("Результаты пользователя %s успешно удалены", user_id, extra={'user_id': user_id})
             return True
         except sqlite3.Error as e:
+            self.conn.rollback()
             logging.error(f"Ошибка при удалении результатов пользователя {user_id}: {e}")
             return False
     
+    def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        """Сохранённые состояния диалога name: ключ диалога -> состояние"""
+        try:
+            self.cursor.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+            return {tuple(json.loads(row['key'])): row['state'] for row in self.cursor.fetchall()}
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при загрузке состояний диалога {name}: {e}")
+            return {}
+    
+    def save_conversations(self, name: str, states: List[Tuple[Tuple, Any]],
+                           drafts: List[Tuple[int, Optional[Dict[str, Any]]]]) -> bool:
+        """Запись состояний диалога и незавершённых анкет одной транзакцией.
+
+        Состояние None удаляет диалог, анкета None - удаляет незавершённую анкету.
+        """
+        try:
+            self.cursor.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, json.dumps(list(key))) for key, state in states if state is None]
+            )
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, json.dumps(list(key)), state) for key, state in states if state is not None]
+            )
+            self.cursor.executemany(
+                "DELETE FROM survey_drafts WHERE user_id = ?",
+                [(user_id,) for user_id, data in drafts if data is None]
+            )
+            self.cursor.executemany(
+                '''
+                INSERT INTO survey_drafts (user_id, data) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+                ''',
+                [(user_id, json.dumps(data, ensure_ascii=False)) for user_id, data in drafts if data is not None]
+            )
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.error(f"Ошибка при сохранении состояний диалога {name}: {e}")
+            return False
+    
+    def save_funnel_events(self, events: List[Tuple[Optional[int], int, int, float]]) -> bool:
+        """Запись пакета переходов (опрос, user_id, новое состояние, время) одной транзакцией.
+
+        Предыдущее состояние и время на нём берутся из funnel_positions (и из
+        предыдущих переходов того же пакета). Повтор текущего состояния не
+        записывается; опрос None - опрос, в котором респондент находится сейчас.
+        Вместе с журналом обновляются сводки funnel_steps и funnel_durations.
+        """
+        try:
+            positions = {}
+            rows = []
+            reached = []
+            current = Counter()
+            durations = Counter()
+            for survey_id, user_id, state, at in events:
+                if user_id not in positions:
+                    self.cursor.execute("SELECT survey_id, state, at FROM funnel_positions WHERE user_id = ?", (user_id,))
+                    row = self.cursor.fetchone()
+                    positions[user_id] = tuple(row) if row is not None else None
+                position = positions[user_id]
+                if survey_id is None:
+                    if position is None:
+                        continue
+                    survey_id = position[0]
+                from_state = duration = None
+                if position is not None:
+                    if position[:2] == (survey_id, state):
+                        continue
+                    current[(position[0], position[1])] -= 1
+                    if position[0] == survey_id:
+                        from_state, duration = position[1], max(at - position[2], 0.0)
+                        durations[(survey_id, from_state, funnel_bucket(duration))] += 1
+                rows.append((survey_id, user_id, from_state, state, at, duration))
+                reached.append((survey_id, state, user_id))
+                if state >= 0:
+                    current[(survey_id, state)] += 1
+                    positions[user_id] = (survey_id, state, at)
+                else:
+                    # Опрос завершён или отменён: респондент больше ни на каком вопросе
+                    positions[user_id] = None
+            
+            self.cursor.executemany(
+                "INSERT INTO funnel_events (survey_id, user_id, from_state, to_state, at, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            reached_delta = Counter()
+            for key in reached:
+                self.cursor.execute("INSERT OR IGNORE INTO funnel_reached (survey_id, state, user_id) VALUES (?, ?, ?)", key)
+                if self.cursor.rowcount:
+                    reached_delta[key[:2]] += 1
+            self.cursor.executemany(
+                "INSERT INTO funnel_steps (survey_id, state, reached, current) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(survey_id, state) DO UPDATE SET "
+                "reached = reached + excluded.reached, current = current + excluded.current",
+                [(*key, reached_delta[key], current[key]) for key in set(reached_delta) | set(current)]
+            )
+            self.cursor.executemany(
+                "INSERT INTO funnel_durations (survey_id, state, bucket, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(survey_id, state, bucket) DO UPDATE SET count = count + excluded.count",
+                [(*key, count) for key, count in durations.items()]
+            )
+            self.cursor.executemany(
+                "INSERT INTO funnel_positions (user_id, survey_id, state, at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET survey_id = excluded.survey_id, state = excluded.state, at = excluded.at",
+                [(user_id, *position) for user_id, position in positions.items() if position is not None]
+            )
+            self.cursor.executemany(
+                "DELETE FROM funnel_positions WHERE user_id = ?",
+                [(user_id,) for user_id, position in positions.items() if position is None]
+            )
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.error(f"Ошибка при записи переходов воронки: {e}")
+            return False
+    
+    def get_funnel(self, survey_id: Optional[int] = None) -> Dict[int, Dict[str, Any]]:
+        """Воронка опроса: состояние -> {дошли, остаются сейчас, переходов с него, медиана времени на нём}.
+
+        Читаются только сводки опроса (по первичному ключу), поэтому время не
+        зависит от размера журнала переходов. Медиана оценивается по гистограмме.
+        """
+        survey_id = self._survey(survey_id)
+        try:
+            self.cursor.execute("SELECT state, reached, current FROM funnel_steps WHERE survey_id = ?", (survey_id,))
+            funnel = {
+                row['state']: {'reached': row['reached'], 'current': row['current'], 'left': 0, 'median': None}
+                for row in self.cursor.fetchall()
+            }
+            self.cursor.execute(
+                "SELECT state, bucket, count FROM funnel_durations WHERE survey_id = ? ORDER BY state, bucket",
+                (survey_id,)
+            )
+            histograms = {}
+            for row in self.cursor.fetchall():
+                histograms.setdefault(row['state'], []).append((row['bucket'], row['count']))
+            for state, buckets in histograms.items():
+                total = sum(count for _, count in buckets)
+                cumulative = 0
+                for bucket, count in buckets:
+                    cumulative += count
+                    if cumulative * 2 >= total:
+                        break
+                step = funnel.setdefault(state, {'reached': 0, 'current': 0, 'left': 0, 'median': None})
+                step['left'] = total
+                step['median'] = funnel_bucket_value(bucket)
+            return funnel
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при получении воронки опроса: {e}")
+            return {}
+    
+    def get_draft(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Незавершённая анкета пользователя"""
+        try:
+            self.cursor.execute("SELECT data FROM survey_drafts WHERE user_id = ?", (user_id,))
+            row = self.cursor.fetchone()
+            return json.loads(row['data']) if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при получении незавершённой анкеты пользователя {user_id}: {e}")
+            return None
+    
     def close(self):
         """Закрытие соединения с базой данных"""
         if self.conn:
             self.conn.close()
-            logging.info("Соединение с базой данных закрыто") 
\ No newline at end of file
+            logging.info("Соединение с базой данных закрыто") 
+
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database.
+
+    Все обращения к SQLite выполняются в отдельном потоке, поэтому медленный
+    диск не блокирует цикл событий бота и не задерживает других пользователей.
+    Набор методов совпадает с Database, но методы нужно вызывать через await.
+
+    Сохранения результатов копятся в очереди и записываются одной транзакцией
+    раз в batch_delay секунд или при накоплении batch_size записей.
+    save_survey_result возвращает управление только после фиксации транзакции.
+    """
+    
+    def __init__(self, db_name="survey_bot.db", batch_delay: float = 0.05, batch_size: int = 100,
+                 surveys: Optional[List[Dict[str, Any]]] = None):
+        """Создание потока для работы с БД, подключение к базе данных и регистрация опросов"""
+        self.db_name = db_name
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.surveys = surveys
+        # Один поток: соединение SQLite используется только из него
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self.db = self._executor.submit(Database, db_name, False, surveys).result()
+        # Ожидающие записи: (опрос, user_id, данные, future для ответа пользователю)
+        self._pending = []
+        self._flush_handle = None
+        self._flush_tasks = set()
+    
+    async def _run(self, func, *args):
+        """Выполнение метода Database в потоке базы данных (время - в показатель survey_bot_db_seconds)"""
+        loop = asyncio.get_running_loop()
+        if not REGISTRY.enabled:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+        finally:
+            DB_SECONDS.labels(func.__name__).observe(time.perf_counter() - started)
+    
+    def survey_id(self, name: str, wave: int = 1) -> Optional[int]:
+        """Номер зарегистрированного опроса (волны)"""
+        return self.db.survey_ids.get((name, wave))
+    
+    async def save_survey_result(self, user_id: int, data: Dict[str, Any], survey_id: Optional[int] = None) -> bool:
+        """Постановка результатов в очередь и ожидание фиксации пакета"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Копируем ответы: пользователь может начать опрос заново до записи пакета
+        self._pending.append((self.db._survey(survey_id), user_id, copy.deepcopy(data), future))
+        
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_delay, self._start_flush)
+        
+        # Время от постановки в очередь до фиксации пакета
+        started = time.perf_counter()
+        try:
+            return await future
+        finally:
+            if REGISTRY.enabled:
+                DB_SECONDS.labels('save_survey_result').observe(time.perf_counter() - started)
+    
+    def _start_flush(self):
+        """Запуск записи накопленного пакета"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._flush_batch(batch))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+    
+    async def _flush_batch(self, batch):
+        """Запись пакета одной транзакцией и уведомление ожидающих обработчиков"""
+        items = [(survey_id, user_id, data) for survey_id, user_id, data, _ in batch]
+        try:
+            if await self._run(self.db.save_responses, items):
+                results = [True] * len(items)
+            elif len(items) > 1:
+                # Пакет откатился целиком: сохраняем записи по одной, чтобы
+                # ошибка в одной записи не затронула остальных пользователей
+                results = await self._run(self._save_each, items)
+            else:
+                results = [False]
+        except Exception as e:
+            logging.error(f"Ошибка при записи пакета результатов: {e}")
+            results = [False] * len(items)
+        
+        for (_, _, _, future), saved in zip(batch, results):
+            if not future.done():
+                future.set_result(saved)
+    
+    def _save_each(self, items: List[Tuple[int, int, Dict[str, Any]]]) -> List[bool]:
+        """Сохранение записей по одной (выполняется в потоке базы данных)"""
+        return [self.db.save_responses([item]) for item in items]
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Показатели очереди записи"""
+        return {
+            'pending': len(self._pending),
+            'flushing': len(self._flush_tasks)
+        }
+    
+    async def flush(self):
+        """Немедленная запись всех ожидающих результатов"""
+        self._start_flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks)
+    
+    async def get_all_results(self, survey_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Получение всех результатов опроса"""
+        return await self._run(self.db.get_all_results, survey_id)
+    
+    async def get_surveys(self) -> List[Dict[str, Any]]:
+        """Зарегистрированные опросы с текущей версией и числом анкет"""
+        return await self._run(self.db.get_surveys)
+    
+    async def stream_results(self, consumer, chunk_size: int = 1000, survey_id: Optional[int] = None):
+        """Передача всех результатов в consumer без загрузки их в память целиком.
+
+        consumer получает итератор результатов и выполняется в отдельном потоке
+        с собственным соединением только для чтения, поэтому долгая выборка не
+        задерживает ни цикл событий, ни запись результатов. Возвращает то, что
+        вернул consumer.
+        """
+        survey_id = self.db._survey(survey_id)
+        
+        def run():
+            reader = Database(self.db_name, read_only=True, surveys=self.surveys)
+            try:
+                return consumer(reader.iter_results(chunk_size, survey_id))
+            finally:
+                reader.close()
+        
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(None, run)
+        finally:
+            if REGISTRY.enabled:
+                DB_SECONDS.labels('stream_results').observe(time.perf_counter() - started)
+    
+    async def get_results_page(self, survey_id: Optional[int] = None, municipality: Optional[int] = None,
+                               category: Optional[int] = None, after: Optional[Tuple[int, int]] = None,
+                               before: Optional[Tuple[int, int]] = None, limit: int = 10) -> Dict[str, Any]:
+        """Страница списка участников опроса по курсору"""
+        return await self._run(self.db.get_results_page, survey_id, municipality, category, after, before, limit)
+    
+    async def get_option_codes(self, field: str) -> List[Tuple[int, str]]:
+        """Варианты ответа на вопрос (код, текст) в порядке кодов"""
+        return await self._run(self.db.get_option_codes, field)
+    
+    async def search_education_org(self, text: str, survey_id: Optional[int] = None, after: Optional[int] = None,
+                                   before: Optional[int] = None, limit: int = 10) -> Optional[Dict[str, Any]]:
+        """Страница анкет, найденных по названию учебного заведения"""
+        return await self._run(self.db.search_education_org, text, survey_id, after, before, limit)
+    
+    async def get_result_by_user_id(self, user_id: int, survey_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Получение результатов опроса конкретного пользователя"""
+        return await self._run(self.db.get_result_by_user_id, user_id, survey_id)
+    
+    async def get_statistics(self, survey_id: Optional[int] = None) -> Dict[str, Any]:
+        """Получение статистики по опросу"""
+        return await self._run(self.db.get_statistics, survey_id)
+    
+    async def get_statistics_sql(self, survey_id: Optional[int] = None) -> Dict[str, Any]:
+        """Получение статистики агрегирующим запросом по ответам опроса"""
+        return await self._run(self.db.get_statistics_sql, survey_id)
+    
+    async def delete_result(self, user_id: int, survey_id: Optional[int] = None) -> bool:
+        """Удаление результатов опроса пользователя"""
+        return await self._run(self.db.delete_result, user_id, survey_id)
+    
+    async def reconcile_statistics(self, survey_id: Optional[int] = None) -> Dict[str, Any]:
+        """Сверка счётчиков статистики с результатами опроса"""
+        return await self._run(self.db.reconcile_statistics, survey_id)
+    
+    async def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        """Сохранённые состояния диалога"""
+        return await self._run(self.db.get_conversations, name)
+    
+    async def save_conversations(self, name: str, states: List[Tuple[Tuple, Any]],
+                                 drafts: List[Tuple[int, Optional[Dict[str, Any]]]]) -> bool:
+        """Запись состояний диалога и незавершённых анкет одной транзакцией"""
+        return await self._run(self.db.save_conversations, name, states, drafts)
+    
+    async def save_funnel_events(self, events: List[Tuple[Optional[int], int, int, float]]) -> bool:
+        """Запись пакета переходов воронки одной транзакцией"""
+        return await self._run(self.db.save_funnel_events, events)
+    
+    async def get_funnel(self, survey_id: Optional[int] = None) -> Dict[int, Dict[str, Any]]:
+        """Воронка опроса по сводкам переходов"""
+        return await self._run(self.db.get_funnel, survey_id)
+    
+    async def get_draft(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Незавершённая анкета пользователя"""
+        return await self._run(self.db.get_draft, user_id)
+    
+    @property
+    def legacy_pending(self) -> bool:
+        """Не завершён ли перенос прежней таблицы survey_results"""
+        return self.db.legacy_pending
+    
+    async def migrate_legacy_results(self, chunk_size: int = 1000, pause: float = 0.01) -> int:
+        """Перенос прежней таблицы порциями в потоке БД; между порциями выполняются остальные запросы"""
+        migrated = 0
+        while True:
+            count = await self._run(self.db.migrate_legacy_chunk, chunk_size)
+            if not count:
+                return migrated
+            migrated += count
+            await asyncio.sleep(pause)
+    
+    async def aclose(self):
+        """Запись ожидающих результатов и закрытие соединения"""
+        await self.flush()
+        self.close()
+    
+    def close(self):
+        """Синхронная запись ожидающих результатов, закрытие соединения и остановка потока"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        batch, self._pending = self._pending, []
+        try:
+            if batch:
+                items = [(survey_id, user_id, data) for survey_id, user_id, data, _ in batch]
+                saved = self._executor.submit(self.db.save_responses, items).result()
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_result(saved)
+            self._executor.submit(self.db.close).result()
+        except RuntimeError:
+            # Поток уже остановлен, соединение закрыто ранее
+            return
+        self._executor.shutdown(wait=True)
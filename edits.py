@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from telegram import InlineKeyboardMarkup, Message
+from telegram.error import BadRequest, TelegramError
+
+
+class EditCoalescer:
+    """Объединение быстрых правок одного сообщения в одну.
+
+    Правка сообщения не отправляется сразу: в течение delay секунд после
+    первой правки последующие только заменяют её текст и клавиатуру, после
+    чего отправляется одна правка с последним состоянием. Правка, которая не
+    меняет сообщение (например, направление выбрали и сразу отменили),
+    не отправляется вовсе. Правки одного сообщения отправляются по очереди.
+    """
+
+    def __init__(self, delay: float = 0.3):
+        """Инициализация; delay - сколько секунд собирать правки сообщения"""
+        self.delay = delay
+        # (chat_id, message_id) -> [бот, текст, клавиатура, текущее содержимое сообщения]
+        self._pending = {}
+        # (chat_id, message_id) -> задача, ожидающая отправки правки
+        self._tasks = {}
+        # (chat_id, message_id) -> задача, отправляющая правку прямо сейчас
+        self._sending = {}
+        self.requested = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.sent = 0
+        self.errors = 0
+
+    def edit(self, message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Запрос правки сообщения: она будет отправлена не позже чем через delay секунд"""
+        key = (message.chat_id, message.message_id)
+        self.requested += 1
+        entry = self._pending.get(key)
+        # Содержимое сообщения, с которым пользователь нажал кнопку
+        shown = (message.text, message.reply_markup)
+        if entry is not None:
+            self.coalesced += 1
+            entry[1:] = [text, reply_markup, shown]
+            return
+        self._pending[key] = [message.get_bot(), text, reply_markup, shown]
+        self._tasks[key] = asyncio.create_task(self._send_later(key))
+
+    async def discard(self, message: Message):
+        """Отмена неотправленной правки сообщения и ожидание уже отправляемой.
+
+        Вызывается перед тем, как сообщение меняется иначе, чтобы запоздавшая
+        правка не вернула прежнюю клавиатуру.
+        """
+        key = (message.chat_id, message.message_id)
+        if self._pending.pop(key, None) is not None:
+            task = self._tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+        sending = self._sending.get(key)
+        if sending is not None:
+            await asyncio.wait({sending})
+
+    async def flush(self):
+        """Немедленная отправка всех собранных правок (при остановке бота)"""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        if self._sending:
+            await asyncio.wait(set(self._sending.values()))
+        await asyncio.gather(*(self._send(key) for key in list(self._pending)))
+
+    async def _send_later(self, key: Tuple[int, int]):
+        """Отправка правки по истечении delay секунд"""
+        try:
+            await asyncio.sleep(self.delay)
+            sending = self._sending.get(key)
+            if sending is not None:
+                # Предыдущая правка этого сообщения ещё отправляется
+                await asyncio.wait({sending})
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+        self._sending[key] = asyncio.current_task()
+        try:
+            await self._send(key)
+        finally:
+            del self._sending[key]
+
+    async def _send(self, key: Tuple[int, int]):
+        """Отправка последней запрошенной правки сообщения"""
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        bot, text, reply_markup, shown = entry
+        if (text, reply_markup) == shown:
+            self.skipped += 1
+            return
+        try:
+            await bot.edit_message_text(text, chat_id=key[0], message_id=key[1], reply_markup=reply_markup)
+            self.sent += 1
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                self.skipped += 1
+            else:
+                self.errors += 1
+                logging.error(f"Ошибка при изменении сообщения {key[1]} в чате {key[0]}: {e}")
+        except TelegramError as e:
+            self.errors += 1
+            logging.error(f"Ошибка при изменении сообщения {key[1]} в чате {key[0]}: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Показатели работы"""
+        return {
+            'pending': len(self._pending),
+            'requested': self.requested,
+            'coalesced': self.coalesced,
+            'skipped': self.skipped,
+            'sent': self.sent,
+            'errors': self.errors
+        }
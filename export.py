@@ -0,0 +1,228 @@
+import csv
+import gzip
+import io
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Any, Tuple
+
+from survey import FIELDS, RATING_SHIFTS, directions
+
+# Необязательные зависимости для дополнительных форматов экспорта
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Заголовки CSV
+EXPORT_HEADERS = [
+    "ID пользователя", "Муниципалитет", "Категория", "Образовательная организация", "Знает о Движении",
+    "Участник Движения", "Знает куратора", "Направления",
+    "Оценка региона", "Оценка организации", "Оценка студенческого самоуправления",
+    "Знает о Молодежном центре \"Коса\"", "Дата и время"
+]
+
+# Файл экспорта держится в памяти, пока не превысит этот размер, затем переносится на диск
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Ограничение Telegram на размер отправляемого ботом файла - 50 МБ, берём с запасом
+TELEGRAM_UPLOAD_LIMIT = 49 * 1024 * 1024
+
+# Количество строк в одном пакете Arrow/Parquet
+COLUMNAR_BATCH_SIZE = 65536
+
+# Колонки со словарным кодированием в Arrow/Parquet: значений мало, а повторяются они часто
+DICTIONARY_COLUMNS = ('municipality', 'category', 'knows_movement', 'is_participant', 'knows_curator',
+                      'knows_kosa', 'selected_directions')
+
+
+def result_to_row(result: Dict[str, Any]) -> List[Any]:
+    """Строка CSV для одного результата опроса"""
+    selected_directions = [directions[idx] for idx in result.get('selected_directions') or []]
+    directions_str = "; ".join(selected_directions)
+
+    return [
+        result['user_id'],
+        result.get('municipality', ''),
+        result.get('category', ''),
+        result.get('education_org', ''),
+        result.get('knows_movement', ''),
+        result.get('is_participant', ''),
+        result.get('knows_curator', ''),
+        directions_str,
+        result.get('region_rating', ''),
+        result.get('organization_rating', ''),
+        result.get('student_government_rating', ''),
+        result.get('knows_kosa', ''),
+        result.get('timestamp', '')
+    ]
+
+
+def _write_csv_rows(results: Iterable[Dict[str, Any]], stream) -> int:
+    """Запись CSV в двоичный поток; возвращает количество записей"""
+    # UTF-8 с BOM для корректного отображения в Excel
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(EXPORT_HEADERS)
+
+    count = 0
+    for result in results:
+        writer.writerow(result_to_row(result))
+        count += 1
+
+    text.flush()
+    text.detach()
+    return count
+
+
+def write_csv(results: Iterable[Dict[str, Any]]) -> Tuple[int, tempfile.SpooledTemporaryFile]:
+    """Потоковая запись результатов в CSV.
+
+    Строки пишутся по одной во временный файл, поэтому расход памяти не зависит
+    от количества результатов. Возвращает количество записей и файл,
+    перемотанный в начало; закрыть файл должен вызывающий код.
+    """
+    export_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    count = _write_csv_rows(results, export_file)
+    export_file.seek(0)
+    return count, export_file
+
+
+def write_csv_gzip(results: Iterable[Dict[str, Any]]) -> Tuple[int, tempfile.SpooledTemporaryFile]:
+    """Потоковая запись результатов в CSV, сжатый gzip"""
+    export_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    with gzip.GzipFile(fileobj=export_file, mode='wb') as compressed:
+        count = _write_csv_rows(results, compressed)
+    export_file.seek(0)
+    return count, export_file
+
+
+def write_csv_zstd(results: Iterable[Dict[str, Any]]) -> Tuple[int, tempfile.SpooledTemporaryFile]:
+    """Потоковая запись результатов в CSV, сжатый zstd"""
+    export_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    with zstandard.ZstdCompressor(level=10).stream_writer(export_file, closefd=False) as compressed:
+        count = _write_csv_rows(results, compressed)
+    export_file.seek(0)
+    return count, export_file
+
+
+def _columnar_schema():
+    """Схема Arrow: категориальные колонки - словари, оценки - числа"""
+    fields = [pyarrow.field('user_id', pyarrow.int64())]
+    for field in FIELDS:
+        if field in DICTIONARY_COLUMNS:
+            fields.append(pyarrow.field(field, pyarrow.dictionary(pyarrow.int16(), pyarrow.string())))
+        elif field in RATING_SHIFTS:
+            fields.append(pyarrow.field(field, pyarrow.int8()))
+        else:
+            fields.append(pyarrow.field(field, pyarrow.string()))
+    fields.append(pyarrow.field('timestamp', pyarrow.string()))
+    return pyarrow.schema(fields)
+
+
+def _columnar_batches(results: Iterable[Dict[str, Any]], schema) -> Iterator:
+    """Пакеты Arrow по COLUMNAR_BATCH_SIZE строк"""
+    columns = {name: [] for name in schema.names}
+
+    def flush():
+        arrays = []
+        for schema_field in schema:
+            values = columns[schema_field.name]
+            if pyarrow.types.is_dictionary(schema_field.type):
+                arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode().cast(schema_field.type))
+            else:
+                arrays.append(pyarrow.array(values, schema_field.type))
+            values.clear()
+        return pyarrow.record_batch(arrays, schema=schema)
+
+    for result in results:
+        columns['user_id'].append(result['user_id'])
+        for field in FIELDS:
+            value = result.get(field)
+            if field == 'selected_directions':
+                value = "; ".join(directions[idx] for idx in value or [])
+            elif field in RATING_SHIFTS:
+                value = int(value) if value else None
+            columns[field].append(value if value != '' else None)
+        columns['timestamp'].append(result.get('timestamp'))
+
+        if len(columns['user_id']) >= COLUMNAR_BATCH_SIZE:
+            yield flush()
+
+    if columns['user_id']:
+        yield flush()
+
+
+def write_arrow(results: Iterable[Dict[str, Any]]) -> Tuple[int, tempfile.SpooledTemporaryFile]:
+    """Запись результатов в поток Apache Arrow IPC.
+
+    Используется потоковый формат IPC: у каждого пакета свой словарь значений,
+    а файловый формат IPC не допускает замену словаря между пакетами.
+    """
+    export_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    schema = _columnar_schema()
+    count = 0
+    with pyarrow.ipc.new_stream(export_file, schema) as writer:
+        for batch in _columnar_batches(results, schema):
+            writer.write_batch(batch)
+            count += batch.num_rows
+    export_file.seek(0)
+    return count, export_file
+
+
+def write_parquet(results: Iterable[Dict[str, Any]]) -> Tuple[int, tempfile.SpooledTemporaryFile]:
+    """Запись результатов в Parquet со сжатием zstd, по группе строк на пакет"""
+    export_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    schema = _columnar_schema()
+    count = 0
+    with pyarrow.parquet.ParquetWriter(export_file, schema, compression='zstd',
+                                       use_dictionary=list(DICTIONARY_COLUMNS)) as writer:
+        for batch in _columnar_batches(results, schema):
+            writer.write_batch(batch)
+            count += batch.num_rows
+    export_file.seek(0)
+    return count, export_file
+
+
+# Форматы экспорта: ключ -> (название, расширение файла, функция записи)
+EXPORT_FORMATS = {
+    'csv': ("CSV", ".csv", write_csv),
+    'csv_gz': ("CSV (gzip)", ".csv.gz", write_csv_gzip),
+}
+if zstandard is not None:
+    EXPORT_FORMATS['csv_zst'] = ("CSV (zstd)", ".csv.zst", write_csv_zstd)
+if pyarrow is not None:
+    EXPORT_FORMATS['arrow'] = ("Apache Arrow", ".arrows", write_arrow)
+    EXPORT_FORMATS['parquet'] = ("Parquet", ".parquet", write_parquet)
+
+
+def iter_parts(export_file, part_size: int = TELEGRAM_UPLOAD_LIMIT) -> Iterator:
+    """Разбиение файла на части не больше part_size байт.
+
+    Файл меньше лимита возвращается как есть. Иначе части по очереди копируются
+    во временные файлы; каждая часть закрывается при переходе к следующей.
+    Исходный файл восстанавливается склейкой частей (cat file.part* > file).
+    """
+    export_file.seek(0, io.SEEK_END)
+    size = export_file.tell()
+    export_file.seek(0)
+    if size <= part_size:
+        yield export_file
+        return
+
+    while export_file.tell() < size:
+        with tempfile.TemporaryFile() as part:
+            remaining = part_size
+            while remaining > 0:
+                chunk = export_file.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                part.write(chunk)
+                remaining -= len(chunk)
+            part.seek(0)
+            yield part
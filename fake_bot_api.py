@@ -0,0 +1,204 @@
+"""Локальная имитация Telegram Bot API для проверки и нагрузочного тестирования бота.
+
+Сервер принимает запросы python-telegram-bot по адресу
+http://127.0.0.1:<port>/bot<token>/<method>, считает вызовы каждого метода
+и отвечает правдоподобными данными с заданной задержкой. Если заданы
+ограничения на число сообщений, при их превышении сервер, как и Telegram,
+отвечает ошибкой 429 с retry_after. Обновления для бота, работающего
+в режиме polling, добавляются через push_update() и отдаются методом
+getUpdates. Бот подключается к серверу через
+Application.builder().base_url(api.base_url).
+"""
+
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from typing import Dict, Any, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+
+class FakeBotAPI:
+    """Имитация Bot API на asyncio без сторонних зависимостей"""
+
+    def __init__(self, latency: float = 0.0, subscribed: Optional[Set[int]] = None,
+                 global_limit: Optional[int] = None, chat_limit: Optional[int] = None, retry_after: int = 1):
+        """Инициализация.
+
+        subscribed - пользователи, подписанные на канал (None - все);
+        global_limit и chat_limit - сколько сообщений в секунду принимается
+        всего и в один чат (None - без ограничений).
+        """
+        self.latency = latency
+        self.subscribed = subscribed
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.flood_errors = 0
+        self._sent = deque()
+        self._sent_by_chat = {}
+        # Сообщения бота по чатам и ожидающие их появления
+        self.chat_messages = Counter()
+        self._message_waiters = {}
+        # Очередь обновлений для getUpdates
+        self._updates = deque()
+        self._updates_added = asyncio.Event()
+        self.server = None
+        self.port = None
+        self._message_id = 0
+        self._connections = set()
+
+    @property
+    def base_url(self) -> str:
+        """Адрес для Application.builder().base_url(...)"""
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self, port: int = 0):
+        """Запуск сервера; при port=0 выбирается свободный порт"""
+        self.server = await asyncio.start_server(self._handle_connection, '127.0.0.1', port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self.server is not None:
+            self.server.close()
+            # Прерываем открытые соединения, в том числе ожидающие getUpdates
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self) -> 'FakeBotAPI':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обработка соединения (keep-alive: несколько запросов подряд)"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                method = path.rstrip('/').rsplit('/', 1)[-1]
+                params = {}
+                if headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+                    params = dict(parse_qsl(body.decode('utf-8')))
+
+                if method == 'getUpdates':
+                    status, response = await self._get_updates(params)
+                else:
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    status, response = self.respond(method, params)
+                payload = json.dumps(response).encode('utf-8')
+
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    def push_update(self, update: Dict[str, Any]):
+        """Добавление обновления в очередь getUpdates"""
+        self._updates.append(update)
+        self._updates_added.set()
+
+    async def _get_updates(self, params: Dict[str, str]) -> Tuple[str, Dict[str, Any]]:
+        """getUpdates с длинным опросом: ждёт обновлений до timeout секунд"""
+        self.calls['getUpdates'] += 1
+        offset = int(params.get('offset', 0))
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), float(params.get('timeout', 0)))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get('limit', 100))
+        return '200 OK', {'ok': True, 'result': list(self._updates)[:limit]}
+
+    async def wait_messages(self, chat_id: int, count: int):
+        """Ожидание, пока бот отправит в чат count сообщений (с начала работы)"""
+        if self.chat_messages[chat_id] >= count:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._message_waiters.setdefault(chat_id, []).append((count, future))
+        await future
+
+    def _message_sent(self, chat_id: int):
+        """Учёт сообщения бота и пробуждение ожидающих"""
+        self.chat_messages[chat_id] += 1
+        waiters = self._message_waiters.get(chat_id)
+        if waiters:
+            for waiter in [waiter for waiter in waiters if waiter[0] <= self.chat_messages[chat_id]]:
+                waiters.remove(waiter)
+                if not waiter[1].done():
+                    waiter[1].set_result(None)
+
+    def _flood_limited(self, chat_id: str) -> bool:
+        """Учёт отправленного сообщения; True - лимит превышен"""
+        now = time.monotonic()
+        chat_sent = self._sent_by_chat.setdefault(chat_id, deque())
+        for sent in (self._sent, chat_sent):
+            while sent and now - sent[0] >= 1.0:
+                sent.popleft()
+        if self.global_limit is not None and len(self._sent) >= self.global_limit:
+            return True
+        if self.chat_limit is not None and len(chat_sent) >= self.chat_limit:
+            return True
+        self._sent.append(now)
+        chat_sent.append(now)
+        return False
+
+    def respond(self, method: str, params: Dict[str, str]) -> Tuple[str, Dict[str, Any]]:
+        """Ответ на вызов метода Bot API: HTTP-статус и тело ответа"""
+        self.calls[method] += 1
+        if method.startswith(('send', 'edit')) and self._flood_limited(params.get('chat_id', '')):
+            self.flood_errors += 1
+            return '429 Too Many Requests', {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Опрос', 'username': 'survey_test_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method == 'getChatMember':
+            user_id = int(params.get('user_id', 0))
+            subscribed = self.subscribed is None or user_id in self.subscribed
+            result = {'status': 'member' if subscribed else 'left',
+                      'user': {'id': user_id, 'is_bot': False, 'first_name': 'Пользователь'}}
+        elif method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument'):
+            self._message_id += 1
+            chat_id = int(params.get('chat_id', 1))
+            self._message_sent(chat_id)
+            result = {'message_id': self._message_id, 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': ''}
+        else:
+            result = True
+        return '200 OK', {'ok': True, 'result': result}
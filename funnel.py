@@ -0,0 +1,92 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Состояния завершения в журнале переходов: анкета сохранена или опрос отменён командой /cancel
+FUNNEL_FINISHED = -1
+FUNNEL_CANCELLED = -2
+
+
+class FunnelLog:
+    """Журнал переходов респондентов между состояниями опроса (воронка).
+
+    record() только добавляет переход в буфер: в базу переходы записываются
+    пакетом одной транзакцией раз в flush_interval секунд или при накоплении
+    batch_size переходов, поэтому журнал не добавляет записи в базу на каждое
+    обновление. Откуда пришёл респондент и сколько времени он провёл на
+    предыдущем вопросе, определяет база данных по последнему сохранённому
+    положению респондента - это верно и после перезапуска бота, и при работе
+    несколькими процессами (пользователя всегда обслуживает один процесс).
+    """
+
+    def __init__(self, db, flush_interval: float = 1.0, batch_size: int = 1000):
+        """Инициализация журнала"""
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # Переходы, ещё не записанные в базу: (опрос, user_id, состояние, время)
+        self._buffer: List[Tuple[Optional[int], int, int, float]] = []
+        self._flush_handle = None
+        self._flush_task = None
+        self.recorded = 0
+        self.written = 0
+        self.failures = 0
+
+    def record(self, user_id: int, survey_id: Optional[int], state: int):
+        """Переход респондента в состояние state опроса survey_id.
+
+        survey_id=None - опрос, в котором респондент находится сейчас (для отмены опроса).
+        """
+        self._buffer.append((survey_id, user_id, state, time.time()))
+        self.recorded += 1
+        if len(self._buffer) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_handle is None and self._flush_task is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        """Запуск записи буфера, если она ещё не идёт"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is None and self._buffer:
+            self._flush_task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self):
+        """Запись накопленных переходов; при ошибке они остаются в буфере до следующей записи"""
+        try:
+            while self._buffer:
+                events, self._buffer = self._buffer, []
+                if not await self.db.save_funnel_events(events):
+                    self.failures += 1
+                    # Переходы сохраняют порядок: неудачный пакет - перед новыми
+                    self._buffer[:0] = events
+                    break
+                self.written += len(events)
+        finally:
+            self._flush_task = None
+            if self._buffer and self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    async def flush(self):
+        """Немедленная запись буфера (при остановке бота)"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._buffer:
+            self._flush_task = asyncio.get_running_loop().create_task(self._write())
+            await self._flush_task
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def metrics(self) -> Dict[str, Any]:
+        """Показатели работы журнала"""
+        return {
+            'buffered': len(self._buffer),
+            'recorded': self.recorded,
+            'written': self.written,
+            'failures': self.failures
+        }
@@ -0,0 +1,78 @@
+"""Клавиатуры, построенные один раз при запуске бота.
+
+Клавиатуры не зависят от пользователя, поэтому объекты разметки создаются
+заранее и используются всеми обработчиками без повторного построения. Для
+вопросов с выбором нескольких вариантов (ToggleKeyboard) заранее построена
+клавиатура для каждой битовой маски выбранных вариантов: нажатие на вариант
+сводится к поиску клавиатуры по маске.
+"""
+
+from itertools import combinations
+from typing import Dict, List
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+
+def reply_keyboard(rows: List[List[str]]) -> ReplyKeyboardMarkup:
+    """Клавиатура с вариантами ответа, скрывающаяся после выбора"""
+    return ReplyKeyboardMarkup(rows, one_time_keyboard=True, resize_keyboard=True)
+
+
+def subscription_keyboard(channel_username: str) -> InlineKeyboardMarkup:
+    """Кнопки подписки на канал и повторной проверки подписки"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{channel_username.replace('@', '')}")],
+        [InlineKeyboardButton("Я подписан", callback_data="check_subscription")]
+    ])
+
+
+class ToggleKeyboard:
+    """Inline-клавиатура выбора до max_selected вариантов из options.
+
+    Кнопка варианта i передаёт callback_data "<prefix>_i", кнопка завершения -
+    "<prefix>_done"; выбранные варианты отмечены галочкой.
+    """
+
+    def __init__(self, options: List[str], callback_prefix: str, max_selected: int,
+                 done_text: str = "Завершить выбор"):
+        """Построение клавиатур для всех допустимых масок выбора"""
+        self.options = options
+        self.callback_prefix = callback_prefix
+        self.max_selected = max_selected
+        # Кнопки вариантов: без отметки и с отметкой о выборе
+        self._buttons = [
+            InlineKeyboardButton(option, callback_data=f"{callback_prefix}_{i}") for i, option in enumerate(options)
+        ]
+        self._selected_buttons = [
+            InlineKeyboardButton(f"✅ {option}", callback_data=f"{callback_prefix}_{i}")
+            for i, option in enumerate(options)
+        ]
+        self._done_button = InlineKeyboardButton(done_text, callback_data=f"{callback_prefix}_done")
+        # Маска выбранных вариантов -> клавиатура
+        self.markups: Dict[int, InlineKeyboardMarkup] = {
+            mask: self._build(mask)
+            for mask in (
+                sum(1 << i for i in selected)
+                for count in range(max_selected + 1)
+                for selected in combinations(range(len(options)), count)
+            )
+        }
+
+    def _build(self, mask: int) -> InlineKeyboardMarkup:
+        """Клавиатура с отметками выбранных по маске вариантов"""
+        rows = [
+            [self._selected_buttons[i] if mask >> i & 1 else self._buttons[i]]
+            for i in range(len(self.options))
+        ]
+        rows.append([self._done_button])
+        return InlineKeyboardMarkup(rows)
+
+    def markup(self, mask: int) -> InlineKeyboardMarkup:
+        """Клавиатура для маски выбранных вариантов"""
+        keyboard = self.markups.get(mask)
+        if keyboard is None:
+            # Анкета, сохранённая до ограничения числа выбранных вариантов
+            keyboard = self._build(mask)
+        return keyboard
@@ -0,0 +1,162 @@
+"""Журнал работы бота, не задерживающий обработку обновлений.
+
+Корневой журнал только кладёт записи в очередь (QueueHandler): запись в
+файл и на консоль, форматирование и ротация файла выполняются отдельным
+потоком (QueueListener). Медленный или занятый диск задерживает поток
+журнала, а не цикл событий бота и поток базы данных.
+
+Сообщения передаются с аргументами (logging.info("... %s", value)): строка
+собирается, только если запись проходит по уровню. В записи журнала
+попадают пользователь и состояние диалога обрабатываемого обновления
+(log_user, log_state); в формате JSON это отдельные поля.
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime
+from typing import List, Optional
+
+# Пользователь и состояние диалога обновления, которое сейчас обрабатывается
+log_user = contextvars.ContextVar('log_user', default=None)
+log_state = contextvars.ContextVar('log_state', default=None)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s'
+
+# Текст исключения получается сразу: объект исключения не передаётся в другой поток
+_exception_formatter = logging.Formatter()
+
+# Поток записи журнала, запущенный start_queue_logging
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи пользователя и состояние диалога, если они не переданы в extra"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'user_id'):
+            record.user_id = log_user.get()
+        if not hasattr(record, 'state'):
+            record.state = log_state.get()
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, оставляющий форматирование записи потоку журнала.
+
+    В вызывающем потоке только подставляются аргументы сообщения (они могут
+    измениться после возврата из logging.info) и получается текст исключения.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """Текстовый формат; пользователь и состояние - в конце строки"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        user_id = getattr(record, 'user_id', None)
+        state = getattr(record, 'state', None)
+        if user_id is None:
+            record.context = ''
+        elif state is None:
+            record.context = f' [user {user_id}]'
+        else:
+            record.context = f' [user {user_id}, state {state}]'
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key in ('user_id', 'state'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def file_handler(path: str, max_bytes: int = 0, backup_count: int = 5,
+                 rotate_when: Optional[str] = None) -> logging.Handler:
+    """Файл журнала с ротацией по времени (rotate_when, например 'midnight') или по размеру (max_bytes)"""
+    if rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=rotate_when, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+    if max_bytes:
+        return logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+    return logging.FileHandler(path, encoding='utf-8', delay=True)
+
+
+def start_queue_logging(handlers: List[logging.Handler],
+                        level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """Корневой журнал пишет в очередь, а handlers вызываются потоком журнала.
+
+    Прежние обработчики корневого журнала и запущенный ранее поток журнала
+    заменяются; оставшиеся в очереди записи перед этим дописываются.
+    """
+    global _listener
+    stop_queue_logging()
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_queue_logging() -> None:
+    """Запись оставшихся в очереди записей и остановка потока журнала"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def setup_logging(path: str = 'bot.log', level: int = logging.INFO, json_format: bool = False,
+                  max_bytes: int = 0, backup_count: int = 5, rotate_when: Optional[str] = None,
+                  console: bool = True) -> logging.handlers.QueueListener:
+    """Журнал бота: файл path с ротацией и консоль, запись - в отдельном потоке"""
+    formatter = JsonFormatter() if json_format else TextFormatter(TEXT_FORMAT)
+    handlers = [file_handler(path, max_bytes, backup_count, rotate_when)]
+    if console:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return start_queue_logging(handlers, level)
+
+
+# Дописываем очередь при завершении процесса (до logging.shutdown, закрывающего файлы)
+atexit.register(stop_queue_logging)
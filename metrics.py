@@ -0,0 +1,299 @@
+"""Показатели работы бота в формате Prometheus.
+
+Счётчики (Counter) и гистограммы (Histogram) регистрируются в общем реестре
+REGISTRY и изменяются на горячем пути: обработчики диалога, запросы к базе
+данных и вызовы Bot API. Измерение сводится к замеру времени, двоичному
+поиску корзины гистограммы и сложению, без блокировок и выделения памяти:
+значения меняются только из цикла событий бота. Показатели, которые
+компоненты бота уже считают сами (metrics() у SessionStore, SubscriptionCache
+и других), подключаются сборщиками (Registry.add_collector) и читаются
+только при запросе страницы.
+
+MetricsServer отдаёт реестр в текстовом формате по адресу /metrics.
+Если REGISTRY.enabled = False, обёртки вызывают обработчики без измерений.
+"""
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Границы корзин гистограмм времени выполнения, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: Any) -> str:
+    """Значение метки в формате Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = '') -> str:
+    """Метки показателя: {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    """Число в формате Prometheus"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterChild:
+    """Значение счётчика для одного набора меток"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class HistogramChild:
+    """Гистограмма для одного набора меток: число наблюдений по корзинам, сумма и количество"""
+
+    __slots__ = ('bounds', 'buckets', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # Последняя корзина - значения больше всех границ (+Inf)
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """Показатель с метками; значения для набора меток создаются при первом обращении"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: Any):
+        """Значение показателя для набора меток (его стоит запомнить и использовать повторно)"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Показатель {self.name}: ожидаются метки {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> List[str]:
+        """Строки показателя в текстовом формате"""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+
+class Counter(Metric):
+    """Счётчик, который только растёт"""
+
+    kind = 'counter'
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+            for values, child in list(self._children.items())
+        ]
+
+
+class Histogram(Metric):
+    """Гистограмма наблюдений (времени выполнения) по корзинам"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float('inf'),), child.buckets):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    """Реестр показателей и сборщиков"""
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, Any], float]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        """Регистрация счётчика (повторная регистрация возвращает тот же счётчик)"""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        """Регистрация гистограммы (повторная регистрация возвращает ту же гистограмму)"""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric: Metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, Dict[str, Any], float]]]):
+        """Сборщик показателей: функция, возвращающая (имя, метки, значение) на момент запроса"""
+        self._collectors.append(collector)
+
+    def expose(self) -> str:
+        """Все показатели в текстовом формате Prometheus"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.expose())
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    if isinstance(value, (int, float)):
+                        gauges.setdefault(name, []).append((labels, value))
+            except Exception as e:
+                logging.error(f"Ошибка при сборе показателей: {e}")
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(
+                    f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(float(value))}"
+                )
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'survey_bot_handler_seconds', 'Время обработки обновления обработчиком', ('handler',)
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    'survey_bot_handler_errors_total', 'Исключения в обработчиках', ('handler',)
+)
+DB_SECONDS = REGISTRY.histogram(
+    'survey_bot_db_seconds', 'Время выполнения метода базы данных, включая ожидание её потока', ('method',)
+)
+BOT_API_SECONDS = REGISTRY.histogram(
+    'survey_bot_api_seconds', 'Время запроса к Bot API без ожидания в очереди исходящих', ('method',)
+)
+BOT_API_ERRORS = REGISTRY.counter(
+    'survey_bot_api_errors_total', 'Запросы к Bot API, завершившиеся ошибкой', ('method',)
+)
+QUESTIONS_ASKED = REGISTRY.counter(
+    'survey_bot_questions_asked_total', 'Сколько раз задан вопрос опроса', ('survey', 'question')
+)
+SURVEYS_FINISHED = REGISTRY.counter(
+    'survey_bot_surveys_finished_total', 'Завершённые анкеты по вариантам завершения', ('survey', 'ending', 'saved')
+)
+
+
+def instrument(histogram: Histogram, name: str, errors: Optional[Counter] = None):
+    """Декоратор асинхронной функции: время выполнения в гистограмму с меткой name"""
+    child = histogram.labels(name)
+    error_child = errors.labels(name) if errors is not None else None
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return await func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if error_child is not None:
+                    error_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def instrument_handler(handler, name: str):
+    """Замер времени обработчика python-telegram-bot (его callback заменяется обёрткой)"""
+    handler.callback = instrument(HANDLER_SECONDS, name, HANDLER_ERRORS)(handler.callback)
+    return handler
+
+
+class MetricsServer:
+    """HTTP-сервер, отдающий показатели реестра по адресу /metrics"""
+
+    def __init__(self, registry: Registry, listen: str = '127.0.0.1', port: int = 9100):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        """Запуск сервера; при port=0 выбирается свободный порт"""
+        self.server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info("Показатели доступны по адресу http://%s:%s/metrics", self.listen, self.port)
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Ответ на один запрос, после чего соединение закрывается"""
+        try:
+            request_line = await reader.readline()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.decode('latin-1').split(' ')
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+                status, body = '200 OK', self.registry.expose().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
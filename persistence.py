@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранение состояний ConversationHandler и незавершённых анкет в базе бота.
+
+    После перезапуска бота пользователь продолжает опрос с того же вопроса,
+    а уже данные ответы подгружаются SessionStore из таблицы survey_drafts.
+
+    Изменения не записываются по одному: python-telegram-bot передаёт их раз
+    в update_interval секунд, и все изменения за этот период (состояние
+    диалога и текущие ответы каждого затронутого пользователя) фиксируются
+    одной транзакцией. При остановке бота оставшиеся изменения записываются
+    в flush(). user_data, chat_data и bot_data бот не использует и не хранит.
+
+    Если бот запущен несколькими процессами, каждый процесс загружает только
+    диалоги своих пользователей: owns_user(user_id) отвечает, обрабатывает ли
+    этот процесс обновления пользователя.
+    """
+
+    def __init__(self, db, sessions, update_interval: float = 5,
+                 owns_user: Optional[Callable[[int], bool]] = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self.sessions = sessions
+        self.owns_user = owns_user
+        # (имя диалога, ключ) -> новое состояние, ещё не записанное в базу
+        self._pending = {}
+        self._write_task = None
+        self.writes = 0
+        self.transitions = 0
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        """Загрузка состояний диалога при запуске бота"""
+        conversations = await self.db.get_conversations(name)
+        if self.owns_user is not None:
+            conversations = {key: state for key, state in conversations.items() if self.owns_user(key[-1])}
+        logging.info("Восстановлено состояний диалога %s: %s", name, len(conversations))
+        return conversations
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        """Запоминание нового состояния; запись - одной транзакцией на все изменения"""
+        self._pending[(name, key)] = new_state
+        self.transitions += 1
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        """Запись накопленных изменений"""
+        try:
+            # Даём python-telegram-bot передать остальные изменения этого периода
+            await asyncio.sleep(0)
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                by_name = {}
+                for (name, key), state in pending.items():
+                    by_name.setdefault(name, []).append((key, state))
+
+                for name, states in list(by_name.items()):
+                    drafts = []
+                    for key, state in states:
+                        # Ключ диалога - (chat_id, user_id), для личного чата они совпадают
+                        user_id = key[-1]
+                        if state is None:
+                            drafts.append((user_id, None))
+                        else:
+                            answers = self.sessions.peek(user_id)
+                            if answers is not None:
+                                drafts.append((user_id, answers.to_dict()))
+                    if not await self.db.save_conversations(name, states, drafts):
+                        # Не удалось записать - повторим вместе со следующими изменениями
+                        for unsaved_name, unsaved_states in by_name.items():
+                            for key, state in unsaved_states:
+                                self._pending.setdefault((unsaved_name, key), state)
+                        return
+                    del by_name[name]
+                    self.writes += 1
+        finally:
+            self._write_task = None
+
+    async def flush(self) -> None:
+        """Запись всех изменений при остановке бота"""
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending:
+            self._write_task = asyncio.create_task(self._write())
+            await self._write_task
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
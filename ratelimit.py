@@ -0,0 +1,356 @@
+import asyncio
+import heapq
+import itertools
+import time
+import logging
+from collections import deque
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import BOT_API_ERRORS, BOT_API_SECONDS, REGISTRY
+
+# Очереди исходящих сообщений в порядке приоритета
+PRIORITY_SURVEY = 0  # ответы пользователям (по умолчанию)
+PRIORITY_BULK = 1    # тяжёлые отправки: файлы экспорта
+LANE_NAMES = ('survey', 'bulk')
+
+# Методы, на которые распространяются ограничения Telegram на количество сообщений
+THROTTLED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+# Методы, которые по умолчанию отправляются в очередь тяжёлых отправок
+BULK_ENDPOINTS = ('sendDocument', 'sendMediaGroup')
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity за раз"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Outgoing:
+    """Сообщение, ожидающее разрешения на отправку"""
+
+    __slots__ = ('chat', 'future', 'enqueued', 'seq')
+
+    def __init__(self, chat: Any, future: asyncio.Future, enqueued: float, seq: int):
+        self.chat = chat
+        self.future = future
+        self.enqueued = enqueued
+        self.seq = seq
+
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    """Планировщик исходящих запросов к Bot API.
+
+    Сообщения проходят через общее ведро токенов (лимит бота) и ведро чата
+    (лимит на один чат; для групп он строже). Ожидающие отправки сообщения
+    стоят в очередях по приоритету: ответы в опросе уходят раньше файлов
+    экспорта. Приоритет задаётся аргументом rate_limit_args методов бота
+    (PRIORITY_*), по умолчанию он определяется по методу. При ошибке 429
+    отправка всех сообщений приостанавливается на retry_after секунд, после
+    чего запрос повторяется (не больше max_retries раз).
+
+    В каждой очереди приоритета сообщения разложены по чатам (очередь FIFO на
+    чат). Чаты, которым можно отправлять, стоят в куче по порядку поступления
+    их первого сообщения, а чаты, исчерпавшие свой лимит, - в общей куче по
+    времени появления токена. Поэтому выбор следующего сообщения не
+    просматривает все ожидающие сообщения; отменённые сообщения удаляются,
+    когда доходят до начала очереди своего чата.
+    """
+
+    def __init__(self, global_rate: float = 30, global_burst: float = 1, chat_rate: float = 1,
+                 chat_burst: float = 3, group_rate: float = 20 / 60, group_burst: float = 3,
+                 max_retries: int = 3):
+        """Инициализация планировщика; значения по умолчанию соответствуют ограничениям Telegram"""
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        # Общий лимит без запаса на всплеск: Telegram считает сообщения за скользящую секунду
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = {}
+        # Для каждой очереди приоритета: чат -> сообщения чата, куча (номер первого сообщения, чат)
+        # готовых к отправке чатов и множество чатов в этой куче
+        self._queues = [{} for _ in LANE_NAMES]
+        self._ready = [[] for _ in LANE_NAMES]
+        self._ready_chats = [set() for _ in LANE_NAMES]
+        # Чаты, исчерпавшие лимит: куча (когда появится токен, номер, чат) и множество чатов в ней
+        self._throttled = []
+        self._throttled_chats = set()
+        self._depth = [0] * len(LANE_NAMES)
+        self._seq = itertools.count()
+        self._pause_until = 0.0
+        self._wakeup = None
+        self._dispatcher = None
+        self._last_cleanup = time.monotonic()
+        # Показатели работы
+        self.sent = [0] * len(LANE_NAMES)
+        self.wait_total = [0.0] * len(LANE_NAMES)
+        self.wait_max = [0.0] * len(LANE_NAMES)
+        self.max_depth = [0] * len(LANE_NAMES)
+        self.flood_errors = 0
+
+    async def initialize(self) -> None:
+        """Запуск диспетчера очередей"""
+        # Приложение и его Updater инициализируют бота (а с ним и планировщик) каждый по отдельности
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        """Остановка диспетчера; ожидающие отправки запросы отменяются"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for queues in self._queues:
+            for queue in queues.values():
+                for entry in queue:
+                    entry.future.cancel()
+            queues.clear()
+        for ready in self._ready:
+            ready.clear()
+        for ready_chats in self._ready_chats:
+            ready_chats.clear()
+        self._throttled.clear()
+        self._throttled_chats.clear()
+        self._depth = [0] * len(LANE_NAMES)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        """Отправка запроса с учётом ограничений и повтор после ошибки 429"""
+        throttled = endpoint.startswith(THROTTLED_PREFIXES)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            priority = PRIORITY_BULK if endpoint in BULK_ENDPOINTS else PRIORITY_SURVEY
+
+        for attempt in range(self.max_retries + 1):
+            if throttled:
+                await self._acquire(priority, data.get('chat_id'))
+            else:
+                await self._wait_pause()
+            # Время самого запроса (без ожидания в очереди) - в показатель survey_bot_api_seconds
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                self.flood_errors += 1
+                if REGISTRY.enabled:
+                    BOT_API_ERRORS.labels(endpoint).inc()
+                if attempt == self.max_retries:
+                    logging.error(f"Превышен лимит Telegram для {endpoint}, попытки исчерпаны")
+                    raise
+                logging.info("Превышен лимит Telegram для %s, повтор через %s с", endpoint, exc.retry_after)
+                self._pause_until = max(self._pause_until, time.monotonic() + exc.retry_after)
+                self._wakeup.set()
+            except Exception:
+                if REGISTRY.enabled:
+                    BOT_API_ERRORS.labels(endpoint).inc()
+                raise
+            finally:
+                if REGISTRY.enabled:
+                    BOT_API_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+    async def _wait_pause(self):
+        """Ожидание окончания паузы после ошибки 429"""
+        delay = self._pause_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, priority: int, chat_id: Any):
+        """Постановка в очередь и ожидание разрешения на отправку"""
+        lane_index = min(max(priority, 0), len(LANE_NAMES) - 1)
+        entry = Outgoing(self._chat_key(chat_id), asyncio.get_running_loop().create_future(),
+                         time.monotonic(), next(self._seq))
+        queue = self._queues[lane_index].get(entry.chat)
+        if queue is None:
+            queue = self._queues[lane_index][entry.chat] = deque()
+        queue.append(entry)
+        if len(queue) == 1:
+            self._mark_ready(lane_index, entry.chat)
+        self._depth[lane_index] += 1
+        self.max_depth[lane_index] = max(self.max_depth[lane_index], self._depth[lane_index])
+        self._wakeup.set()
+        try:
+            await entry.future
+        except asyncio.CancelledError:
+            # Отменённое сообщение остаётся в очереди чата до её начала, но в глубину не входит
+            if entry.future.cancelled():
+                self._depth[lane_index] -= 1
+            raise
+
+    def _mark_ready(self, lane_index: int, chat: Any):
+        """Чат с сообщениями в очереди lane_index - в кучу готовых, если он не ждёт своего лимита"""
+        if chat in self._throttled_chats or chat in self._ready_chats[lane_index]:
+            return
+        queue = self._queues[lane_index].get(chat)
+        if queue:
+            heapq.heappush(self._ready[lane_index], (queue[0].seq, chat))
+            self._ready_chats[lane_index].add(chat)
+
+    def _chat_key(self, chat_id: Any) -> Any:
+        """Чат в едином виде: числовой id - числом, @username - строкой"""
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return chat_id
+
+    def _chat_bucket(self, chat_id: Any) -> Optional[TokenBucket]:
+        """Ведро токенов чата (для групп и каналов - с более строгим лимитом)"""
+        if chat_id is None:
+            return None
+        chat_id = self._chat_key(chat_id)
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный id или @username - группа или канал
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float):
+        """Первое сообщение в порядке приоритета, чат которого не исчерпал лимит (None - такого нет)"""
+        # Чаты, у которых появился токен, снова готовы к отправке
+        while self._throttled and self._throttled[0][0] <= now:
+            _, _, chat = heapq.heappop(self._throttled)
+            self._throttled_chats.discard(chat)
+            for lane_index in range(len(LANE_NAMES)):
+                self._mark_ready(lane_index, chat)
+
+        for lane_index, ready in enumerate(self._ready):
+            queues = self._queues[lane_index]
+            while ready:
+                seq, chat = ready[0]
+                queue = queues[chat]
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if not queue:
+                    heapq.heappop(ready)
+                    self._ready_chats[lane_index].discard(chat)
+                    del queues[chat]
+                    continue
+                if queue[0].seq != seq:
+                    # Первое сообщение чата было отменено - чат встаёт по следующему
+                    heapq.heapreplace(ready, (queue[0].seq, chat))
+                    continue
+                bucket = self._chat_bucket(chat)
+                wait = bucket.wait_time(now) if bucket is not None else 0.0
+                if wait > 0:
+                    heapq.heappop(ready)
+                    self._ready_chats[lane_index].discard(chat)
+                    if chat not in self._throttled_chats:
+                        heapq.heappush(self._throttled, (now + wait, next(self._seq), chat))
+                        self._throttled_chats.add(chat)
+                    continue
+                return lane_index, queue, bucket
+        return None
+
+    async def _dispatch(self):
+        """Выдача разрешений на отправку: по приоритету, в пределах лимитов"""
+        while True:
+            if not any(self._depth):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            delay = max(self._pause_until - now, self._global_bucket.wait_time(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            picked = self._pick(now)
+            if picked is None:
+                # Все ожидающие чаты упёрлись в свой лимит - ждём освобождения или нового сообщения
+                next_ready = self._throttled[0][0] - now if self._throttled else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_ready)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            lane_index, queue, bucket = picked
+            entry = queue.popleft()
+            ready = self._ready[lane_index]
+            if queue:
+                heapq.heapreplace(ready, (queue[0].seq, entry.chat))
+            else:
+                heapq.heappop(ready)
+                self._ready_chats[lane_index].discard(entry.chat)
+                del self._queues[lane_index][entry.chat]
+            self._depth[lane_index] -= 1
+            self._global_bucket.consume(now)
+            if bucket is not None:
+                bucket.consume(now)
+            entry.future.set_result(None)
+            waited = now - entry.enqueued
+            self.sent[lane_index] += 1
+            self.wait_total[lane_index] += waited
+            self.wait_max[lane_index] = max(self.wait_max[lane_index], waited)
+
+            if now - self._last_cleanup > 60:
+                self._cleanup(now)
+
+    def _cleanup(self, now: float):
+        """Удаление вёдер чатов, которые давно не использовались"""
+        self._last_cleanup = now
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_full(now)]:
+            del self._chat_buckets[chat_id]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Показатели работы планировщика"""
+        lanes = {}
+        for index, name in enumerate(LANE_NAMES):
+            lanes[name] = {
+                'depth': self._depth[index],
+                'max_depth': self.max_depth[index],
+                'sent': self.sent[index],
+                'avg_wait': self.wait_total[index] / self.sent[index] if self.sent[index] else 0.0,
+                'max_wait': self.wait_max[index]
+            }
+        return {
+            'lanes': lanes,
+            'flood_errors': self.flood_errors,
+            'paused_for': max(0.0, self._pause_until - time.monotonic())
+        }
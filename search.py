@@ -0,0 +1,93 @@
+"""Нормализация названий учебных заведений для полнотекстового поиска.
+
+Название учебного заведения респондент вводит сам, поэтому одна и та же
+школа записывается по-разному: "МБОУ СОШ №5", "средняя общеобразовательная
+школа № 5", "школа 5". Перед записью в индекс и перед поиском текст
+приводится к одному виду: нижний регистр, ё -> е, без кавычек и знаков,
+полные названия организационных форм заменены сокращениями, номер отделён от
+слова, окончания слов отброшены (школа, школы, школе -> школ). К сокращениям
+вида СОШ добавляется слово "школ", чтобы по запросу "школа 5" находились и
+такие ответы. В запросе все слова должны найтись в названии.
+"""
+
+import re
+from typing import List, Optional
+
+# Версия нормализации: индекс, заполненный другой версией, заполняется заново
+ORG_INDEX_VERSION = 2
+
+# Полные названия -> сокращения (в тексте, уже приведённом к нижнему регистру)
+ORG_PHRASES = [
+    ('федеральное государственное бюджетное образовательное учреждение высшего образования', 'фгбоу во'),
+    ('государственное бюджетное профессиональное образовательное учреждение', 'гбпоу'),
+    ('государственное автономное профессиональное образовательное учреждение', 'гапоу'),
+    ('государственное бюджетное общеобразовательное учреждение', 'гбоу'),
+    ('муниципальное бюджетное общеобразовательное учреждение', 'мбоу'),
+    ('муниципальное автономное общеобразовательное учреждение', 'маоу'),
+    ('муниципальное казенное общеобразовательное учреждение', 'мкоу'),
+    ('муниципальное общеобразовательное учреждение', 'моу'),
+    ('средняя общеобразовательная школа', 'сош'),
+    ('основная общеобразовательная школа', 'оош'),
+    ('начальная общеобразовательная школа', 'нош'),
+]
+
+# Сокращения, по которым ответ должен находиться и по основе слова "школа"
+ORG_IMPLIED = {'сош': 'школ', 'оош': 'школ', 'нош': 'школ'}
+
+# Слова, записываемые по-разному
+ORG_SYNONYMS = {'имени': 'им'}
+
+# Гласные и знаки, отбрасываемые в конце слова (не больше двух, основа - не короче 4 букв)
+_ENDINGS = set('аеиоуыэюяйь')
+
+_PHRASES_RE = re.compile('|'.join(re.escape(phrase) for phrase, _ in ORG_PHRASES))
+_PHRASES = dict(ORG_PHRASES)
+_WORD_RE = re.compile(r'[^\W_]+')
+# Слово, сразу за которым идёт номер: "сош5" -> "сош 5"
+_LETTER_DIGIT_RE = re.compile(r'(?<=[^\W\d_])(?=\d)')
+# Номер и буква сразу после него или через дефис: "5а", "5-а". Третья группа -
+# продолжение слова или сокращения с точкой ("№5г.Астрахани"): тогда буква к
+# номеру не относится. Буква через пробел или другой знак не проверяется вовсе
+_NUMBER_LETTER_RE = re.compile(r'(\d+)(?:\s*-\s*)?([^\W\d_])(?=([^\W_]|\.\s*[^\W\d_])?)')
+
+
+def _stem(word: str) -> str:
+    """Основа слова: без одной-двух конечных гласных"""
+    if word.isdigit():
+        return word
+    for _ in range(2):
+        if len(word) > 4 and word[-1] in _ENDINGS:
+            word = word[:-1]
+    return word
+
+
+def _number_letter(match: re.Match) -> str:
+    """Номер с литерой ("5а") или номер и отдельное слово ("5 г.")"""
+    number, letter, following = match.groups()
+    return f"{number}{letter}" if following is None else f"{number} {letter}"
+
+
+def org_tokens(text: Optional[str]) -> List[str]:
+    """Слова названия в нормализованном виде"""
+    if not text:
+        return []
+    text = text.lower().replace('ё', 'е')
+    text = _PHRASES_RE.sub(lambda match: _PHRASES[match.group(0)], text)
+    text = _LETTER_DIGIT_RE.sub(' ', text)
+    text = _NUMBER_LETTER_RE.sub(_number_letter, text)
+    return [_stem(ORG_SYNONYMS.get(word, word)) for word in _WORD_RE.findall(text)]
+
+
+def org_index_text(text: Optional[str]) -> str:
+    """Текст названия для индекса: нормализованные слова и слова, подразумеваемые сокращениями"""
+    tokens = org_tokens(text)
+    tokens.extend(ORG_IMPLIED[token] for token in list(tokens) if token in ORG_IMPLIED)
+    return ' '.join(tokens)
+
+
+def org_match_query(text: Optional[str]) -> Optional[str]:
+    """Выражение FTS5 для поиска по названию: все слова запроса (None, если слов нет)"""
+    tokens = list(dict.fromkeys(org_tokens(text)))
+    if not tokens:
+        return None
+    return ' AND '.join(f'"{token}"' for token in tokens)
@@ -0,0 +1,88 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Any
+
+from survey import SurveyAnswers
+
+
+class SessionStore:
+    """Хранилище ответов пользователей, которые проходят опрос прямо сейчас.
+
+    В памяти держатся только активные анкеты. Анкета вытесняется, если к ней
+    не обращались дольше ttl секунд или если анкет больше max_size (вытесняется
+    та, к которой обращались раньше всех). При обращении к отсутствующей анкете
+    из базы данных подгружается незавершённая анкета, сохранённая
+    SQLitePersistence; если её нет, начинается пустая анкета. Результаты
+    завершённого опроса не подгружаются: иначе опрос продолжился бы с прежней
+    анкеты и её ответы сохранились бы повторно вместе с новыми.
+    """
+
+    def __init__(self, db, max_size: int = 10000, ttl: float = 24 * 60 * 60):
+        """Инициализация хранилища"""
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (ответы, время последнего обращения); порядок - от давних обращений к свежим
+        self._sessions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def start(self, user_id: int) -> SurveyAnswers:
+        """Создание новой анкеты пользователя"""
+        answers = SurveyAnswers()
+        self._put(user_id, answers)
+        return answers
+
+    async def get(self, user_id: int) -> SurveyAnswers:
+        """Получение анкеты пользователя с подгрузкой из базы данных при промахе"""
+        session = self._sessions.get(user_id)
+        if session is not None and time.monotonic() - session[1] <= self.ttl:
+            self.hits += 1
+            self._put(user_id, session[0])
+            return session[0]
+
+        self.misses += 1
+        draft = await self.db.get_draft(user_id)
+        answers = SurveyAnswers.from_dict(draft) if draft else SurveyAnswers()
+        self._put(user_id, answers)
+        return answers
+
+    def peek(self, user_id: int):
+        """Анкета пользователя, если она в памяти (без учёта в показателях и без продления)"""
+        session = self._sessions.get(user_id)
+        return session[0] if session is not None else None
+
+    def finish(self, user_id: int):
+        """Удаление анкеты после завершения опроса"""
+        self._sessions.pop(user_id, None)
+
+    def _put(self, user_id: int, answers: SurveyAnswers):
+        """Сохранение анкеты как самой свежей и вытеснение устаревших"""
+        now = time.monotonic()
+        self._sessions[user_id] = (answers, now)
+        self._sessions.move_to_end(user_id)
+
+        # Устаревшие анкеты всегда находятся в начале очереди
+        while self._sessions:
+            oldest_user_id, (_, last_access) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_size and now - last_access <= self.ttl:
+                break
+            del self._sessions[oldest_user_id]
+            self.evictions += 1
+            logging.info("Анкета пользователя %s вытеснена из памяти", oldest_user_id, extra={'user_id': oldest_user_id})
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Показатели работы хранилища"""
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions
+        }
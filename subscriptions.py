@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Any
+
+# Статусы участника канала, при которых пользователь считается подписанным
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+
+class SubscriptionCache:
+    """Кэш статуса подписки пользователей на канал.
+
+    Проверка подписки - запрос к Bot API, поэтому результат запоминается:
+    подтверждённая подписка на positive_ttl секунд, её отсутствие - на
+    negative_ttl секунд (обычно меньше, чтобы только что подписавшийся
+    пользователь не ждал долго). Одновременные проверки одного пользователя
+    выполняются одним запросом. Ошибки запроса не кэшируются.
+    """
+
+    def __init__(self, channel_id: str, positive_ttl: float = 10 * 60, negative_ttl: float = 30,
+                 max_size: int = 100000):
+        """Инициализация кэша"""
+        self.channel_id = channel_id
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # user_id -> (подписан ли, момент устаревания); порядок - от давних проверок к свежим
+        self._entries = OrderedDict()
+        # user_id -> выполняющаяся проверка
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.invalidations = 0
+
+    async def is_subscribed(self, bot, user_id: int) -> bool:
+        """Проверка подписки с использованием кэша"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if time.monotonic() < entry[1]:
+                self.hits += 1
+                return entry[0]
+            del self._entries[user_id]
+
+        task = self._in_flight.get(user_id)
+        if task is not None:
+            # Проверка этого пользователя уже выполняется - ждём её результат
+            self.shared += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._fetch(bot, user_id))
+        self._in_flight[user_id] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._in_flight.get(user_id) is task:
+                del self._in_flight[user_id]
+
+    async def _fetch(self, bot, user_id: int) -> bool:
+        """Запрос статуса подписки и сохранение результата"""
+        chat_member = await bot.get_chat_member(chat_id=self.channel_id, user_id=user_id)
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        # Результат проверки, начатой до сброса, не сохраняется
+        if self._in_flight.get(user_id) is asyncio.current_task():
+            self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            self._evict()
+        return subscribed
+
+    def _evict(self):
+        """Удаление записей из начала очереди: устаревших, а при переполнении - самых старых.
+
+        Просмотр останавливается на первой действующей записи, поэтому не зависит
+        от размера кэша. Устаревшая запись за ней (отсутствие подписки хранится
+        меньше, чем подписка) удаляется позже или при обращении к ней.
+        """
+        now = time.monotonic()
+        while self._entries:
+            _, expires = next(iter(self._entries.values()))
+            if len(self._entries) <= self.max_size and expires > now:
+                break
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """Сброс сохранённого статуса (например, после нажатия "Я подписан")"""
+        self.invalidations += 1
+        self._entries.pop(user_id, None)
+        self._in_flight.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Показатели работы кэша"""
+        requests = self.hits + self.misses + self.shared
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'invalidations': self.invalidations,
+            'hit_rate': (self.hits + self.shared) / requests if requests else 0.0
+        }
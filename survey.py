@@ -0,0 +1,325 @@
+from typing import Dict, List, Any
+
+# Данные для опроса
+municipalities = [
+    "Ахтубинский район", "Володарский район", "Город Астрахань", "Енотаевский район",
+    "ЗАТО Знаменск", "Икрянинский район", "Камызякский район", "Красноярский округ",
+    "Лиманский район", "Наримановский район", "Приволжский район", "Харабалинский район",
+    "Черноярский округ"
+]
+
+categories = ["Ученик", "Студент ССУЗа", "Студент ВУЗа"]
+
+directions = [
+    "Волонтерство и добровольчество", "Труд, профессия и свое дело", "Спорт",
+    "Образование и знания", "Культура и искусство", "Наука и технологии",
+    "Патриотизм и историческая память", "Медиа и коммуникации", "Здоровый образ жизни",
+    "Экология и охрана природы", "Дипломатия и международные отношения", "Туризм и путешествия"
+]
+
+yes_no = ["Да", "Нет"]
+
+ratings = ["1", "2", "3", "4", "5"]
+
+# Все вопросы анкеты в порядке колонок таблицы результатов
+FIELDS = (
+    'municipality', 'category', 'education_org', 'knows_movement', 'is_participant',
+    'knows_curator', 'selected_directions', 'region_rating', 'organization_rating', 'knows_kosa',
+    'student_government_rating'
+)
+
+# Вопросы с вариантами ответа: ответ хранится номером варианта (с 1, 0 - нет ответа)
+CODED_FIELDS = {
+    'municipality': municipalities,
+    'category': categories,
+    'knows_movement': yes_no,
+    'is_participant': yes_no,
+    'knows_curator': yes_no,
+    'knows_kosa': yes_no,
+}
+
+CODES = {field: {value: code for code, value in enumerate(options, 1)} for field, options in CODED_FIELDS.items()}
+
+# Оценки от 1 до 5 упаковываются в одно число по 3 бита на оценку
+RATING_SHIFTS = {
+    'region_rating': 0,
+    'organization_rating': 3,
+    'student_government_rating': 6,
+}
+
+# Ключи словаря анкеты, которые не являются ответами
+RESULT_META = ('user_id', 'timestamp', 'survey')
+
+_MISSING = object()
+
+
+class SurveyAnswers:
+    """Компактное представление ответов одного респондента.
+
+    Вместо словаря строк хранятся номера вариантов ответа, битовая маска
+    выбранных направлений и упакованные оценки. Ответ, которого нет среди
+    вариантов (например, набранный вручную текст), хранится строкой как есть.
+    Доступ к ответам - как к словарю: answers['category'], answers.get(...).
+    Ответы на вопросы других опросов (не из FIELDS) хранятся в словаре extra,
+    survey - имя опроса, который проходит пользователь (None - опрос по умолчанию).
+    """
+
+    __slots__ = (
+        'municipality', 'category', 'education_org', 'knows_movement', 'is_participant',
+        'knows_curator', 'knows_kosa', 'ratings', 'directions_mask', 'survey', 'extra'
+    )
+
+    def __init__(self):
+        self.municipality = 0
+        self.category = 0
+        self.education_org = None
+        self.knows_movement = 0
+        self.is_participant = 0
+        self.knows_curator = 0
+        self.knows_kosa = 0
+        self.ratings = 0
+        self.directions_mask = 0
+        self.survey = None
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'SurveyAnswers':
+        """Создание из словаря ответов (например, строки базы данных)"""
+        answers = cls()
+        answers.survey = data.get('survey')
+        for field, value in data.items():
+            if field not in RESULT_META:
+                answers[field] = value
+        return answers
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Преобразование в словарь ответов для сохранения в базу данных"""
+        data = {field: value for field in FIELDS if (value := self.get(field, _MISSING)) is not _MISSING}
+        if self.extra:
+            data.update(self.extra)
+        if self.survey is not None:
+            data['survey'] = self.survey
+        return data
+
+    def __setitem__(self, field: str, value: Any):
+        if field in CODED_FIELDS:
+            setattr(self, field, CODES[field].get(value, value or 0))
+        elif field in RATING_SHIFTS:
+            shift = RATING_SHIFTS[field]
+            code = int(value) if value in ratings else 0
+            self.ratings = (self.ratings & ~(0b111 << shift)) | (code << shift)
+        elif field == 'selected_directions':
+            self.directions_mask = 0
+            for idx in value or []:
+                self.add_direction(idx)
+        elif field == 'education_org':
+            self.education_org = value or None
+        elif value:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[field] = value
+        elif self.extra:
+            self.extra.pop(field, None)
+
+    def get(self, field: str, default: Any = None) -> Any:
+        if field in CODED_FIELDS:
+            value = getattr(self, field)
+            if not value:
+                return default
+            return CODED_FIELDS[field][value - 1] if isinstance(value, int) else value
+        if field in RATING_SHIFTS:
+            code = (self.ratings >> RATING_SHIFTS[field]) & 0b111
+            return str(code) if code else default
+        if field == 'selected_directions':
+            return self.selected_directions
+        if field == 'education_org':
+            return self.education_org if self.education_org is not None else default
+        return self.extra.get(field, default) if self.extra else default
+
+    def __getitem__(self, field: str) -> Any:
+        value = self.get(field, _MISSING)
+        if value is _MISSING:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field: str) -> bool:
+        return self.get(field, _MISSING) is not _MISSING
+
+    @property
+    def selected_directions(self) -> List[int]:
+        """Номера выбранных направлений"""
+        return [idx for idx in range(len(directions)) if self.directions_mask >> idx & 1]
+
+    def has_direction(self, idx: int) -> bool:
+        return bool(self.directions_mask >> idx & 1)
+
+    def add_direction(self, idx: int):
+        self.directions_mask |= 1 << idx
+
+    def remove_direction(self, idx: int):
+        self.directions_mask &= ~(1 << idx)
+
+    def direction_count(self) -> int:
+        return self.directions_mask.bit_count()
+
+
+# Напоминание о боте "ТРЕВОГА АСТРАХАНЬ" в конце опроса
+REMINDER = (
+    "Также напоминаем о боте \"ТРЕВОГА АСТРАХАНЬ\" @trevoga30_bot в который приходит вся проверенная "
+    "информация о БПЛА и других ЧП региона. Думайте. Подпишись, чтобы быть в курсе."
+)
+
+RATING_PROMPT = "Оцените по шкале от 1 до 5, где 5 - \"отлично\", а 1 - \"плохо\""
+
+# Описание опроса: вопросы, переходы между ними и варианты завершения.
+# Вопрос: id - поле анкеты, text - текст вопроса, options - допустимые ответы
+# (без них принимается любой текст), layout - кнопки в столбик (column) или
+# в ряд (row), invalid - ответ на недопустимый вариант, next - следующий
+# вопрос или завершение ("end:<имя>"); next может зависеть от ответа:
+# {'field': поле, 'cases': {ответ: переход}, 'default': переход}.
+# Вопрос type=multi - выбор до max вариантов inline-кнопками. Номера состояний
+# диалога (они сохраняются в базе) - по порядку вопросов, поэтому новые
+# вопросы добавляются в конец списка.
+# В текстах завершений {summary} - сводка ответов; строки сводки с when
+# выводятся, только если ответ на поле входит в перечисленные варианты.
+SURVEY = {
+    'name': 'survey',
+    'wave': 1,
+    'questions': [
+        {
+            'id': 'municipality',
+            'text': "Опрос для обучающихся и студентов Астраханской области\n\nУкажите Ваше муниципальное образование:",
+            'options': municipalities,
+            'next': 'category',
+        },
+        {
+            'id': 'category',
+            'text': "Выберите категорию, к которой вы относитесь:",
+            'options': categories,
+            # Студентам ВУЗов - вопрос о Молодежном центре "Коса"
+            'next': {'field': 'category', 'cases': {"Студент ВУЗа": 'knows_kosa'}, 'default': 'education_org'},
+        },
+        {
+            'id': 'education_org',
+            'text': "Введите название Вашей образовательной организации:",
+            # Студентам ВУЗов - оценка студенческого самоуправления
+            'next': {'field': 'category', 'cases': {"Студент ВУЗа": 'student_government_rating'},
+                     'default': 'knows_movement'},
+        },
+        {
+            'id': 'knows_movement',
+            'text': "Знаете ли Вы о проектах Общероссийского общественно-государственного движения детей и молодежи "
+                    "\"Движение первых\"? @mypervie30",
+            'options': yes_no,
+            'next': {'field': 'knows_movement', 'cases': {"Да": 'is_participant'}, 'default': 'end:not_familiar'},
+        },
+        {
+            'id': 'is_participant',
+            'text': "Являетесь ли Вы участником Движения Первых?",
+            'options': yes_no,
+            'next': {'field': 'is_participant', 'cases': {"Нет": 'end:not_participant'}, 'default': 'knows_curator'},
+        },
+        {
+            'id': 'knows_curator',
+            'text': "Знаете ли Вы куратора первичного отделения Движения Первых в Вашей образовательной организации?",
+            'options': yes_no,
+            'next': 'selected_directions',
+        },
+        {
+            'id': 'selected_directions',
+            'type': 'multi',
+            'text': "Укажите 3 направления Движения Первых, в проектах которых Вы принимаете активное участие:\n"
+                    "(Выберите до 3 направлений, затем нажмите 'Завершить выбор')",
+            'progress': "Укажите 3 направления Движения Первых, в проектах которых Вы принимаете активное участие:\n"
+                        "(Выбрано: {count}/{max})",
+            'done': "Вы выбрали следующие направления:\n• {selected}",
+            'empty': "Пожалуйста, выберите хотя бы одно направление",
+            'added': "Вы выбрали: {option}",
+            'removed': "Вы отменили выбор: {option}",
+            'limit': "Вы уже выбрали 3 направления. Отмените одно из них или завершите выбор.",
+            'options': directions,
+            'max': 3,
+            'callback': 'direction',
+            'next': 'region_rating',
+        },
+        {
+            'id': 'region_rating',
+            'text': "Оцените уровень развития Движения Первых на территории Вашего муниципального образования\n"
+                    + RATING_PROMPT,
+            'options': ratings,
+            'layout': 'row',
+            'invalid': "Пожалуйста, выберите оценку от 1 до 5:",
+            'next': 'organization_rating',
+        },
+        {
+            'id': 'organization_rating',
+            'text': "Оцените уровень организации и проведения мероприятий Движения Первых в Вашей образовательной "
+                    "организации\n" + RATING_PROMPT,
+            'options': ratings,
+            'layout': 'row',
+            'invalid': "Пожалуйста, выберите оценку от 1 до 5:",
+            'next': 'end:participant',
+        },
+        {
+            'id': 'knows_kosa',
+            'text': "Знаете ли вы о работе Молодежного центра \"Коса\"? @dmpp30",
+            'options': yes_no,
+            'next': 'education_org',
+        },
+        {
+            'id': 'student_government_rating',
+            'text': "Оцените деятельность работы студенческого самоуправления Вашего учебного заведения\n"
+                    + RATING_PROMPT,
+            'options': ratings,
+            'layout': 'row',
+            'invalid': "Пожалуйста, выберите оценку от 1 до 5:",
+            'next': 'end:student',
+        },
+    ],
+    'summary': {
+        'title': "📋 Ваши ответы:\n\n",
+        'lines': [
+            {'text': "🏙️ Муниципальное образование: {municipality}"},
+            {'text': "👤 Категория: {category}"},
+            {'text': "🏫 Образовательная организация: {education_org}"},
+            {'text': "📊 Оценка студенческого самоуправления: {student_government_rating}/5",
+             'when': {'category': ["Студент ВУЗа"]}},
+            {'text': "🚩 Знание о Молодежном центре \"Коса\": {knows_kosa}", 'when': {'category': ["Студент ВУЗа"]}},
+            {'text': "🚩 Знание о Движении Первых: {knows_movement}",
+             'when': {'category': ["Ученик", "Студент ССУЗа"]}},
+            {'text': "🧑‍🤝‍🧑 Участие в Движении: {is_participant}", 'when': {'knows_movement': ["Да"]}},
+            {'text': "👨‍🏫 Знание куратора: {knows_curator}", 'when': {'knows_movement': ["Да"]}},
+            {'text': "🧭 Выбранные направления: {selected_directions}", 'when': {'knows_movement': ["Да"]}},
+            {'text': "⭐ Оценка в муниципалитете: {region_rating}/5", 'when': {'knows_movement': ["Да"]}},
+            {'text': "🏫 Оценка в организации: {organization_rating}/5", 'when': {'knows_movement': ["Да"]}},
+        ],
+        'missing': "Не указано",
+    },
+    'endings': {
+        'not_familiar': [
+            {'text': "Спасибо за участие в опросе! Ваши ответы записаны.", 'remove_keyboard': True},
+            {'text': REMINDER},
+        ],
+        'not_participant': [
+            {'text': "Спасибо за участие в опросе! Ваши ответы успешно записаны.", 'remove_keyboard': True},
+            {'text': "Будь с нами!\n\n" + REMINDER},
+        ],
+        'participant': [
+            {'text': "{summary}\n\nБудь с нами!\n\n" + REMINDER},
+        ],
+        'student': [
+            {'text': "Спасибо за участие в опросе! Ваши ответы успешно записаны.", 'remove_keyboard': True},
+            {'text': "{summary}"},
+            {'text': REMINDER},
+        ],
+    },
+    'save_error': "К сожалению, произошла ошибка при сохранении ваших ответов. "
+                  "Пожалуйста, попробуйте пройти опрос позже.",
+}
+
+# Опросы, которые бот проводит одновременно. Первый проходят по команде /start,
+# остальные - по ссылке t.me/<бот>?start=<name>. Новая волна опроса - то же
+# описание с новым номером wave: ответы каждой волны хранятся отдельно.
+# Новые опросы добавляются в конец списка: от позиции опроса зависят номера
+# состояний его диалога, сохранённые в базе.
+SURVEYS = [SURVEY]
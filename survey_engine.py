@@ -0,0 +1,193 @@
+"""Исполнение опроса по его описанию.
+
+Опрос задаётся данными (см. SURVEY в survey.py): вопросы с вариантами
+ответа, переходы, которые могут зависеть от уже данных ответов, и варианты
+завершения. При запуске бота описание компилируется в таблицу переходов:
+состояние ConversationHandler -> вопрос, у вопроса - множество допустимых
+ответов, готовая клавиатура и словарь "ответ -> следующий шаг". Обработка
+ответа сводится к нескольким поискам по словарям, без ветвлений в коде
+обработчиков; ошибки в описании обнаруживаются при компиляции.
+"""
+
+from typing import Any, Dict, List, Tuple, Union
+
+from keyboards import REMOVE_KEYBOARD, ToggleKeyboard, reply_keyboard
+
+# Состояние 0 занято проверкой подписки, вопросы первого опроса нумеруются с 1
+FIRST_STATE = 1
+
+# Сколько состояний диалога отведено одному опросу: вопросы опроса номер i
+# (по порядку в SURVEYS) занимают состояния с FIRST_STATE + i * SURVEY_STATES
+SURVEY_STATES = 100
+
+# Поля анкеты с выбором нескольких вариантов и атрибут SurveyAnswers с их битовой маской
+MASK_FIELDS = {'selected_directions': 'directions_mask'}
+
+ENDING_PREFIX = 'end:'
+
+
+class Ending:
+    """Завершение опроса: сообщения, отправляемые после сохранения анкеты"""
+
+    __slots__ = ('name', 'messages')
+
+    def __init__(self, name: str, messages: List[Tuple[str, bool]]):
+        self.name = name
+        # (текст, убрать ли клавиатуру)
+        self.messages = messages
+
+
+class Branch:
+    """Переход, зависящий от ответа на вопрос field"""
+
+    __slots__ = ('field', 'cases', 'default')
+
+    def __init__(self, field: str, cases: Dict[str, Any], default: Any):
+        self.field = field
+        self.cases = cases
+        self.default = default
+
+
+class Question:
+    """Скомпилированный вопрос опроса"""
+
+    __slots__ = (
+        'id', 'state', 'kind', 'text', 'options', 'valid', 'keyboard', 'invalid', 'next',
+        'mask_attribute', 'max_selected', 'callback_prefix', 'texts'
+    )
+
+    def __init__(self, spec: Dict[str, Any], state: int):
+        self.id = spec['id']
+        self.state = state
+        self.kind = spec.get('type', 'choice' if spec.get('options') else 'text')
+        self.text = spec['text']
+        self.options = list(spec.get('options') or [])
+        self.invalid = spec.get('invalid', "Пожалуйста, выберите один из предложенных вариантов:")
+        self.next = None
+        self.mask_attribute = None
+        self.max_selected = None
+        self.callback_prefix = None
+        self.texts = {}
+        if self.kind == 'choice':
+            # Допустимые ответы - множество для проверки за O(1)
+            self.valid = frozenset(self.options)
+            rows = [self.options] if spec.get('layout') == 'row' else [[option] for option in self.options]
+            self.keyboard = reply_keyboard(rows)
+        elif self.kind == 'text':
+            self.valid = None
+            self.keyboard = REMOVE_KEYBOARD
+        elif self.kind == 'multi':
+            if self.id not in MASK_FIELDS:
+                raise ValueError(f"Вопрос {self.id}: выбор нескольких вариантов не поддерживается для этого поля")
+            self.valid = None
+            self.mask_attribute = MASK_FIELDS[self.id]
+            self.max_selected = spec['max']
+            self.callback_prefix = spec['callback']
+            self.keyboard = ToggleKeyboard(self.options, self.callback_prefix, self.max_selected)
+            self.texts = {key: spec[key] for key in ('progress', 'done', 'empty', 'added', 'removed', 'limit')}
+        else:
+            raise ValueError(f"Вопрос {self.id}: неизвестный тип {self.kind}")
+
+    def is_valid(self, answer: str) -> bool:
+        """Допустим ли ответ на вопрос"""
+        return self.valid is None or answer in self.valid
+
+    def next_step(self, answers) -> Union['Question', Ending]:
+        """Следующий вопрос или завершение опроса после ответа на этот вопрос"""
+        step = self.next
+        if isinstance(step, Branch):
+            step = step.cases.get(answers.get(step.field), step.default)
+        return step
+
+
+class CompiledSurvey:
+    """Опрос, готовый к исполнению: таблица переходов по состояниям"""
+
+    def __init__(self, definition: Dict[str, Any], first_state: int = FIRST_STATE):
+        """Компиляция описания опроса; ошибки описания - ValueError"""
+        self.name = definition['name']
+        self.wave = definition.get('wave', 1)
+        # Номер опроса (волны) в базе данных, задаётся при регистрации опроса
+        self.id = None
+        questions = definition['questions']
+        if len(questions) > SURVEY_STATES:
+            raise ValueError(f"Опрос {self.name}: больше {SURVEY_STATES} вопросов")
+        self.by_id: Dict[str, Question] = {}
+        for state, spec in enumerate(questions, first_state):
+            if spec['id'] in self.by_id:
+                raise ValueError(f"Вопрос {spec['id']} описан дважды")
+            self.by_id[spec['id']] = Question(spec, state)
+        # Состояние ConversationHandler -> вопрос
+        self.states: Dict[int, Question] = {question.state: question for question in self.by_id.values()}
+        self.first = self.by_id[questions[0]['id']]
+        # Префикс callback_data -> вопрос с выбором нескольких вариантов
+        self.callbacks = {
+            question.callback_prefix: question for question in self.by_id.values() if question.kind == 'multi'
+        }
+
+        self.endings = {
+            name: Ending(name, [(message['text'], message.get('remove_keyboard', False)) for message in messages])
+            for name, messages in definition['endings'].items()
+        }
+        for spec in questions:
+            self.by_id[spec['id']].next = self._compile_step(spec['id'], spec['next'])
+
+        summary = definition.get('summary', {})
+        self.summary_title = summary.get('title', '')
+        self.missing = summary.get('missing', '')
+        self.summary_lines = [
+            (line['text'], [(field, frozenset(values)) for field, values in line.get('when', {}).items()])
+            for line in summary.get('lines', [])
+        ]
+        self.save_error = definition['save_error']
+
+    def _compile_step(self, question_id: str, step: Any) -> Union[Question, Ending, Branch]:
+        """Переход: вопрос, завершение или ветвление по ответу"""
+        if isinstance(step, dict):
+            if step['field'] not in self.by_id:
+                raise ValueError(f"Вопрос {question_id}: переход зависит от неизвестного вопроса {step['field']}")
+            return Branch(
+                step['field'],
+                {answer: self._compile_step(question_id, target) for answer, target in step['cases'].items()},
+                self._compile_step(question_id, step['default'])
+            )
+        if step.startswith(ENDING_PREFIX):
+            ending = self.endings.get(step[len(ENDING_PREFIX):])
+            if ending is None:
+                raise ValueError(f"Вопрос {question_id}: неизвестное завершение {step}")
+            return ending
+        question = self.by_id.get(step)
+        if question is None:
+            raise ValueError(f"Вопрос {question_id}: переход к неизвестному вопросу {step}")
+        return question
+
+    def values(self, answers) -> Dict[str, str]:
+        """Ответы анкеты в виде текста для подстановки в сообщения"""
+        values = {}
+        for field, question in self.by_id.items():
+            value = answers.get(field)
+            if question.kind == 'multi':
+                value = ', '.join(question.options[idx] for idx in value) if value else None
+            values[field] = value if value is not None else self.missing
+        return values
+
+    def summary(self, answers) -> str:
+        """Сводка ответов анкеты"""
+        values = self.values(answers)
+        lines = [
+            text.format_map(values) for text, conditions in self.summary_lines
+            if all(answers.get(field) in allowed for field, allowed in conditions)
+        ]
+        return self.summary_title + ''.join(line + '\n' for line in lines)
+
+    def render_ending(self, ending: Ending, answers) -> List[Tuple[str, bool]]:
+        """Тексты сообщений завершения опроса"""
+        summary = None
+        messages = []
+        for text, remove_keyboard in ending.messages:
+            if '{summary}' in text:
+                if summary is None:
+                    summary = self.summary(answers)
+                text = text.replace('{summary}', summary)
+            messages.append((text, remove_keyboard))
+        return messages
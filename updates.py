@@ -0,0 +1,66 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Hashable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from logs import log_user
+
+
+class KeyedLocks:
+    """Блокировки по ключу (например, по пользователю); освободившиеся блокировки удаляются"""
+
+    def __init__(self):
+        # ключ -> [блокировка, количество ожидающих её]
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """Захват блокировки ключа; ожидающие получают её в порядке очереди"""
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Одновременно обрабатывается не больше max_concurrent_updates обновлений,
+    но обновления одного пользователя - строго по очереди, в порядке
+    поступления: иначе два быстрых ответа могли бы пройти через
+    ConversationHandler в одном и том же состоянии.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = KeyedLocks()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Обработка обновления под блокировкой его пользователя"""
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+
+        # Записи журнала, сделанные при обработке обновления, относятся к его пользователю
+        log_user.set(user.id)
+        async with self._user_locks.hold(user.id):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass